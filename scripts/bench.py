@@ -0,0 +1,676 @@
+#!/usr/bin/env python3
+"""
+Benchmark the scripts on synthetic reads and reports, with stand-ins for
+centrifuge, centrifuge-inspect and fastq-dump on the PATH
+"""
+
+import argparse
+import contextlib
+import gzip
+import io
+import json
+import os
+import platform
+import random
+import shlex
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from typing import Callable, Dict, List, Optional
+
+CUR_DIR = os.path.dirname(os.path.realpath(__file__))
+BENCHES = ['startup', 'fasplit', 'collapse', 'unsplit', 'discover',
+           'parse_files', 'pipeline']
+NUM_TAXA = 50
+
+# Classifies each read as species 1000 + n (n from a hash of its name),
+# with FAKE_CENTRIFUGE_MATCHES lines per read after sleeping
+# FAKE_CENTRIFUGE_LATENCY seconds
+FAKE_CENTRIFUGE = """#!/usr/bin/env python3
+import collections, gzip, os, sys, time, zlib
+args = sys.argv[1:]
+opts = {}
+while args:
+    flag = args.pop(0)
+    with_value = ['-p', '-x', '-U', '-1', '-2', '-S', '--report-file',
+                  '--exclude-taxids']
+    opts[flag] = args.pop(0) if flag in with_value else True
+time.sleep(float(os.environ.get('FAKE_CENTRIFUGE_LATENCY', 0)))
+matches = int(os.environ.get('FAKE_CENTRIFUGE_MATCHES', 1))
+fasta = '-f' in opts
+
+def reads_in(file):
+    return (sys.stdin.buffer if file == '-' else
+            gzip.open(file) if file.endswith('.gz') else open(file, 'rb'))
+
+def names(fh):
+    for num, line in enumerate(fh):
+        if line.startswith(b'>') if fasta else num % 4 == 0:
+            yield line[1:].split()[0]
+
+reads = collections.Counter()
+with open(opts['-S'], 'w') as out:
+    out.write('readID\\tseqID\\ttaxID\\tscore\\t2ndBestScore\\thitLength\\t'
+              'queryLength\\tnumMatches\\n')
+    firsts = (opts.get('-U') or opts['-1']).split(',')
+    seconds = opts['-2'].split(',') if '-2' in opts else [''] * len(firsts)
+    for file, mate_file in zip(firsts, seconds):
+        # Mates carry no information here, but are opened with the first
+        # reads and read in step, as Centrifuge does (named pipes need it)
+        fh = reads_in(file)
+        mate_names = names(reads_in(mate_file)) if mate_file else iter(())
+        for name in names(fh):
+            next(mate_names, None)
+            first = zlib.crc32(name)
+            for i in range(matches):
+                tax_id = 1000 + (first + i) % NUM_TAXA
+                reads[tax_id] += 1
+                out.write(f'{name.decode()}\\tseq{tax_id}\\t{tax_id}\\t'
+                          f'100\\t0\\t50\\t50\\t{matches}\\n')
+        for _ in mate_names:
+            pass
+
+total = sum(reads.values())
+with open(opts['--report-file'], 'w') as out:
+    out.write('name\\ttaxID\\ttaxRank\\tgenomeSize\\tnumReads\\t'
+              'numUniqueReads\\tabundance\\n')
+    for tax_id, count in reads.most_common():
+        out.write(f'Genus{(tax_id - 1000) // 5} species{tax_id}\\t'
+                  f'{tax_id}\\tspecies\\t{10**6 + tax_id}\\t{count}\\t'
+                  f'{count if matches == 1 else 0}\\t{count / total:.4f}\\n')
+""".replace('NUM_TAXA', str(NUM_TAXA))
+
+# The taxonomy behind FAKE_CENTRIFUGE: species 1000 + n in genus 100 + n/5
+FAKE_CENTRIFUGE_INSPECT = """#!/usr/bin/env python3
+import sys
+if sys.argv[1] == '--taxonomy-tree':
+    print('1\\t|\\t1\\t|\\tno rank')
+    for n in range(NUM_TAXA):
+        print(f'{100 + n // 5}\\t|\\t1\\t|\\tgenus')
+        print(f'{1000 + n}\\t|\\t{100 + n // 5}\\t|\\tspecies')
+else:
+    print('1\\troot')
+    for n in range(NUM_TAXA):
+        print(f'{100 + n // 5}\\tGenus{n // 5}')
+        print(f'{1000 + n}\\tGenus{n // 5} species{1000 + n}')
+""".replace('NUM_TAXA', str(NUM_TAXA))
+
+# FAKE_SRA_SPOTS FASTA spots (mates for "*paired*" runs) after sleeping
+# FAKE_SRA_LATENCY seconds, to stdout (-Z) or "<acc>_N.fasta" in -O
+FAKE_FASTQ_DUMP = """#!/usr/bin/env python3
+import os, sys, time
+args = sys.argv[1:]
+time.sleep(float(os.environ.get('FAKE_SRA_LATENCY', 0)))
+acc = os.path.splitext(os.path.basename(args[-1]))[0]
+spots = 1 if '-X' in args else int(os.environ.get('FAKE_SRA_SPOTS', 1000))
+mates = [1, 2] if 'paired' in acc and '--split-files' in args else [1]
+seq = 'ACGT' * 25
+outs = ([sys.stdout] * len(mates) if '-Z' in args else [
+    open(os.path.join(args[args.index('-O') + 1], f'{acc}_{mate}.fasta'), 'w')
+    for mate in mates
+])
+# Spot by spot, the mates in turn, as fastq-dump writes them
+for i in range(spots):
+    for mate, out in zip(mates, outs):
+        out.write(f'>{acc}.{i}.{mate}\\n{seq}\\n')
+for out in outs:
+    out.flush()
+    if out is not sys.stdout:
+        out.close()
+"""
+
+
+# --------------------------------------------------
+def get_args() -> argparse.Namespace:
+    """Get command-line arguments"""
+
+    parser = argparse.ArgumentParser(
+        description='Benchmark the scripts',
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+
+    parser.add_argument('-b',
+                        '--bench',
+                        help='Benchmarks to run',
+                        metavar='str',
+                        type=str,
+                        nargs='+',
+                        choices=BENCHES,
+                        default=BENCHES)
+
+    parser.add_argument('-s',
+                        '--scale',
+                        help='Multiply the synthetic data sizes',
+                        metavar='float',
+                        type=float,
+                        default=1.)
+
+    parser.add_argument('-n',
+                        '--runs',
+                        help='Times to run each command',
+                        metavar='int',
+                        type=int,
+                        default=3)
+
+    parser.add_argument('-l',
+                        '--limit',
+                        help='Fail if a median startup exceeds this (ms)',
+                        metavar='float',
+                        type=float,
+                        default=100.)
+
+    parser.add_argument('-L',
+                        '--latency',
+                        help='Seconds each fake centrifuge call sleeps',
+                        metavar='float',
+                        type=float,
+                        default=0.)
+
+    parser.add_argument('-m',
+                        '--matches',
+                        help='Classifications per read from fake centrifuge',
+                        metavar='int',
+                        type=int,
+                        default=1)
+
+    parser.add_argument('-o',
+                        '--outfile',
+                        help='Write the results as JSON',
+                        metavar='str',
+                        type=str,
+                        default='bench.json')
+
+    parser.add_argument('-B',
+                        '--baseline',
+                        help='Earlier results (JSON) to compare against',
+                        metavar='str',
+                        type=str,
+                        default='')
+
+    parser.add_argument('-T',
+                        '--tolerance',
+                        help='Slowdown over the baseline that is a regression',
+                        metavar='float',
+                        type=float,
+                        default=.25)
+
+    parser.add_argument('-w',
+                        '--work_dir',
+                        help='Directory for the synthetic data (default temp)',
+                        metavar='str',
+                        type=str,
+                        default='')
+
+    args = parser.parse_args()
+
+    if args.baseline and not os.path.isfile(args.baseline):
+        parser.error(f'--baseline "{args.baseline}" is not a file')
+
+    return args
+
+
+# --------------------------------------------------
+def main() -> None:
+    """Make a jazz noise here"""
+
+    args = get_args()
+
+    with contextlib.ExitStack() as stack:
+        work_dir = args.work_dir or stack.enter_context(
+            tempfile.TemporaryDirectory())
+        os.makedirs(work_dir, exist_ok=True)
+        install_fakes(os.path.join(work_dir, 'bin'))
+        env = fake_env(work_dir, args.latency, args.matches)
+
+        results: Dict[str, float] = {}
+        for bench in args.bench:
+            print(f'Running {bench}', file=sys.stderr)
+            bench_dir = os.path.join(work_dir, bench)
+            os.makedirs(bench_dir, exist_ok=True)
+            results.update(BENCH_FUNCS[bench](bench_dir, args.scale,
+                                              args.runs, env))
+
+    report = {
+        'scale': args.scale,
+        'runs': args.runs,
+        'latency': args.latency,
+        'matches': args.matches,
+        'python': platform.python_version(),
+        'host': platform.node(),
+        'date': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'results': results
+    }
+    with open(args.outfile, 'wt') as out_fh:
+        json.dump(report, out_fh, indent=2)
+
+    baseline = {}
+    if args.baseline:
+        with open(args.baseline) as fh:
+            baseline = json.load(fh)['results']
+
+    regressions = compare(results, baseline, args.tolerance)
+    for name, secs in results.items():
+        old = baseline.get(name)
+        change = f'{secs / old - 1:+7.1%}' if old else ''
+        flag = 'REGRESSION' if name in regressions else ''
+        print(f'{name:45} {secs * 1000:10.1f} ms {change:>8} {flag}')
+
+    slow = [
+        name for name, secs in results.items()
+        if name.startswith('startup ') and secs * 1000 > args.limit
+    ]
+    if slow:
+        print(f'Slower than {args.limit} ms: {", ".join(slow)}')
+
+    print(f'Wrote "{args.outfile}"')
+    if regressions or slow:
+        sys.exit(1)
+
+
+# --------------------------------------------------
+def compare(results: Dict[str, float], baseline: Dict[str, float],
+            tolerance: float) -> List[str]:
+    """Benchmarks more than "tolerance" slower than in the baseline"""
+
+    return [
+        name for name, secs in results.items()
+        if baseline.get(name) and secs > baseline[name] * (1 + tolerance)
+    ]
+
+
+# --------------------------------------------------
+def install_fakes(bin_dir: str) -> None:
+    """Write the stand-in programs"""
+
+    os.makedirs(bin_dir, exist_ok=True)
+    for name, text in [('centrifuge', FAKE_CENTRIFUGE),
+                       ('centrifuge-inspect', FAKE_CENTRIFUGE_INSPECT),
+                       ('fastq-dump', FAKE_FASTQ_DUMP)]:
+        path = os.path.join(bin_dir, name)
+        with open(path, 'wt') as out_fh:
+            out_fh.write(text)
+        os.chmod(path, 0o755)
+
+
+# --------------------------------------------------
+def fake_env(work_dir: str, latency: float, matches: int) -> Dict[str, str]:
+    """Environment with the stand-ins first on the PATH"""
+
+    env = dict(os.environ)
+    env['PATH'] = os.path.join(work_dir, 'bin') + os.pathsep + env['PATH']
+    env['FAKE_CENTRIFUGE_LATENCY'] = str(latency)
+    env['FAKE_CENTRIFUGE_MATCHES'] = str(matches)
+    env['FAKE_SRA_LATENCY'] = str(latency)
+
+    return env
+
+
+# --------------------------------------------------
+def time_command(cmd: List[str],
+                 runs: int,
+                 cwd: str = '',
+                 env: Optional[Dict[str, str]] = None,
+                 clean: Optional[List[str]] = None) -> float:
+    """
+    Median wall seconds of running cmd, which must succeed, removing the
+    "clean" paths (untimed) before each run
+    """
+
+    times = []
+    for _ in range(max(1, runs)):
+        for path in clean or []:
+            shutil.rmtree(path, ignore_errors=True)
+
+        start = time.perf_counter()
+        subprocess.run(cmd,
+                       cwd=cwd or None,
+                       env=env,
+                       stdout=subprocess.DEVNULL,
+                       check=True)
+        times.append(time.perf_counter() - start)
+
+    return statistics.median(times)
+
+
+# --------------------------------------------------
+def time_call(func: Callable[[], object], runs: int) -> float:
+    """
+    Median wall seconds of calling func, ignoring what it prints, after
+    an untimed call to load modules and warm caches
+    """
+
+    times = []
+    with contextlib.redirect_stdout(io.StringIO()):
+        func()
+
+    for _ in range(max(1, runs)):
+        with contextlib.redirect_stdout(io.StringIO()):
+            start = time.perf_counter()
+            func()
+            times.append(time.perf_counter() - start)
+
+    return statistics.median(times)
+
+
+# --------------------------------------------------
+def script(name: str) -> List[str]:
+    """Command to run one of the scripts"""
+
+    return [sys.executable, os.path.join(CUR_DIR, name)]
+
+
+# --------------------------------------------------
+def write_reads(path: str, file_format: str, num_reads: int,
+                read_len: int = 100, seed: int = 0) -> None:
+    """Random FASTA/FASTQ reads, gzipped for a ".gz" path"""
+
+    rng = random.Random(seed)
+    pool = ''.join(rng.choice('ACGT') for _ in range(2**16))
+    qual = 'I' * read_len
+    name = os.path.basename(path).split('.')[0]
+
+    opener = gzip.open if path.endswith('.gz') else open
+    with opener(path, 'wt') as out_fh:
+        for num in range(num_reads):
+            start = rng.randrange(len(pool) - read_len)
+            seq = pool[start:start + read_len]
+            if file_format == 'fasta':
+                out_fh.write(f'>{name}.{num}\n{seq}\n')
+            else:
+                out_fh.write(f'@{name}.{num}\n{seq}\n+\n{qual}\n')
+
+
+# --------------------------------------------------
+def write_report(path: str, num_taxa: int, seed: int = 0) -> None:
+    """A Centrifuge .tsv report of species, genera and leaves"""
+
+    rng = random.Random(seed)
+    ranks = ['species', 'species', 'genus', 'leaf', 'subspecies', 'family']
+
+    with open(path, 'wt') as out_fh:
+        out_fh.write('name\ttaxID\ttaxRank\tgenomeSize\tnumReads\t'
+                     'numUniqueReads\tabundance\n')
+        for tax_id in rng.sample(range(1000, 1000 + 20 * num_taxa), num_taxa):
+            reads = rng.randrange(1, 10000)
+            out_fh.write(f'Genus{tax_id // 5} species{tax_id} str. '
+                         f'{tax_id % 7}\t{tax_id}\t{rng.choice(ranks)}\t'
+                         f'{10**6 + tax_id}\t{reads}\t{reads // 2}\t'
+                         f'{rng.random():.4f}\n')
+
+
+# --------------------------------------------------
+def write_sum(path: str, num_reads: int, seed: int = 0) -> None:
+    """A Centrifuge .sum file of one classification per read"""
+
+    rng = random.Random(seed)
+    with open(path, 'wt') as out_fh:
+        out_fh.write('readID\tseqID\ttaxID\tscore\t2ndBestScore\thitLength\t'
+                     'queryLength\tnumMatches\n')
+        for num in range(num_reads):
+            tax_id = rng.randrange(1000, 1000 + NUM_TAXA)
+            out_fh.write(f'r{num}\tseq{tax_id}\t{tax_id}\t100\t0\t50\t50\t1\n')
+
+
+# --------------------------------------------------
+def bench_startup(work_dir: str, scale: float, runs: int,
+                  env: Dict[str, str]) -> Dict[str, float]:
+    """
+    "--help", and run_centrifuge.py validating an index dir of 10,000
+    files and finding nothing to do
+    """
+
+    index_dir = os.path.join(work_dir, 'indexes')
+    if not os.path.isdir(index_dir):
+        os.makedirs(index_dir)
+        for num in range(10000):
+            open(os.path.join(index_dir, f'x{num}.1.cf'), 'w').close()
+        open(os.path.join(index_dir, 'p.1.cf'), 'w').close()
+    os.makedirs(os.path.join(work_dir, 'empty'), exist_ok=True)
+
+    runs = max(runs, 7)
+    return {
+        'startup python':
+        time_command([sys.executable, '-c', 'pass'], runs),
+        'startup run_centrifuge.py --help':
+        time_command(script('run_centrifuge.py') + ['--help'], runs),
+        'startup run_centrifuge.py (nothing to do)':
+        time_command(
+            script('run_centrifuge.py') +
+            ['-q', 'empty', '-I', index_dir, '-i', 'p', '-o', 'out'], runs,
+            work_dir),
+        'startup plot.py --help':
+        time_command(script('plot.py') + ['--help'], runs),
+        'startup collapse.py --help':
+        time_command(script('collapse.py') + ['--help'], runs),
+    }
+
+
+# --------------------------------------------------
+def bench_fasplit(work_dir: str, scale: float, runs: int,
+                  env: Dict[str, str]) -> Dict[str, float]:
+    """Splitting FASTA/FASTQ, plain and gzipped, by count and by size"""
+
+    num_reads = int(200000 * scale)
+    results = {}
+    for name, file_format, opts in [
+        ('reads.fa', 'fasta', ['-n', '10000']),
+        ('reads.fa.gz', 'fasta', ['-n', '10000']),
+        ('reads.fq', 'fastq', ['-n', '10000']),
+        ('reads.fq.gz', 'fastq', ['-n', '10000']),
+        ('reads.fa', 'fasta', ['-b', str(2**20)]),
+        ('reads.fa', 'fasta', ['-n', '10000', '-z']),
+    ]:
+        path = os.path.join(work_dir, name)
+        if not os.path.isfile(path):
+            write_reads(path, file_format, num_reads)
+
+        out_dir = os.path.join(work_dir, 'out')
+        results[f'fasplit {name} {" ".join(opts)}'] = time_command(
+            script('fasplit.py') +
+            ['-i', path, '-f', file_format, '-o', out_dir] + opts,
+            runs,
+            clean=[out_dir])
+
+    return results
+
+
+# --------------------------------------------------
+def bench_collapse(work_dir: str, scale: float, runs: int,
+                   env: Dict[str, str]) -> Dict[str, float]:
+    """Collapsing the reports of split FASTA files"""
+
+    num_samples, num_splits = 10, max(1, int(20 * scale))
+    fasta_dir = os.path.join(work_dir, 'fasta')
+    reports_dir = os.path.join(work_dir, 'reports')
+    if not os.path.isdir(reports_dir):
+        os.makedirs(fasta_dir)
+        os.makedirs(reports_dir)
+        for sample in range(num_samples):
+            open(os.path.join(fasta_dir, f's{sample}.fa'), 'w').close()
+            for split in range(1, num_splits + 1):
+                base = os.path.join(reports_dir, f's{sample}.{split}.fa')
+                seed = sample * num_splits + split
+                write_report(base + '.tsv', 200, seed)
+                write_sum(base + '.sum', 5000, seed)
+
+    out_dir = os.path.join(work_dir, 'out')
+    return {
+        f'collapse -p {procs}':
+        time_command(script('collapse.py') + [
+            '-f', fasta_dir, '-r', reports_dir, '-o', out_dir, '-p',
+            str(procs)
+        ],
+                     runs,
+                     clean=[out_dir])
+        for procs in sorted({1, os.cpu_count() or 1})
+    }
+
+
+# --------------------------------------------------
+def bench_unsplit(work_dir: str, scale: float, runs: int,
+                  env: Dict[str, str]) -> Dict[str, float]:
+    """Concatenating split FASTA files"""
+
+    parts_dir = os.path.join(work_dir, 'parts')
+    if not os.path.isdir(parts_dir):
+        os.makedirs(parts_dir)
+        for sample in range(10):
+            for part in range(1, max(1, int(20 * scale)) + 1):
+                write_reads(
+                    os.path.join(parts_dir, f's{sample}.{part}.fa'), 'fasta',
+                    2000, seed=sample * 100 + part)
+
+    out_dir = os.path.join(work_dir, 'out')
+    return {
+        'unsplit':
+        time_command(script('unsplit.py') + ['-d', parts_dir, '-o', out_dir],
+                     runs,
+                     clean=[out_dir])
+    }
+
+
+# --------------------------------------------------
+def bench_discover(work_dir: str, scale: float, runs: int,
+                   env: Dict[str, str]) -> Dict[str, float]:
+    """Finding input files in a deep tree, without and with a manifest"""
+
+    import input_manifest
+
+    query_dir = os.path.join(work_dir, 'query')
+    if not os.path.isdir(query_dir):
+        for num in range(int(20000 * scale)):
+            sub_dir = os.path.join(query_dir, f'd{num % 10}', f'd{num % 97}')
+            os.makedirs(sub_dir, exist_ok=True)
+            with open(os.path.join(sub_dir, f's{num}_1.fq'), 'wt') as fh:
+                fh.write('@r\nACGT\n+\nIIII\n')
+
+        # Old enough for their listings to be trusted
+        for root, _, _ in os.walk(query_dir):
+            os.utime(root, (time.time() - 60, time.time() - 60))
+
+    old = input_manifest.Manifest()
+    manifest = input_manifest.scan([query_dir], old)
+    return {
+        'discover':
+        time_call(lambda: input_manifest.scan([query_dir], old), runs),
+        'discover (manifest)':
+        time_call(lambda: input_manifest.scan([query_dir], manifest), runs),
+    }
+
+
+# --------------------------------------------------
+def bench_parse_files(work_dir: str, scale: float, runs: int,
+                      env: Dict[str, str]) -> Dict[str, float]:
+    """plot.parse_files on a cohort of reports, without and with caching"""
+
+    import plot
+
+    reports_dir = os.path.join(work_dir, 'reports')
+    num_samples = max(1, int(200 * scale))
+    if not os.path.isdir(reports_dir):
+        os.makedirs(reports_dir)
+        for sample in range(num_samples):
+            write_report(os.path.join(reports_dir, f's{sample}.tsv'), 500,
+                         sample)
+
+    paths = [
+        os.path.join(reports_dir, f's{sample}.tsv')
+        for sample in range(num_samples)
+    ]
+    cache_path = os.path.join(work_dir, 'bubble.cohort.parquet')
+
+    def parse(rank: str, cache: str = '') -> Callable[[], object]:
+        def run():
+            files = [open(path) for path in paths]
+            plot.parse_files(files, rank, [], 0., 1, cache)
+            for fh in files:
+                fh.close()
+
+        return run
+
+    results = {
+        f'parse_files --rank {rank}': time_call(parse(rank), runs)
+        for rank in ['species', 'genus']
+    }
+
+    if os.path.isfile(cache_path):
+        os.remove(cache_path)
+    with contextlib.redirect_stdout(io.StringIO()):
+        parse('species', cache_path)()
+    results['parse_files --rank species (cached)'] = time_call(
+        parse('species', cache_path), runs)
+
+    return results
+
+
+# --------------------------------------------------
+def bench_pipeline(work_dir: str, scale: float, runs: int,
+                   env: Dict[str, str]) -> Dict[str, float]:
+    """run_centrifuge.py from reads (paired, unpaired and SRA) to the plot"""
+
+    reads_dir = os.path.join(work_dir, 'reads')
+    index_dir = os.path.join(work_dir, 'index')
+    num_reads = int(20000 * scale)
+    if not os.path.isdir(reads_dir):
+        os.makedirs(reads_dir)
+        os.makedirs(index_dir)
+        with open(os.path.join(index_dir, 'bench.1.cf'), 'wb') as out_fh:
+            out_fh.write(b'\0' * 2**20)
+
+        for sample in range(8):
+            write_reads(os.path.join(reads_dir, f'u{sample}.fa.gz'), 'fasta',
+                        num_reads, seed=sample)
+        for sample in range(4):
+            for mate in [1, 2]:
+                write_reads(
+                    os.path.join(reads_dir, f'p{sample}_{mate}.fa.gz'),
+                    'fasta', num_reads, seed=100 + sample)
+        for name in ['single.sra', 'paired.sra']:
+            open(os.path.join(reads_dir, name), 'w').close()
+
+    sra_env = dict(env, FAKE_SRA_SPOTS=str(num_reads))
+    out_dir = os.path.join(work_dir, 'out')
+    cmd = script('run_centrifuge.py') + [
+        '-q', reads_dir, '-I', index_dir, '-i', 'bench', '-f', 'fasta', '-o',
+        out_dir
+    ]
+
+    # Both shards as background processes, then the merge
+    shard_cmds = [
+        ' '.join(map(shlex.quote, cmd + ['--shard', f'{i}/2']))
+        for i in [1, 2]
+    ]
+    sharded = ' & '.join(shard_cmds) + ' & wait && ' + ' '.join(
+        map(shlex.quote, cmd + ['--merge']))
+
+    return {
+        'run_centrifuge':
+        time_command(cmd, runs, work_dir, sra_env, [out_dir]),
+        'run_centrifuge --batch_size 4':
+        time_command(cmd + ['-b', '4'], runs, work_dir, sra_env, [out_dir]),
+        'run_centrifuge --stage_dir':
+        time_command(cmd + ['-L', os.path.join(work_dir, 'stage')], runs,
+                     work_dir, sra_env, [out_dir]),
+        'run_centrifuge --mmap':
+        time_command(cmd + ['--mmap'], runs, work_dir, sra_env, [out_dir]),
+        'run_centrifuge --shard 1/2 & 2/2, --merge':
+        time_command(['sh', '-c', sharded], runs, work_dir, sra_env,
+                     [out_dir]),
+    }
+
+
+BENCH_FUNCS = {
+    'startup': bench_startup,
+    'fasplit': bench_fasplit,
+    'collapse': bench_collapse,
+    'unsplit': bench_unsplit,
+    'discover': bench_discover,
+    'parse_files': bench_parse_files,
+    'pipeline': bench_pipeline,
+}
+
+# --------------------------------------------------
+if __name__ == '__main__':
+    main()
@@ -6,9 +6,16 @@
 
 import argparse
 import csv
+import gzip
 import os
 import re
+import shutil
 import sys
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
+import reports
+
+np = reports.lazy_import('numpy')
 
 # --------------------------------------------------
 def get_args():
@@ -23,6 +30,10 @@ def get_args():
     parser.add_argument('-o', '--out_dir', help='Output directory',
                         type=str, metavar='DIR', 
                         default=os.path.join(os.getcwd(), 'collapsed'))
+    parser.add_argument('-p', '--procs', help='Number of processes',
+                        type=int, metavar='NUM', default=os.cpu_count() or 1)
+    parser.add_argument('-z', '--compress', help='Gzip the .sum output',
+                        action='store_true')
     return parser.parse_args()
 
 # --------------------------------------------------
@@ -76,83 +87,188 @@ def main():
         print('Found no files in --reports_dir {}'.format(reports_dir))
         sys.exit(1)
 
+    index = index_splits(split_files, reports_dir)
+
+    jobs = []
     for i, fasta in enumerate(fasta_files):
         basename = os.path.basename(fasta)
         print('{:4}: {}'.format(i + 1, basename))
         basename, ext = os.path.splitext(os.path.basename(fasta))
-        splits = {'tsv': [], 'sum': []}
-        for split in split_files:
-            regex = r'({})\.(\d+)\.({})\.(tsv|sum)'.format(basename, ext[1:])
-            match = re.match(regex, split)
-            if not match is None:
-                _, num, _, type_ext = match.groups()
-                if type_ext in splits:
-                    # storing a tuple with the num first for sorting
-                    splits[type_ext].append((int(num), os.path.join(reports_dir, split)))
-
-        for file_type in splits:
+        splits = index.get((basename, ext[1:]), {})
+
+        for file_type in ['tsv', 'sum']:
             # sort on the fst of the tuple but take the snd
-            files = [a[1] for a in sorted(splits[file_type], key=lambda a: a[0])]
+            files = [a[1] for a in sorted(splits.get(file_type, []))]
 
             if len(files) < 1:
                 msg = 'WARNING: No files ending with "{}" for "{}"'
                 print(msg.format(file_type, basename))
             else:
                 out_path = os.path.join(out_dir, basename + '.' + file_type)
+                if file_type == 'sum' and args.compress:
+                    out_path += '.gz'
+
                 if os.path.isfile(out_path):
                     print('      "{}" exists, skipping'.format(out_path))
                 else:
-                    print('      Writing to "{}"'.format(out_path))
-                    func = write_tsv if file_type == 'tsv' else write_sum
-                    func(files, open(out_path, 'w'))
+                    jobs.append((file_type, files, out_path))
+
+    if args.procs > 1 and len(jobs) > 1:
+        with ProcessPoolExecutor(max_workers=args.procs) as pool:
+            for out_path in pool.map(collapse, *zip(*jobs)):
+                print('      Wrote "{}"'.format(out_path))
+    else:
+        # one base, so read its splits in parallel instead
+        for job in jobs:
+            print('      Wrote "{}"'.format(collapse(*job, args.procs)))
 
     print('Done, see output dir "{}"'.format(out_dir))
 
 # --------------------------------------------------
-def write_tsv(files, out_fh):
+def index_splits(split_files, reports_dir):
+    """
+    parse "<base>.<num>.<ext>.(tsv|sum)" names once into
+    {(base, ext): {type: [(num, path)]}}
+    """
+    split_re = re.compile(r'^(.+)\.(\d+)\.([^.]+)\.(tsv|sum)$')
+    index = defaultdict(lambda: defaultdict(list))
+    for split in split_files:
+        match = split_re.match(split)
+        if match:
+            base, num, ext, type_ext = match.groups()
+            index[(base, ext)][type_ext].append(
+                (int(num), os.path.join(reports_dir, split)))
+
+    return index
+
+# --------------------------------------------------
+def collapse(file_type, files, out_path, procs=1):
+    """collapse split files of one type into out_path"""
+    if file_type == 'tsv':
+        with open(out_path, 'w') as out_fh:
+            write_tsv(files, out_fh, procs)
+    else:
+        opener = gzip.open if out_path.endswith('.gz') else open
+        with opener(out_path, 'wb') as out_fh:
+            write_sum(files, out_fh)
+
+    return out_path
+
+# --------------------------------------------------
+def write_tsv(files, out_fh, procs=1):
     """collapse tsv files"""
-    tax = dict()
     num_flds = ['numReads', 'numUniqueReads']
 
     for fnum, file in enumerate(files):
         print('    {:4}: {}'.format(fnum + 1, os.path.basename(file)))
-        with open(file) as csvfile:
-            reader = csv.DictReader(csvfile, delimiter='\t')
-            for row in reader:
-                tax_id = row['taxID']
-                if not tax_id in tax:
-                    tax[tax_id] = dict()
-                    for fld in row.keys():
-                        tax[tax_id][fld] = int(row[fld]) if fld in num_flds else row[fld]
-                else:
-                    for fld in num_flds:
-                        tax[tax_id][fld] += int(row[fld])
+
+    matrix, info = reports.map_reduce(read_tsv, files, merge_tax, None, procs)
 
     # Write the headers
     flds = ['name', 'taxID', 'taxRank', 'genomeSize'] + num_flds + ['abundance']
     out_fh.write("\t".join(flds) + '\n')
 
-    total_reads = sum([tax[s]['numReads'] for s in tax])
+    if matrix is None:
+        return
+
+    counts = {fld: matrix.values[fld].tolist() for fld in num_flds}
+    total_reads = sum(counts['numReads'])
+    tax_ids = matrix.taxa[matrix.cols].tolist()
+
+    for i in sorted(range(len(tax_ids)), key=lambda i: int(tax_ids[i])):
+        name, tax_rank, genome_size = info[tax_ids[i]]
+        out_fh.write('\t'.join([
+            name, tax_ids[i], tax_rank, genome_size,
+            str(counts['numReads'][i]), str(counts['numUniqueReads'][i]),
+            str(round(counts['numReads'][i] / total_reads, 2))
+        ]) + '\n')
+
+# --------------------------------------------------
+def read_tsv(file):
+    """
+    read one report into a one-row matrix of read counts by taxID and
+    {tax_id: (name, taxRank, genomeSize)} as first seen
+    """
+    tax_ids, num_reads, num_unique, info = [], [], [], {}
+    with open(file) as csvfile:
+        reader = csv.DictReader(csvfile, delimiter='\t')
+        for row in reader:
+            tax_id = row['taxID']
+            tax_ids.append(tax_id)
+            num_reads.append(int(row['numReads']))
+            num_unique.append(int(row['numUniqueReads']))
+            if not tax_id in info:
+                info[tax_id] = (row['name'], row['taxRank'], row['genomeSize'])
+
+    matrix = reports.CohortMatrix.from_entries(
+        [''] * len(tax_ids), tax_ids,
+        numReads=np.array(num_reads, dtype=np.int64),
+        numUniqueReads=np.array(num_unique, dtype=np.int64))
+
+    return matrix, info
 
-    for tax_id in sorted(tax.keys(), key=int):
-        species = tax[tax_id]
+# --------------------------------------------------
+def merge_tax(partials):
+    """sum the read counts of reports read by read_tsv"""
+    info = {}
+    for _, partial_info in partials:
+        for tax_id, row in partial_info.items():
+            info.setdefault(tax_id, row)
 
-        species['abundance'] = round(species['numReads'] / total_reads, 2)
+    matrix = reports.CohortMatrix.concat([matrix for matrix, _ in partials])
 
-        out_fh.write('\t'.join([str(species[f]) for f in flds]) + '\n')
+    return matrix, info
 
 # --------------------------------------------------
 def write_sum(files, out_fh):
-    """collapse sum files"""
+    """collapse sum files into binary out_fh"""
     for fnum, file in enumerate(files):
         print('    {:4}: {}'.format(fnum + 1, os.path.basename(file)))
-        in_fh = open(file, 'r')
-        hdr = in_fh.readline()
-        if fnum == 0:
-            out_fh.write(hdr)
+        with open(file, 'rb') as in_fh:
+            hdr = in_fh.readline()
+            if fnum == 0:
+                out_fh.write(hdr)
+
+            copy_rest(in_fh, out_fh)
+
+# --------------------------------------------------
+def copy_rest(in_fh, out_fh):
+    """
+    copy the rest of in_fh to out_fh, in the kernel when both are plain
+    files (copy_file_range, then sendfile) or else in large blocks
+    """
+    offset = in_fh.tell()
+    remaining = os.fstat(in_fh.fileno()).st_size - offset
+
+    if isinstance(out_fh, gzip.GzipFile) or not hasattr(out_fh, 'fileno'):
+        in_fh.seek(offset)
+        shutil.copyfileobj(in_fh, out_fh, 2**24)
+        return
+
+    out_fh.flush()
+    in_fd, out_fd = in_fh.fileno(), out_fh.fileno()
+    for name in ['copy_file_range', 'sendfile']:
+        if not hasattr(os, name):
+            continue
+        try:
+            while remaining > 0:
+                if name == 'copy_file_range':
+                    sent = os.copy_file_range(in_fd, out_fd,
+                                              min(remaining, 2**30), offset)
+                else:
+                    sent = os.sendfile(out_fd, in_fd, offset,
+                                       min(remaining, 2**30))
+                if sent == 0:
+                    break
+                offset += sent
+                remaining -= sent
+            return
+        except OSError:
+            # e.g., EXDEV across filesystems; carry on from where we were
+            continue
 
-        for line in in_fh:
-            out_fh.write(line)
+    in_fh.seek(offset)
+    shutil.copyfileobj(in_fh, out_fh, 2**24)
 
 # --------------------------------------------------
 if __name__ == '__main__':
@@ -4,10 +4,18 @@
 # Author: Ken Youens-Clark <kyclark@email.arizona.edu>
 
 import argparse
+import bisect
+import functools
+import io
+import mmap
 import os
+import queue
+import re
 import sys
 import gzip
-from Bio import SeqIO
+import threading
+import zlib
+from concurrent.futures import ThreadPoolExecutor
 
 # --------------------------------------------------
 def get_args():
@@ -40,12 +48,50 @@ def get_args():
                         metavar='NUM',
                         default=100_000)
 
+    parser.add_argument('-b', '--bytes',
+                        help='Split on bytes per file instead of records',
+                        type=int,
+                        metavar='NUM',
+                        default=0)
+
+    parser.add_argument('-B', '--bases',
+                        help='Split on (approx.) bases per file instead',
+                        type=int,
+                        metavar='NUM',
+                        default=0)
+
+    parser.add_argument('-k', '--chunks',
+                        help='Split into this many files of equal size',
+                        type=int,
+                        metavar='NUM',
+                        default=0)
+
     parser.add_argument('-o', '--out_dir',
                         help='Output directory',
                         type=str,
                         metavar='DIR',
                         default='split-files')
 
+    parser.add_argument('-t', '--threads',
+                        help='Number of threads writing chunks',
+                        type=int,
+                        metavar='NUM',
+                        default=os.cpu_count() or 1)
+
+    parser.add_argument('-z', '--compress',
+                        help='Gzip the chunks',
+                        action='store_true')
+
+    parser.add_argument('-x', '--index',
+                        help='Only write an index of chunk offsets',
+                        action='store_true')
+
+    parser.add_argument('-s', '--slice',
+                        help='Write this chunk to STDOUT using the index',
+                        type=int,
+                        metavar='NUM',
+                        default=0)
+
     return parser.parse_args()
 
 # --------------------------------------------------
@@ -70,12 +116,32 @@ def main():
     if not os.path.isfile(infile):
         die('--infile "{}" is not valid'.format(infile))
 
+    index_path = os.path.join(out_dir, os.path.basename(infile) + '.idx')
+    if args.slice:
+        if not os.path.isfile(index_path):
+            die('No index "{}", run with --index first'.format(index_path))
+        write_slice(infile, read_index(index_path), args.slice,
+                    sys.stdout.buffer)
+        return
+
     if not os.path.isdir(out_dir):
         os.mkdir(out_dir)
 
     if max_per < 1:
         die("--num cannot be less than one")
 
+    if args.threads < 1:
+        die("--threads cannot be less than one")
+
+    if min(args.bytes, args.bases, args.chunks) < 0:
+        die("--bytes, --bases and --chunks cannot be negative")
+
+    if sum(map(bool, [args.bytes, args.bases, args.chunks])) > 1:
+        die("Choose only one of --bytes, --bases or --chunks")
+
+    if args.index and (args.bytes or args.bases or args.chunks):
+        die("--index splits by --num, not --bytes, --bases or --chunks")
+
     valid_format = set(['fasta', 'fastq'])
     if not input_format in valid_format:
         die('--input_format ({}) must be in {}'.format(input_format,
@@ -88,18 +154,508 @@ def main():
         die('--output_format ({}) must be in {}'.format(output_format,
                                                         ', '.join(valid_format)))
 
-    i = 0
-    nseq = 0
-    nfile = 0
     basename, ext = os.path.splitext(os.path.basename(infile))
 
+    if args.index:
+        entries = build_index(infile, input_format, max_per)
+        write_index(entries, index_path)
+        print('Done, indexed {} chunk{} in "{}"'.format(
+            len(entries), '' if len(entries) == 1 else 's', index_path))
+        return
+
     handle = None
     if ext == ".gz":
-        handle = gzip.open(infile, "rt")
+        handle = gzip.open(infile, "rb")
         basename, ext = os.path.splitext(basename)
     else:
-        handle = open(infile, "rt")
+        handle = open(infile, "rb")
+
+    out_path = lambda n: os.path.join(
+        out_dir, basename + '.' + str(n) + ext + ('.gz' if args.compress else ''))
 
+    chunk_end = None
+    if args.bytes:
+        chunk_end = lambda n, start: start + args.bytes
+    elif args.bases:
+        max_bytes = round(args.bases * bytes_per_base(infile, input_format))
+        chunk_end = lambda n, start: start + max(1, max_bytes)
+    elif args.chunks:
+        total = data_size(infile)
+        chunk_end = lambda n, start: -(-n * total // args.chunks)
+
+    if chunk_end and output_format != input_format:
+        die("--bytes, --bases and --chunks cannot be used to convert formats")
+
+    if output_format == input_format:
+        nseq, nfile = split_parallel(handle, input_format, max_per, out_path,
+                                     args.threads, args.compress, chunk_end)
+    else:
+        nseq, nfile = split_seqio(io.TextIOWrapper(handle), input_format,
+                                  output_format, max_per, out_path,
+                                  args.compress)
+
+    handle.close()
+
+    print('Done, wrote {} sequence{} to {} file{} in "{}"'.format(
+        nseq, '' if nseq == 1 else 's',
+        nfile, '' if nfile == 1 else 's',
+        out_dir))
+
+# --------------------------------------------------
+def read_blocks(handle, block_size=2**24):
+    """read binary blocks that each end on a line boundary"""
+    carry = b''
+    while True:
+        block = handle.read(block_size)
+        if not block:
+            break
+
+        cut = block.rfind(b'\n') + 1
+        if cut == 0:
+            carry += block
+            continue
+
+        yield carry + block[:cut]
+        carry = block[cut:]
+
+    if carry:
+        yield carry
+
+# --------------------------------------------------
+def prefetch(items, depth=4):
+    """produce items in a background thread, up to depth ahead"""
+    buf = queue.Queue(maxsize=depth)
+    done = object()
+
+    def produce():
+        try:
+            for item in items:
+                buf.put(item)
+        except Exception as err:
+            buf.put(err)
+        buf.put(done)
+
+    threading.Thread(target=produce, daemon=True).start()
+    for item in iter(buf.get, done):
+        if isinstance(item, Exception):
+            raise item
+        yield item
+
+# --------------------------------------------------
+def split_raw(handle, input_format, max_per, open_chunk, block_size=2**24,
+              read_ahead=0):
+    """
+    split by copying byte ranges, finding record boundaries without
+    parsing records: ">" at a line start for FASTA, every four lines
+    for FASTQ; open_chunk(n) returns the binary file for chunk n.
+    With read_ahead, blocks are read (decompressed) in another thread.
+    """
+    # FASTA counts record starts, FASTQ counts lines; "remaining" is how
+    # many more the current file takes before the next one is opened
+    fasta = input_format == 'fasta'
+    remaining = 0
+    nunits = 0
+    nfile = 0
+    out_fh = None
+
+    blocks = read_blocks(handle, block_size)
+    if read_ahead:
+        blocks = prefetch(blocks, read_ahead)
+
+    for block in blocks:
+        # walk the block by offset, writing views of it, so each cut costs
+        # only the scan up to it rather than a copy of the rest
+        view = memoryview(block)
+        pos = 0
+        if fasta:
+            left = block.count(b'\n>') + block.startswith(b'>')
+        else:
+            left = block.count(b'\n')
+
+        while pos < len(block):
+            starts_rec = block.startswith(b'>', pos)
+            if remaining == 0 and (starts_rec or not fasta or out_fh is None):
+                if out_fh is not None:
+                    out_fh.close()
+                nfile += 1
+                out_fh = open_chunk(nfile)
+                remaining = max_per if fasta else 4 * max_per
+
+            if left <= remaining:
+                out_fh.write(view[pos:])
+                remaining -= left
+                nunits += left
+                break
+
+            # cut just before the first unit that belongs in the next file
+            if fasta:
+                i = pos - 1
+                for _ in range(remaining + 1 - starts_rec):
+                    i = block.find(b'\n>', i + 1)
+                cut = i + 1
+            else:
+                cut = lines_pattern(remaining).match(block, pos).end()
+
+            out_fh.write(view[pos:cut])
+            nunits += remaining
+            left -= remaining
+            remaining = 0
+            pos = cut
+
+    if out_fh is not None:
+        out_fh.close()
+
+    return (nunits if fasta else -(-nunits // 4)), nfile
+
+# --------------------------------------------------
+@functools.lru_cache(maxsize=None)
+def lines_pattern(num):
+    """regex matching num whole lines"""
+    return re.compile(b'(?:[^\\n]*\\n){%d}' % num)
+
+# --------------------------------------------------
+def next_boundary(block, pos, fasta, phase):
+    """
+    position of the first record start at or after pos in a block that
+    starts on a line boundary "phase" lines into a FASTQ record
+    """
+    if pos <= 0 and (block.startswith(b'>') if fasta else phase == 0):
+        return 0
+
+    if fasta:
+        i = block.find(b'\n>', max(pos, 1) - 1)
+        return i + 1 if i >= 0 else None
+
+    # line k starts after the k-th newline; records start where the
+    # line number (counting the phase) is a multiple of four
+    pos = max(pos, 1)
+    k = block.count(b'\n', 0, pos - 1) + 1
+    i = block.find(b'\n', pos - 1)
+    for _ in range((-(phase + k)) % 4):
+        if i < 0:
+            break
+        i = block.find(b'\n', i + 1)
+
+    return i + 1 if i >= 0 else None
+
+# --------------------------------------------------
+def split_sized(handle, input_format, chunk_end, open_chunk,
+                block_size=2**24, read_ahead=0):
+    """
+    split like split_raw but by size: chunk n starting at byte offset
+    "start" ends at the first record boundary at or after
+    chunk_end(n, start), or after one record if that is no further
+    than the start, so no chunk is empty
+    """
+    fasta = input_format == 'fasta'
+    phase = 0
+    offset = 0
+    nunits = 0
+    nfile = 0
+    out_fh = None
+    end = 0
+
+    blocks = read_blocks(handle, block_size)
+    if read_ahead:
+        blocks = prefetch(blocks, read_ahead)
+
+    for block in blocks:
+        if fasta:
+            nunits += block.count(b'\n>') + block.startswith(b'>')
+        else:
+            nunits += block.count(b'\n')
+
+        while block:
+            if out_fh is None:
+                nfile += 1
+                out_fh = open_chunk(nfile)
+                end = max(chunk_end(nfile, offset), offset + 1)
+
+            cut = None
+            if offset + len(block) > end:
+                cut = next_boundary(block, end - offset, fasta, phase)
+
+            if cut is None:
+                out_fh.write(block)
+                offset += len(block)
+                phase = (phase + block.count(b'\n')) % 4
+                break
+
+            out_fh.write(block[:cut])
+            out_fh.close()
+            out_fh = None
+            offset += cut
+            phase = 0
+            block = block[cut:]
+
+    if out_fh is not None:
+        out_fh.close()
+
+    return (nunits if fasta else -(-nunits // 4)), nfile
+
+# --------------------------------------------------
+def data_size(infile):
+    """bytes of (uncompressed) data in infile"""
+    if not infile.endswith('.gz'):
+        return os.path.getsize(infile)
+
+    total = 0
+    with gzip.open(infile, 'rb') as fh:
+        for block in iter(lambda: fh.read(2**24), b''):
+            total += len(block)
+
+    return total
+
+# --------------------------------------------------
+def bytes_per_base(infile, input_format, sample_size=2**20):
+    """estimate bytes of input per sequence base from the head of infile"""
+    opener = gzip.open if infile.endswith('.gz') else open
+    with opener(infile, 'rb') as fh:
+        head = fh.read(sample_size)
+
+    if len(head) == sample_size:
+        head = head[:head.rfind(b'\n') + 1]
+
+    lines = head.splitlines()
+    if input_format == 'fasta':
+        bases = sum(len(line) for line in lines if not line.startswith(b'>'))
+    else:
+        bases = sum(len(line) for line in lines[1::4])
+
+    return len(head) / bases if bases else 1.
+
+# --------------------------------------------------
+class ChunkWriter:
+    """
+    hand a chunk's data to a worker thread that writes (and compresses) it,
+    taking one of "slots" until it is done so only so many chunks (each
+    up to four blocks) are in memory at once
+    """
+    def __init__(self, path, compress, pool, slots):
+        self.queue = queue.Queue(maxsize=4)
+        wait_for(lambda: slots.acquire(timeout=.1), None)
+        self.future = pool.submit(drain_chunk, self.queue, path, compress,
+                                  slots)
+
+    def write(self, data):
+        if self.future.done():
+            self.future.result()
+        wait_for(lambda: put_or_full(self.queue, data), self.future)
+
+    def close(self):
+        wait_for(lambda: put_or_full(self.queue, None), self.future)
+
+# --------------------------------------------------
+def put_or_full(chunk_queue, data):
+    """put data on the queue, waiting briefly, and say whether it fit"""
+    try:
+        chunk_queue.put(data, timeout=.1)
+        return True
+    except queue.Full:
+        return False
+
+# --------------------------------------------------
+def wait_for(attempt, future):
+    """
+    retry attempt() until it succeeds, raising the error of the writer
+    future if it stops (it would never make room)
+    """
+    while not attempt():
+        if future is not None and future.done():
+            future.result()
+            raise Exception('chunk writer stopped early')
+
+# --------------------------------------------------
+def drain_chunk(chunk_queue, path, compress, slots):
+    """write queued data to path until None arrives"""
+    try:
+        if compress:
+            out_fh = gzip.open(path, 'wb', compresslevel=6)
+        else:
+            out_fh = open(path, 'wb', buffering=2**22)
+
+        with out_fh:
+            for data in iter(chunk_queue.get, None):
+                out_fh.write(data)
+    finally:
+        slots.release()
+
+# --------------------------------------------------
+def split_parallel(handle, input_format, max_per, out_path, threads=1,
+                   compress=False, chunk_end=None):
+    """
+    split_raw with one thread reading and finding boundaries and a pool of
+    threads each writing a chunk, so decompression, boundary detection and
+    (compressed) writes overlap; zlib and file I/O release the GIL.
+    Given chunk_end, chunks are cut by size (see split_sized).
+    """
+    writers = []
+    slots = threading.Semaphore(threads)
+    with ThreadPoolExecutor(max_workers=threads) as pool:
+        def open_chunk(n):
+            writers.append(ChunkWriter(out_path(n), compress, pool, slots))
+            return writers[-1]
+
+        read_ahead = 4 if threads > 1 else 0
+        try:
+            if chunk_end:
+                result = split_sized(handle, input_format, chunk_end,
+                                     open_chunk, read_ahead=read_ahead)
+            else:
+                result = split_raw(handle, input_format, max_per, open_chunk,
+                                   read_ahead=read_ahead)
+        except BaseException:
+            # let the worker for the unfinished chunk stop
+            if writers:
+                try:
+                    writers[-1].close()
+                except Exception:
+                    pass
+            raise
+
+        for writer in writers:
+            writer.future.result()
+
+    return result
+
+# --------------------------------------------------
+class ChunkSpan:
+    """stands in for a chunk file, noting where the chunk lies in the input"""
+    def __init__(self, start):
+        self.start = start
+        self.end = start
+
+    def write(self, data):
+        self.end += len(data)
+
+    def close(self):
+        pass
+
+# --------------------------------------------------
+class MemberReader:
+    """
+    decompress a (multi-member, e.g. BGZF) gzip file, noting the compressed
+    and uncompressed offsets where each member starts
+    """
+    def __init__(self, handle):
+        self.handle = handle
+        self.members = []
+        self.consumed = 0
+        self.uoffset = 0
+        self.decomp = None
+        self.buf = b''
+
+    def read(self, size=-1):
+        out = []
+        total = 0
+        while size < 0 or total < size:
+            if self.decomp is None or self.decomp.eof:
+                self.buf = self.decomp.unused_data if self.decomp else b''
+                if not self.buf:
+                    self.buf = self.handle.read(2**20)
+                    self.consumed += len(self.buf)
+                    if not self.buf:
+                        break
+                self.members.append((self.consumed - len(self.buf),
+                                     self.uoffset))
+                self.decomp = zlib.decompressobj(zlib.MAX_WBITS | 16)
+            elif not self.buf:
+                self.buf = self.handle.read(2**20)
+                self.consumed += len(self.buf)
+                if not self.buf:
+                    break
+
+            data = self.decomp.decompress(self.buf)
+            self.buf = b''
+            self.uoffset += len(data)
+            total += len(data)
+            out.append(data)
+
+        return b''.join(out)
+
+# --------------------------------------------------
+def build_index(infile, input_format, max_per):
+    """
+    find each chunk's (start, end, records, member_offset, member_skip):
+    byte offsets in the (uncompressed) data and, for gzip, the compressed
+    offset of the member holding the start and how far into it that is
+    """
+    spans = []
+    def open_chunk(_):
+        spans.append(ChunkSpan(spans[-1].end if spans else 0))
+        return spans[-1]
+
+    members = [(0, 0)]
+    with open(infile, 'rb') as fh:
+        if infile.endswith('.gz'):
+            reader = MemberReader(fh)
+            nseq, _ = split_raw(reader, input_format, max_per, open_chunk)
+            members = reader.members or members
+        elif os.path.getsize(infile) == 0:
+            nseq = 0
+        else:
+            with mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                nseq, _ = split_raw(mm, input_format, max_per, open_chunk)
+
+    ustarts = [ustart for _, ustart in members]
+    entries = []
+    for i, span in enumerate(spans):
+        coffset, ustart = members[bisect.bisect_right(ustarts, span.start) - 1]
+        nrec = max_per if i < len(spans) - 1 else nseq - max_per * i
+        entries.append((span.start, span.end, nrec, coffset,
+                        span.start - ustart))
+
+    return entries
+
+# --------------------------------------------------
+def write_index(entries, path):
+    """write chunk offsets as tab-delimited text"""
+    with open(path, 'wt') as out_fh:
+        out_fh.write('\t'.join(['chunk', 'start', 'end', 'records',
+                                'member_offset', 'member_skip']) + '\n')
+        for i, entry in enumerate(entries, start=1):
+            out_fh.write('\t'.join(map(str, (i,) + tuple(entry))) + '\n')
+
+# --------------------------------------------------
+def read_index(path):
+    """read chunk offsets written by write_index"""
+    with open(path) as fh:
+        fh.readline()
+        return [tuple(map(int, line.split('\t')[1:])) for line in fh]
+
+# --------------------------------------------------
+def write_slice(infile, entries, num, out_fh):
+    """copy chunk num (1-based) of infile to out_fh"""
+    if not 1 <= num <= len(entries):
+        die('--slice {} is not in 1-{}'.format(num, len(entries)))
+
+    start, end, _, member_offset, member_skip = entries[num - 1]
+    with open(infile, 'rb') as fh:
+        if infile.endswith('.gz'):
+            fh.seek(member_offset)
+            handle = gzip.GzipFile(fileobj=fh)
+            handle.seek(member_skip)
+            remaining = end - start
+            while remaining > 0:
+                data = handle.read(min(remaining, 2**22))
+                if not data:
+                    break
+                out_fh.write(data)
+                remaining -= len(data)
+        else:
+            with mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                for pos in range(start, end, 2**22):
+                    out_fh.write(mm[pos:min(end, pos + 2**22)])
+
+# --------------------------------------------------
+def split_seqio(handle, input_format, output_format, max_per, out_path,
+                compress=False):
+    """split while converting formats through Bio.SeqIO"""
+    from Bio import SeqIO
+
+    i = 0
+    nseq = 0
+    nfile = 0
     out_fh = None
     for record in SeqIO.parse(handle, input_format):
         if i == max_per:
@@ -112,18 +668,15 @@ def main():
         nseq += 1
         if out_fh is None:
             nfile += 1
-            path = os.path.join(out_dir, basename + '.' + str(nfile) + ext)
-            out_fh = open(path, 'wt')
+            out_fh = gzip.open(out_path(nfile), 'wt') if compress else open(
+                out_path(nfile), 'wt')
 
         SeqIO.write(record, out_fh, output_format)
 
     if out_fh is not None:
         out_fh.close()
 
-    print('Done, wrote {} sequence{} to {} file{} in "{}"'.format(
-        nseq, '' if nseq == 1 else 's',
-        nfile, '' if nfile == 1 else 's',
-        out_dir))
+    return nseq, nfile
 
 # --------------------------------------------------
 if __name__ == '__main__':
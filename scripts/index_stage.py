@@ -0,0 +1,259 @@
+"""Node-local copies of a Centrifuge index shared by one user's runs"""
+
+import fcntl
+import hashlib
+import logging
+import os
+import shutil
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from typing import Dict, Iterator, List, Tuple
+
+import report_cache
+
+LOCK_FILE = '.lock'
+MANIFEST_FILE = '.manifest'
+REFS_FILE = '.refs'
+
+# Leave room on a full disk (or /dev/shm) for everything else
+FREE_MARGIN = .95
+
+
+# --------------------------------------------------
+def source_key(index: str, files: List[str]) -> str:
+    """Entry name for an index: its name plus its files' sizes and mtimes"""
+
+    digest = hashlib.blake2b(digest_size=8)
+    for file in files:
+        stat = os.stat(file)
+        digest.update('{}:{}:{}\n'.format(os.path.basename(file),
+                                          stat.st_size,
+                                          stat.st_mtime_ns).encode())
+
+    return f'{index}-{digest.hexdigest()}'
+
+
+# --------------------------------------------------
+@contextmanager
+def locked(stage_dir: str) -> Iterator[None]:
+    """Hold the stage directory's lock, shared by all runs on the node"""
+
+    with open(os.path.join(stage_dir, LOCK_FILE), 'a') as fh:
+        fcntl.flock(fh, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(fh, fcntl.LOCK_UN)
+
+
+# --------------------------------------------------
+def copy_file(src: str, dest: str, block_size: int = 2**24) -> str:
+    """
+    Copy a file, keeping its mtime, and return the BLAKE2 digest of the
+    bytes read from the source
+    """
+
+    digest = hashlib.blake2b(digest_size=20)
+    with open(src, 'rb') as in_fh, open(dest, 'wb') as out_fh:
+        for block in iter(lambda: in_fh.read(block_size), b''):
+            digest.update(block)
+            out_fh.write(block)
+
+    stat = os.stat(src)
+    os.utime(dest, ns=(stat.st_atime_ns, stat.st_mtime_ns))
+
+    return digest.hexdigest()
+
+
+# --------------------------------------------------
+def read_manifest(entry: str) -> Dict[str, Tuple[int, str]]:
+    """{file name: (size, digest)} of a complete entry, else empty"""
+
+    manifest = {}
+    try:
+        with open(os.path.join(entry, MANIFEST_FILE)) as fh:
+            for line in fh:
+                name, size, digest = line.rstrip('\n').split('\t')
+                manifest[name] = (int(size), digest)
+    except (OSError, ValueError):
+        return {}
+
+    return manifest
+
+
+# --------------------------------------------------
+def is_complete(entry: str, files: List[str]) -> bool:
+    """Whether an entry holds all the files at the sizes it recorded"""
+
+    manifest = read_manifest(entry)
+    if sorted(manifest) != sorted(map(os.path.basename, files)):
+        return False
+
+    for name, (size, _) in manifest.items():
+        path = os.path.join(entry, name)
+        if not os.path.isfile(path) or os.path.getsize(path) != size:
+            return False
+
+    return True
+
+
+# --------------------------------------------------
+def copy_index(files: List[str], entry: str) -> None:
+    """
+    Copy the index files in parallel into a temporary directory, check
+    each copy's size and re-read digest against the source, and rename
+    it into place as entry
+    """
+
+    tmp_dir = tempfile.mkdtemp(dir=os.path.dirname(entry), prefix='.tmp-')
+    try:
+        dests = [os.path.join(tmp_dir, os.path.basename(f)) for f in files]
+        with ThreadPoolExecutor(max_workers=len(files) or 1) as pool:
+            digests = list(pool.map(copy_file, files, dests))
+            copied = list(pool.map(report_cache.file_digest, dests))
+
+        with open(os.path.join(tmp_dir, MANIFEST_FILE), 'wt') as fh:
+            for src, dest, digest, copy_digest in zip(files, dests, digests,
+                                                      copied):
+                size = os.path.getsize(src)
+                if os.path.getsize(dest) != size or copy_digest != digest:
+                    raise Exception(f'Copy of "{src}" does not match')
+                fh.write(f'{os.path.basename(src)}\t{size}\t{digest}\n')
+
+        os.rename(tmp_dir, entry)
+    except BaseException:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        raise
+
+
+# --------------------------------------------------
+def pid_alive(pid: int) -> bool:
+    """Whether a process is still running on this node"""
+
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+
+    return True
+
+
+# --------------------------------------------------
+def live_refs(entry: str) -> List[int]:
+    """PIDs using an entry, less those that died without releasing it"""
+
+    try:
+        with open(os.path.join(entry, REFS_FILE)) as fh:
+            pids = [int(line) for line in fh if line.strip().isdigit()]
+    except OSError:
+        return []
+
+    return [pid for pid in pids if pid_alive(pid)]
+
+
+# --------------------------------------------------
+def write_refs(entry: str, pids: List[int]) -> None:
+    """Replace an entry's reference count file"""
+
+    path = os.path.join(entry, REFS_FILE)
+    with open(path + '.tmp', 'wt') as fh:
+        fh.write(''.join(f'{pid}\n' for pid in pids))
+    os.replace(path + '.tmp', path)
+
+
+# --------------------------------------------------
+def entry_size(entry: str) -> int:
+    """Bytes of an entry's files"""
+
+    return sum(f.stat().st_size for f in os.scandir(entry) if f.is_file())
+
+
+# --------------------------------------------------
+def make_room(stage_dir: str, needed: int, max_bytes: int = 0) -> bool:
+    """
+    Remove unused entries, least-recently used first, until needed bytes
+    fit within max_bytes of entries (or the free space, if 0). Return
+    whether they fit.
+    """
+
+    if max_bytes and needed > max_bytes:
+        return False
+
+    entries = [(entry.stat().st_mtime, entry.path)
+               for entry in os.scandir(stage_dir)
+               if entry.is_dir() and not entry.name.startswith('.')]
+
+    def fits() -> bool:
+        if max_bytes:
+            used = sum(entry_size(path) for _, path in entries)
+            return used + needed <= max_bytes
+        return needed <= shutil.disk_usage(stage_dir).free * FREE_MARGIN
+
+    for entry in sorted(entries):
+        if fits():
+            return True
+        if not live_refs(entry[1]):
+            logging.debug('Evicting staged index "%s"', entry[1])
+            shutil.rmtree(entry[1], ignore_errors=True)
+            entries.remove(entry)
+
+    return fits()
+
+
+# --------------------------------------------------
+def acquire(index: str, files: List[str], stage_dir: str,
+            max_bytes: int = 0) -> str:
+    """
+    Directory of a verified copy of the index files in this user's part
+    of stage_dir, copied there by the first of their runs to need it,
+    with this process added to its users. Each user has their own part
+    (holding its lock and entries), as one user's files cannot be
+    shared safely with another's runs. Return '' if it cannot fit
+    within max_bytes (0 for the free space), in which case the shared
+    index should be used.
+    """
+
+    stage_dir = os.path.join(stage_dir, str(os.getuid()))
+    os.makedirs(stage_dir, exist_ok=True)
+    entry = os.path.join(stage_dir, source_key(index, files))
+
+    with locked(stage_dir):
+        # Copies are only made under the lock, so any others are left over
+        for tmp in os.scandir(stage_dir):
+            if tmp.name.startswith('.tmp-') and tmp.is_dir():
+                shutil.rmtree(tmp.path, ignore_errors=True)
+
+        if not is_complete(entry, files):
+            shutil.rmtree(entry, ignore_errors=True)
+            if not make_room(stage_dir, sum(map(os.path.getsize, files)),
+                             max_bytes):
+                logging.debug('No room to stage "%s" in "%s"', index,
+                              stage_dir)
+                return ''
+
+            logging.debug('Staging "%s" in "%s"', index, entry)
+            copy_index(files, entry)
+
+        write_refs(entry, live_refs(entry) + [os.getpid()])
+
+        # The entry's mtime records its last use for eviction
+        now = time.time()
+        os.utime(entry, (now, now))
+
+    return entry
+
+
+# --------------------------------------------------
+def release(entry: str) -> None:
+    """Remove this process from the users of a staged index"""
+
+    with locked(os.path.dirname(entry)):
+        if os.path.isdir(entry):
+            pids = live_refs(entry)
+            if os.getpid() in pids:
+                pids.remove(os.getpid())
+            write_refs(entry, pids)
@@ -0,0 +1,202 @@
+"""Parallel discovery of input files, cached in a manifest between runs"""
+
+import gzip
+import json
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import asdict, dataclass, field
+from typing import Dict, List, Optional, Tuple
+
+# Directories changed this recently may change again within their mtime's
+# resolution (a second on some filesystems), so are always listed again
+MTIME_SLACK_NS = 2 * 10**9
+
+SNIFF_BYTES = 64
+
+
+# --------------------------------------------------
+@dataclass
+class InputFile:
+    """One input file, its content's format and its paired mate (if any)"""
+
+    path: str
+    size: int
+    mtime_ns: int
+    format: str
+    gzip: bool
+    mate: str = ''
+
+
+# --------------------------------------------------
+@dataclass
+class Listing:
+    """Names in a directory as of its mtime (None if it must be relisted)"""
+
+    mtime_ns: Optional[int]
+    files: List[str]
+    dirs: List[str]
+
+
+# --------------------------------------------------
+@dataclass
+class Manifest:
+    """Input files and the directory listings they were found in"""
+
+    files: Dict[str, InputFile] = field(default_factory=dict)
+    dirs: Dict[str, Listing] = field(default_factory=dict)
+
+    # --------------------------------------------------
+    @classmethod
+    def load(cls, path: str) -> 'Manifest':
+        """Read a saved manifest, or an empty one if there is none"""
+
+        try:
+            with open(path) as fh:
+                data = json.load(fh)
+            return cls(
+                {rec['path']: InputFile(**rec)
+                 for rec in data['files']},
+                {name: Listing(**rec)
+                 for name, rec in data['dirs'].items()})
+        except (OSError, ValueError, KeyError, TypeError):
+            return cls()
+
+    # --------------------------------------------------
+    def save(self, path: str) -> None:
+        """Write atomically as JSON"""
+
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'wt') as fh:
+            json.dump(
+                {
+                    'files': [asdict(rec) for rec in self.files.values()],
+                    'dirs':
+                    {name: asdict(rec)
+                     for name, rec in self.dirs.items()}
+                }, fh)
+        os.replace(tmp_path, path)
+
+    # --------------------------------------------------
+    def paths(self) -> List[str]:
+        """All the input files, sorted"""
+
+        return sorted(self.files)
+
+    # --------------------------------------------------
+    def set_mates(self, forward: List[str], reverse: List[str]) -> None:
+        """Record which files were paired"""
+
+        for rec in self.files.values():
+            rec.mate = ''
+        for fwd, rev in zip(forward, reverse):
+            self.files[fwd].mate = rev
+            self.files[rev].mate = fwd
+
+
+# --------------------------------------------------
+def sniff(path: str) -> Tuple[str, bool]:
+    """
+    Format from the first bytes (fasta, fastq, sra or '' if unknown) and
+    whether the file is gzipped
+    """
+
+    try:
+        with open(path, 'rb') as fh:
+            head = fh.read(SNIFF_BYTES)
+        is_gzip = head[:2] == b'\x1f\x8b'
+        if is_gzip:
+            with gzip.open(path) as fh:
+                head = fh.read(SNIFF_BYTES)
+    except (OSError, EOFError):
+        return '', False
+
+    head = head.lstrip()
+    fmt = ('fasta' if head.startswith(b'>') else
+           'fastq' if head.startswith(b'@') else
+           'sra' if head.startswith(b'NCBI.sra') else '')
+
+    return fmt, is_gzip
+
+
+# --------------------------------------------------
+def list_dir(path: str, old: Optional[Listing], now_ns: int) -> Listing:
+    """
+    A directory's listing, reusing the old one if the directory has not
+    changed since. Links to directories are skipped, like os.walk.
+    """
+
+    files: List[str] = []
+    dirs: List[str] = []
+    try:
+        mtime_ns = os.stat(path).st_mtime_ns
+        if old and old.mtime_ns == mtime_ns:
+            return old
+
+        for entry in os.scandir(path):
+            if entry.is_dir():
+                if not entry.is_symlink():
+                    dirs.append(entry.name)
+            else:
+                files.append(entry.name)
+    except OSError:
+        # Unreadable, like os.walk
+        return Listing(None, [], [])
+
+    stable = mtime_ns < now_ns - MTIME_SLACK_NS
+    return Listing(mtime_ns if stable else None, files, dirs)
+
+
+# --------------------------------------------------
+def stat_file(path: str, old: Optional[InputFile]) -> Optional[InputFile]:
+    """A file's record, only sniffing its contents if it changed"""
+
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+
+    if old and (old.size, old.mtime_ns) == (stat.st_size, stat.st_mtime_ns):
+        return old
+
+    fmt, is_gzip = sniff(path)
+    return InputFile(path, stat.st_size, stat.st_mtime_ns, fmt, is_gzip)
+
+
+# --------------------------------------------------
+def scan(query: List[str], old: Manifest, workers: int = 0) -> Manifest:
+    """
+    Find the files under each query file/directory, listing directories
+    level by level in parallel. A directory whose mtime is unchanged
+    since the old manifest is not listed again, but its files are still
+    stat'ed, and only those whose size or mtime changed (e.g., rewritten
+    in place) are sniffed again.
+    """
+
+    new = Manifest()
+    now_ns = time.time_ns()
+
+    with ThreadPoolExecutor(max_workers=workers or 4 *
+                            (os.cpu_count() or 1)) as pool:
+        frontier = [qry for qry in query if os.path.isdir(qry)]
+        # Stat'ed a directory's worth at a time, as most are unchanged
+        to_stat = [[qry for qry in query if os.path.isfile(qry)]]
+        while frontier:
+            listings = pool.map(
+                lambda path: list_dir(path, old.dirs.get(path), now_ns),
+                frontier)
+            next_frontier = []
+            for path, listing in zip(frontier, listings):
+                new.dirs[path] = listing
+                to_stat.append(
+                    [os.path.join(path, name) for name in listing.files])
+                next_frontier.extend(
+                    os.path.join(path, name) for name in listing.dirs)
+            frontier = next_frontier
+
+        for recs in pool.map(
+                lambda files: [stat_file(file, old.files.get(file))
+                               for file in files], to_stat):
+            new.files.update((rec.path, rec) for rec in recs if rec)
+
+    return new
@@ -0,0 +1,67 @@
+"""Crash-safe record of each job's attempts, for retrying and resuming"""
+
+import json
+import os
+import threading
+import time
+from typing import Any, Dict, Optional, TextIO
+
+
+# --------------------------------------------------
+class Journal:
+    """
+    JSON lines appended (to "path", if given) and synced as each attempt
+    finishes or sample completes. Reopening replays them, skipping a last
+    line cut short by a crash, so the latest state of each job is known.
+    """
+
+    def __init__(self, path: str = '') -> None:
+        self.states: Dict[str, Dict[str, Any]] = {}
+        self.lock = threading.Lock()
+        self.out_fh: Optional[TextIO] = None
+
+        if not path:
+            return
+
+        complete = True
+        if os.path.isfile(path):
+            with open(path) as fh:
+                for line in fh:
+                    complete = line.endswith('\n')
+                    try:
+                        record = json.loads(line)
+                        self.states[record['job']] = record
+                    except (ValueError, KeyError, TypeError):
+                        continue
+
+        self.out_fh = open(path, 'at')
+        if not complete:
+            self.out_fh.write('\n')
+
+    # --------------------------------------------------
+    def write(self, job: str, state: str, **fields: Any) -> Dict[str, Any]:
+        """Record a job's new state (e.g., done, retry, failed)"""
+
+        record = {'job': job, 'state': state, 'time': time.time(), **fields}
+        with self.lock:
+            self.states[job] = record
+            if self.out_fh:
+                self.out_fh.write(json.dumps(record) + '\n')
+                self.out_fh.flush()
+                os.fsync(self.out_fh.fileno())
+
+        return record
+
+    # --------------------------------------------------
+    def state(self, job: str) -> str:
+        """A job's latest state, or '' if it has none"""
+
+        return self.states.get(job, {}).get('state', '')
+
+    # --------------------------------------------------
+    def close(self) -> None:
+        """Close the journal file"""
+
+        if self.out_fh:
+            self.out_fh.close()
+            self.out_fh = None
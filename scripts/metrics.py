@@ -0,0 +1,136 @@
+"""Per-stage and per-job wall time, CPU time and peak memory"""
+
+import json
+import resource
+import sys
+import threading
+import time
+from contextlib import contextmanager
+from typing import Any, Dict, Iterator, List, Optional, TextIO
+
+# ru_maxrss is in bytes on macOS, KB elsewhere
+RSS_UNIT = 1 if sys.platform == 'darwin' else 1024
+
+
+# --------------------------------------------------
+def cpu_seconds(usage: resource.struct_rusage) -> float:
+    """User plus system time"""
+
+    return usage.ru_utime + usage.ru_stime
+
+
+# --------------------------------------------------
+def max_rss(usage: resource.struct_rusage) -> int:
+    """Peak resident set size in bytes"""
+
+    return usage.ru_maxrss * RSS_UNIT
+
+
+# --------------------------------------------------
+class Trace:
+    """
+    JSON-lines records of stages and jobs, written as they finish (to
+    "path", if given) and kept for a summary
+    """
+
+    def __init__(self, path: str = '') -> None:
+        self.records: List[Dict[str, Any]] = []
+        self.lock = threading.Lock()
+        self.out_fh: Optional[TextIO] = open(path, 'wt') if path else None
+
+    # --------------------------------------------------
+    def write(self, kind: str, name: str, **fields: Any) -> Dict[str, Any]:
+        """Add a record, with reads/sec if it has reads and wall time"""
+
+        record = {'kind': kind, 'name': name, **fields}
+        if record.get('reads') and record.get('wall'):
+            record['reads_per_sec'] = record['reads'] / record['wall']
+
+        with self.lock:
+            self.records.append(record)
+            if self.out_fh:
+                self.out_fh.write(json.dumps(record) + '\n')
+                self.out_fh.flush()
+
+        return record
+
+    # --------------------------------------------------
+    @contextmanager
+    def stage(self, name: str, **fields: Any) -> Iterator[Dict[str, Any]]:
+        """
+        Time a stage of this process and the children it waits for. The
+        caller may add fields (e.g., input_bytes, reads) to the dict it
+        is given. Peak RSS is the high-water mark so far, as getrusage
+        cannot reset it.
+        """
+
+        start_self = resource.getrusage(resource.RUSAGE_SELF)
+        start_children = resource.getrusage(resource.RUSAGE_CHILDREN)
+        start = time.perf_counter()
+        started = time.time()
+        try:
+            yield fields
+        finally:
+            wall = time.perf_counter() - start
+            end_self = resource.getrusage(resource.RUSAGE_SELF)
+            end_children = resource.getrusage(resource.RUSAGE_CHILDREN)
+            self.write(
+                'stage', name, **{
+                    'start': started,
+                    'wall': wall,
+                    'cpu': cpu_seconds(end_self) - cpu_seconds(start_self) +
+                    cpu_seconds(end_children) - cpu_seconds(start_children),
+                    'max_rss': max(max_rss(end_self), max_rss(end_children)),
+                    **fields
+                })
+
+    # --------------------------------------------------
+    def summary(self) -> str:
+        """Table of the stages and the jobs overall"""
+
+        def row(name, wall, cpu, rss, input_bytes, rate):
+            return '{:24} {:>10} {:>10} {:>10} {:>10} {:>12}'.format(
+                name, wall, cpu, rss, input_bytes, rate)
+
+        def num(value, fmt='{:.1f}'):
+            return fmt.format(value) if value else '-'
+
+        lines = [
+            row('stage', 'wall (s)', 'cpu (s)', 'rss (MB)', 'in (MB)',
+                'reads/sec')
+        ]
+        for rec in self.records:
+            if rec['kind'] == 'stage':
+                lines.append(
+                    row(rec['name'], num(rec['wall'], '{:.2f}'),
+                        num(rec['cpu'], '{:.2f}'),
+                        num(rec['max_rss'] / 2**20),
+                        num(rec.get('input_bytes', 0) / 2**20),
+                        num(rec.get('reads_per_sec'), '{:.0f}')))
+
+        jobs = [rec for rec in self.records if rec['kind'] == 'job']
+        if jobs:
+            failed = sum(1 for rec in jobs if rec['exit_code'] != 0)
+            walls = [rec['wall'] for rec in jobs]
+            reads = sum(rec.get('reads', 0) for rec in jobs)
+            lines.append('')
+            lines.append(
+                '{} job(s), {} failed: wall mean {:.2f} s, max {:.2f} s; '
+                'cpu {:.2f} s; max rss {:.1f} MB; max queued {:.2f} s; '
+                '{} reads/sec/job'.format(
+                    len(jobs), failed,
+                    sum(walls) / len(jobs), max(walls),
+                    sum(rec['cpu'] for rec in jobs),
+                    max(rec['max_rss'] for rec in jobs) / 2**20,
+                    max(rec['queued'] for rec in jobs),
+                    num(reads / sum(walls) if sum(walls) else 0, '{:.0f}')))
+
+        return '\n'.join(lines)
+
+    # --------------------------------------------------
+    def close(self) -> None:
+        """Close the trace file"""
+
+        if self.out_fh:
+            self.out_fh.close()
+            self.out_fh = None
@@ -0,0 +1,168 @@
+"""Share one page-cached copy of a Centrifuge index among its processes"""
+
+import ctypes
+import ctypes.util
+import mmap
+import os
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from functools import lru_cache
+from typing import Iterator, List, Tuple
+
+MAP_FAILED = ctypes.c_void_p(-1).value
+
+
+# --------------------------------------------------
+@lru_cache(maxsize=None)
+def libc() -> ctypes.CDLL:
+    """The C library, for the calls the mmap module does not offer"""
+
+    lib = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+    lib.mmap.restype = ctypes.c_void_p
+    lib.mmap.argtypes = [
+        ctypes.c_void_p, ctypes.c_size_t, ctypes.c_int, ctypes.c_int,
+        ctypes.c_int, ctypes.c_long
+    ]
+    for func in [lib.munmap, lib.mlock, lib.munlock]:
+        func.argtypes = [ctypes.c_void_p, ctypes.c_size_t]
+    lib.mincore.argtypes = [
+        ctypes.c_void_p, ctypes.c_size_t,
+        ctypes.POINTER(ctypes.c_ubyte)
+    ]
+
+    return lib
+
+
+# --------------------------------------------------
+def check(result: int) -> None:
+    """Raise OSError for a failed C call"""
+
+    if result != 0:
+        err = ctypes.get_errno()
+        raise OSError(err, os.strerror(err))
+
+
+# --------------------------------------------------
+def map_file(file: str) -> Tuple[int, int]:
+    """(address, size) of a shared read-only mapping of a non-empty file"""
+
+    size = os.path.getsize(file)
+    fd = os.open(file, os.O_RDONLY)
+    try:
+        addr = libc().mmap(None, size, mmap.PROT_READ, mmap.MAP_SHARED, fd,
+                           0)
+    finally:
+        os.close(fd)
+
+    if addr in (None, MAP_FAILED):
+        check(-1)
+
+    return addr, size
+
+
+# --------------------------------------------------
+@contextmanager
+def mapped(file: str) -> Iterator[Tuple[int, int]]:
+    """Map a non-empty file for the duration"""
+
+    addr, size = map_file(file)
+    try:
+        yield addr, size
+    finally:
+        libc().munmap(addr, size)
+
+
+# --------------------------------------------------
+def num_pages(size: int) -> int:
+    """Pages spanned by size bytes"""
+
+    return -(-size // mmap.PAGESIZE)
+
+
+# --------------------------------------------------
+def residency(files: List[str]) -> Tuple[int, int]:
+    """(resident, expected) pages of the files in the page cache"""
+
+    resident = expected = 0
+    for file in files:
+        if not os.path.getsize(file):
+            continue
+
+        with mapped(file) as (addr, size):
+            vec = (ctypes.c_ubyte * num_pages(size))()
+            check(libc().mincore(addr, size, vec))
+            expected += len(vec)
+            resident += len(vec) - bytes(vec).count(0)
+
+    return resident, expected
+
+
+# --------------------------------------------------
+def read_range(file: str, start: int, length: int,
+               block_size: int = 2**24) -> int:
+    """Read part of a file sequentially, returning the bytes read"""
+
+    fd = os.open(file, os.O_RDONLY)
+    try:
+        if hasattr(os, 'posix_fadvise'):
+            os.posix_fadvise(fd, start, length, os.POSIX_FADV_SEQUENTIAL)
+
+        done = 0
+        while done < length:
+            block = os.pread(fd, min(block_size, length - done),
+                             start + done)
+            if not block:
+                break
+            done += len(block)
+    finally:
+        os.close(fd)
+
+    return done
+
+
+# --------------------------------------------------
+def prewarm(files: List[str], workers: int = 0,
+            chunk_size: int = 2**28) -> int:
+    """
+    Pull the files into the page cache, each chunk_size piece read
+    sequentially by one of workers threads (default one per core).
+    Return the bytes read.
+    """
+
+    pieces = [(file, start, min(chunk_size, size - start))
+              for file in files for size in [os.path.getsize(file)]
+              for start in range(0, size, chunk_size)]
+
+    with ThreadPoolExecutor(max_workers=workers or os.cpu_count()
+                            or 1) as pool:
+        return sum(pool.map(lambda piece: read_range(*piece), pieces))
+
+
+# --------------------------------------------------
+def pin(files: List[str]) -> List[Tuple[int, int]]:
+    """
+    Map and mlock the files so their pages stay resident for as long as
+    this process holds the mappings, which unpin releases. Raise OSError
+    (e.g., over RLIMIT_MEMLOCK) with nothing left locked.
+    """
+
+    mappings: List[Tuple[int, int]] = []
+    try:
+        for file in files:
+            if os.path.getsize(file):
+                mappings.append(map_file(file))
+                check(libc().mlock(*mappings[-1]))
+    except OSError:
+        unpin(mappings)
+        raise
+
+    return mappings
+
+
+# --------------------------------------------------
+def unpin(mappings: List[Tuple[int, int]]) -> None:
+    """Unlock and unmap what pin mapped"""
+
+    for addr, size in mappings:
+        libc().munlock(addr, size)
+        libc().munmap(addr, size)
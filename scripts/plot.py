@@ -5,21 +5,36 @@ Date   : 2019-06-11
 Purpose: Plot Centrifuge out
 """
 
+from __future__ import annotations
+
 import argparse
-import csv
+import io
 import os
-import re
-import pandas as pd
-import matplotlib.pyplot as plt
-from functools import partial
-from collections import defaultdict
+from collections import Counter
 from dire import die, warn
-from typing import List, Dict, TextIO
+from functools import partial
+from typing import List, Dict, Optional, Set, TextIO, Tuple, Union
+import reports
+import taxonomy
+
+# numpy/pandas load on first use and matplotlib only to draw
+np = reports.lazy_import('numpy')
+pd = reports.lazy_import('pandas')
+
+
+# Results of on_uniques by key, then value
+UNIQUE_CACHE: Dict[str, dict] = {}
+
+# Largest bubble plot side, most tick labels on an axis and the side of
+# unlabelled heatmap axes
+MAX_INCHES = 40
+MAX_LABELS = 150
+HEAT_INCHES = 15
 
 
 # --------------------------------------------------
-def get_args():
-    """Get command-line arguments"""
+def get_args(argv: Optional[List[str]] = None) -> argparse.Namespace:
+    """Get command-line arguments, from sys.argv unless given argv"""
 
     parser = argparse.ArgumentParser(
         description='Plot Centrifuge out',
@@ -36,8 +51,8 @@ def get_args():
                         help='Tax rank',
                         metavar='str',
                         type=str,
-                        choices=('class family genus kingdom leaf'
-                                 'order phylum species subspecies'
+                        choices=('class family genus kingdom leaf '
+                                 'order phylum species subspecies '
                                  'superkingdom').split(),
                         default='species')
 
@@ -79,11 +94,30 @@ def get_args():
 
     parser.add_argument('-p',
                         '--max_plot',
-                        help='Max samples to plot',
+                        help='Max points to draw as bubbles, else a heatmap',
                         metavar='int',
                         type=int,
                         default=1000)
 
+    parser.add_argument('-s',
+                        '--page_samples',
+                        help='Max samples per heatmap page',
+                        metavar='int',
+                        type=int,
+                        default=500)
+
+    parser.add_argument('-k',
+                        '--top_taxa',
+                        help='Only the most abundant taxa in heatmaps (0=all)',
+                        metavar='int',
+                        type=int,
+                        default=0)
+
+    parser.add_argument('-c',
+                        '--cluster',
+                        help='Group heatmap samples by their dominant taxon',
+                        action='store_true')
+
     parser.add_argument('-H',
                         '--img_height',
                         help='Image height',
@@ -98,12 +132,32 @@ def get_args():
                         type=float,
                         default=0.)
 
+    parser.add_argument('-P',
+                        '--procs',
+                        help='Number of processes reading reports',
+                        metavar='int',
+                        type=int,
+                        default=1)
+
+    parser.add_argument('-T',
+                        '--taxonomy',
+                        help='Centrifuge index (e.g., dir/p_compressed) or '
+                        'its .taxonomy.npz, to roll up ranks by lineage',
+                        metavar='str',
+                        type=str,
+                        default='')
+
+    parser.add_argument('-C',
+                        '--no_cache',
+                        help='Do not keep a cohort cache next to the figure',
+                        action='store_true')
+
     parser.add_argument('-O',
                         '--show_image',
                         help='Show image',
                         action='store_true')
 
-    args = parser.parse_args()
+    args = parser.parse_args(argv)
 
     if not args.title:
         args.title = '{} abundance'.format(args.rank.title() or 'Organism')
@@ -114,122 +168,487 @@ def get_args():
 
 
 # --------------------------------------------------
-def parse_files(files: List[TextIO], rank_wanted: str, exclude: List[str],
-                min_pct: float) -> List[dict]:
-    """Parse the files"""
-
-    below_genus = partial(re.search, '(species|leaf)')
-    below_species = partial(re.search, '(subspecies|leaf)')
-    is_virus = lambda name: re.search('(phage|virus)', name, re.IGNORECASE)
-
-    assigned = {}
+def parse_files(files: List[TextIO],
+                rank_wanted: str,
+                exclude: List[str],
+                min_pct: float,
+                procs: int = 1,
+                cache_path: str = '',
+                tax_file: str = '') -> List[dict]:
+    """
+    Parse the files, using/updating the cohort cache if given one and
+    rolling ranks up with the taxonomy cache if given one
+    """
+
+    samples: List[str] = []
+    jobs = []
     for i, fh in enumerate(files, start=1):
         print('{:3}: {}'.format(i, fh.name))
 
         sample, _ = os.path.splitext(os.path.basename(fh.name))
-        if not sample in assigned:
-            assigned[sample] = {}
-
-        reader = csv.DictReader(fh, delimiter='\t')
-        for rec in reader:
-            tax_name = rec['name']
-            tax_rank = rec['taxRank']
-
-            if rank_wanted == 'genus' and below_genus(tax_rank):
-                tax_rank = 'genus'
-                if not is_virus(tax_name):
-                    tax_name = tax_name.split()[0]
-            elif rank_wanted == 'species' and below_species(tax_rank):
-                tax_rank = 'species'
-                if not is_virus(tax_name):
-                    tax_name = ' '.join(tax_name.split()[:2])
-
-            if rank_wanted and (rank_wanted != tax_rank):
-                continue
-
-            if rec['taxID'] in exclude or tax_name.lower() in exclude:
-                continue
-
-            try:
-                reads = int(rec['numUniqueReads'])
-                abundance = float(rec['abundance'])
-            except:
-                continue
-
-            if reads == 0:
-                continue
-
-            if not tax_name in assigned[sample]:
-                assigned[sample][tax_name] = {'reads': 0, 'abundance': 0}
-
-            assigned[sample][tax_name]['reads'] += reads
-            assigned[sample][tax_name]['abundance'] += abundance
-
-    data = []
-    for sample in assigned:
-        total_reads = sum([
-            assigned[sample][tax_name]['reads']
-            for tax_name in assigned[sample]
-        ])
-
-        if total_reads == 0:
+        if not sample in samples:
+            samples.append(sample)
+
+        # Open files cannot be sent to other processes, so send the name
+        jobs.append((samples.index(sample), fh if procs <= 1 else fh.name))
+
+    if cache_path and all(os.path.isfile(fh.name) for fh in files):
+        paths = [os.path.abspath(fh.name) for fh in files]
+        raw = load_cohort(cache_path, paths, procs)
+        # A report given twice counts twice, as when not cached
+        times = raw['file'].map(Counter(paths)).to_numpy()
+        if (times > 1).any():
+            raw = raw.iloc[np.repeat(np.arange(len(raw)),
+                                     times)].reset_index(drop=True)
+        sample_of = dict(zip(paths, (sample for sample, _ in jobs)))
+        raw['sample'] = raw['file'].map(sample_of).to_numpy(dtype=np.int64)
+        matrix = summarize(raw, rank_wanted, exclude, tax_file)
+    else:
+        matrix = reports.map_reduce(
+            partial(parse_report,
+                    rank_wanted=rank_wanted,
+                    exclude=exclude,
+                    tax_file=tax_file),
+            jobs, reports.CohortMatrix.concat, empty_matrix(), procs)
+
+    matrix = matrix.sort_samples()
+    totals = matrix.row_totals('reads')
+
+    total_of = dict(zip(matrix.samples.tolist(), totals.tolist()))
+    for num, sample in enumerate(samples):
+        if total_of.get(num, 0) == 0:
             warn('No reads for "{}"?'.format(sample))
-            continue
 
-        for tax_name, d in assigned[sample].items():
-            pct = d['reads'] / total_reads
+    matrix = matrix.select(totals[matrix.rows] != 0)
+    pct = matrix.values['reads'] / matrix.row_totals('reads')[matrix.rows]
+
+    if min_pct:
+        keep = ~(pct < min_pct)
+        matrix, pct = matrix.select(keep), pct[keep]
+
+    return [{
+        'sample': samples[sample],
+        'tax_name': tax_name,
+        'pct': pct,
+        'reads': reads,
+        'abundance': abundance
+    } for sample, tax_name, pct, reads, abundance in zip(
+        matrix.samples[matrix.rows].tolist(),
+        matrix.taxa[matrix.cols].tolist(), pct.tolist(),
+        matrix.values['reads'].tolist(), matrix.values['abundance'].tolist())]
+
+
+# --------------------------------------------------
+def parse_report(job: Tuple[int, Union[str, TextIO]],
+                 rank_wanted: str,
+                 exclude: List[str],
+                 tax_file: str = '') -> reports.CohortMatrix:
+    """Reads and abundance by (sample, tax_name) for one report"""
+
+    sample, src = job
+    return summarize(read_raw(src).assign(sample=sample), rank_wanted,
+                     exclude, tax_file)
+
+
+# --------------------------------------------------
+def read_raw(src: Union[str, TextIO]) -> pd.DataFrame:
+    """A report's names, ranks and typed counts, noting failed conversions"""
+
+    if isinstance(src, str):
+        with open(src) as fh:
+            df = read_report(fh)
+    else:
+        df = read_report(src)
+
+    reads, reads_ok = to_numbers(df['numUniqueReads'], np.int64)
+    abundance, abundance_ok = to_numbers(df['abundance'], np.float64)
+
+    return pd.DataFrame({
+        'name': df['name'].to_numpy(),
+        'taxID': df['taxID'].to_numpy(),
+        'taxRank': df['taxRank'].to_numpy(),
+        'reads': reads,
+        'reads_ok': reads_ok,
+        'abundance': abundance,
+        'abundance_ok': abundance_ok
+    })
+
+
+# --------------------------------------------------
+def summarize(raw: pd.DataFrame,
+              rank_wanted: str,
+              exclude: List[str],
+              tax_file: str = '') -> reports.CohortMatrix:
+    """Reads and abundance by (sample, tax_name) from raw report rows"""
+
+    if tax_file:
+        df = roll_up(raw, rank_wanted, taxonomy.load(tax_file))
+    else:
+        df = collapse_ranks(raw, rank_wanted)
+    reads = df['reads'].to_numpy()
+
+    keep = ((df['taxRank'] == rank_wanted).to_numpy()
+            & df['reads_ok'].to_numpy() & df['abundance_ok'].to_numpy())
+    if exclude:
+        keep &= ~(df['taxID'].isin(exclude).to_numpy() | on_uniques(
+            df['name'], lambda names: names.str.lower().isin(exclude)))
+    keep &= reads != 0
+
+    return reports.CohortMatrix.from_entries(
+        df['sample'].to_numpy(dtype=np.int64)[keep],
+        df['name'].to_numpy()[keep],
+        reads=reads[keep],
+        abundance=df['abundance'].to_numpy(dtype=np.float64)[keep])
+
+
+# --------------------------------------------------
+def load_cohort(cache_path: str, paths: List[str],
+                procs: int = 1) -> pd.DataFrame:
+    """
+    Raw rows of all the reports, in order, with a "file" column. Rows of
+    reports whose size and mtime match the cache are read from it, only
+    new or changed reports are parsed, and the cache is then updated.
+    A report given more than once is read (and returned) once.
+    """
+
+    paths = list(dict.fromkeys(paths))
+    stats = {path: os.stat(path) for path in paths}
+    frames = []
+    current: Set[str] = set()
+    changed = False
+
+    if os.path.isfile(cache_path):
+        cached = pd.read_parquet(cache_path)
+        files = cached.drop_duplicates('file')
+        current = {
+            file
+            for file, mtime, size in zip(files['file'], files['mtime_ns'],
+                                         files['size'])
+            if file in stats and stats[file].st_mtime_ns == mtime
+            and stats[file].st_size == size
+        }
+        keep = cached['file'].isin(current).to_numpy()
+        changed = not keep.all()
+        frames.append(cached[keep])
+
+    fresh = [path for path in paths if path not in current]
+    for path, raw in zip(fresh, reports.ordered_map(read_raw, fresh, procs)):
+        raw['file'] = path
+        raw['mtime_ns'] = stats[path].st_mtime_ns
+        raw['size'] = stats[path].st_size
+        changed = changed or not raw.empty
+        frames.append(raw)
+
+    cohort = pd.concat(frames, ignore_index=True) if frames else read_raw(
+        io.StringIO()).assign(file='', mtime_ns=0, size=0)
+    for col in ['file', 'name', 'taxID', 'taxRank']:
+        cohort[col] = cohort[col].astype(object)
+
+    # Put the rows in the order of the reports given
+    order = pd.Categorical(cohort['file'], categories=paths).codes
+    cohort = cohort.iloc[np.argsort(order, kind='stable')].reset_index(
+        drop=True)
+
+    if changed:
+        tmp_path = cache_path + '.tmp'
+        cohort.to_parquet(tmp_path, index=False)
+        os.replace(tmp_path, cache_path)
+
+    return cohort
+
+
+# --------------------------------------------------
+def empty_matrix() -> reports.CohortMatrix:
+    """A cohort with no reads"""
+
+    return reports.CohortMatrix.from_entries([], [],
+                                             reads=np.zeros(0, np.int64),
+                                             abundance=np.zeros(0))
+
+
+# --------------------------------------------------
+def read_report(fh: Optional[TextIO]) -> pd.DataFrame:
+    """Read a Centrifuge report as strings, keeping values like "NA" """
+
+    cols = ['name', 'taxID', 'taxRank', 'numUniqueReads', 'abundance']
+    if fh is None:
+        return pd.DataFrame({col: pd.Series(dtype=object) for col in cols})
+
+    try:
+        df = pd.read_csv(fh, sep='\t', dtype=str, keep_default_na=False)
+    except pd.errors.EmptyDataError:
+        return read_report(None)
+
+    return df[cols].astype(object)
+
+
+# --------------------------------------------------
+def collapse_ranks(df: pd.DataFrame, rank_wanted: str) -> pd.DataFrame:
+    """
+    Report anything below the wanted genus/species at that rank, naming
+    non-viruses by the first one/two words of the organism name
+    """
+
+    if rank_wanted not in ('genus', 'species'):
+        return df
+
+    # Ranks and names repeat across reports, so work on the unique values
+    below = on_uniques(
+        df['taxRank'], lambda ranks: ranks.str.contains(
+            'species|leaf' if rank_wanted == 'genus' else 'subspecies|leaf'),
+        'below_' + rank_wanted).astype(bool)
+    is_virus = on_uniques(
+        df['name'],
+        lambda names: names.str.contains('phage|virus', case=False),
+        'is_virus').astype(bool)
+    words = 1 if rank_wanted == 'genus' else 2
+    short_name = on_uniques(
+        df['name'], lambda names: names.str.split().str[:words].str.join(' '),
+        'short_' + rank_wanted)
+
+    rename = below & ~is_virus
+    return df.assign(taxRank=np.where(below, rank_wanted, df['taxRank']),
+                     name=np.where(rename, short_name, df['name']))
+
+
+# --------------------------------------------------
+def roll_up(df: pd.DataFrame, rank_wanted: str,
+            tax: taxonomy.Taxonomy) -> pd.DataFrame:
+    """Report each taxon as its ancestor at the wanted rank, if any"""
+
+    codes, tax_ids = pd.factorize(df['taxID'])
+    ids, ids_ok = to_numbers(pd.Series(tax_ids, dtype=object), np.int64)
+    ancestor = tax.ancestor_at(np.where(ids_ok, ids, 0), rank_wanted)
+    names = tax.name_of(ancestor)
+
+    found = (ancestor != 0)[codes]
+    return df.assign(
+        taxID=np.where(found,
+                       np.array(list(map(str, ancestor.tolist())),
+                                dtype=object)[codes], df['taxID']),
+        taxRank=np.where(found, rank_wanted, df['taxRank']),
+        name=np.where(found, names[codes], df['name']))
+
+
+# --------------------------------------------------
+def on_uniques(values: pd.Series, func, key: str = '') -> np.ndarray:
+    """
+    Apply a vectorised function to the unique values, then broadcast.
+    With a key, results are remembered across calls (e.g., reports).
+    """
+
+    codes, uniques = pd.factorize(values)
+    if not key:
+        return func(pd.Series(uniques, dtype=object)).to_numpy()[codes]
 
-            if min_pct and pct < min_pct:
-                continue
+    cache = UNIQUE_CACHE.setdefault(key, {})
+    new = [value for value in uniques if value not in cache]
+    if new:
+        cache.update(zip(new, func(pd.Series(new, dtype=object)).tolist()))
 
-            data.append({
-                'sample': sample,
-                'tax_name': tax_name,
-                'pct': pct,
-                'reads': d['reads'],
-                'abundance': d['abundance']
-            })
+    return np.array([cache[value] for value in uniques],
+                    dtype=object)[codes]
 
-    return data
+
+# --------------------------------------------------
+def to_numbers(values: pd.Series, dtype) -> Tuple[np.ndarray, np.ndarray]:
+    """Convert strings like int()/float() would, with a mask of successes"""
+
+    try:
+        return values.astype(dtype).to_numpy(), np.ones(len(values), bool)
+    except (ValueError, TypeError, OverflowError):
+        pass
+
+    def convert(value):
+        try:
+            return (int if dtype == np.int64 else float)(value), True
+        except (ValueError, TypeError, OverflowError):
+            return 0, False
+
+    pairs = [convert(value) for value in values]
+    return (np.array([value for value, _ in pairs], dtype=dtype),
+            np.array([ok for _, ok in pairs], dtype=bool))
+
+
+# --------------------------------------------------
+def plot_bubbles(df: pd.DataFrame,
+                 outfile: str,
+                 title: str = '',
+                 img_width: float = 0.,
+                 img_height: float = 0.,
+                 show_image: bool = False) -> None:
+    """Bubble per (sample, taxon) sized by pct, on integer-coded axes"""
+
+    import matplotlib.pyplot as plt
+
+    x, samples = pd.factorize(df['sample'])
+    y, taxa = pd.factorize(df['tax_name'])
+
+    img_width = img_width or min(MAX_INCHES, 5 + len(samples) / 5)
+    img_height = img_height or min(MAX_INCHES, len(taxa) / 3)
+    fig, ax = plt.subplots(figsize=(img_width, img_height))
+    ax.scatter(x, y, s=df['pct'].to_numpy() * 100, alpha=0.5)
+    label_axes(ax, samples, taxa)
+    ax.set_xlim(-.5, len(samples) - .5)
+    ax.set_ylim(-.5, len(taxa) - .5)
+    fig.subplots_adjust(bottom=.4, left=.4)
+    if title:
+        ax.set_title(title)
+
+    fig.savefig(outfile)
+    if show_image:
+        plt.show()
+    plt.close(fig)
+
+
+# --------------------------------------------------
+def plot_heatmap(df: pd.DataFrame,
+                 outfile: str,
+                 title: str = '',
+                 page_samples: int = 500,
+                 top_taxa: int = 0,
+                 cluster: bool = False) -> List[str]:
+    """
+    Rasterised pct by taxon (most abundant at the top) and sample, in
+    pages of page_samples samples ("bubble.1.png", ...) so only one
+    page's grid is ever in memory. Return the files written.
+    """
+
+    import matplotlib.pyplot as plt
+
+    sample_codes, samples = pd.factorize(df['sample'])
+    taxon_codes, taxa = pd.factorize(df['tax_name'])
+    pct = df['pct'].to_numpy(dtype=np.float64)
+
+    totals = np.bincount(taxon_codes, weights=pct, minlength=len(taxa))
+    taxon_order = np.argsort(-totals, kind='stable')
+    if top_taxa:
+        taxon_order = taxon_order[:top_taxa]
+    taxon_row = np.full(len(taxa), -1)
+    taxon_row[taxon_order] = np.arange(len(taxon_order))
+
+    keep = taxon_row[taxon_codes] >= 0
+    sample_codes, rows, pct = (sample_codes[keep],
+                               taxon_row[taxon_codes][keep], pct[keep])
+
+    sample_order = np.arange(len(samples))
+    if cluster:
+        # Order by dominant taxon, then by how dominant it is
+        by_pct = np.lexsort((-pct, sample_codes))
+        first = by_pct[np.r_[True, np.diff(sample_codes[by_pct]) != 0]]
+        dominant = np.full(len(samples), len(taxon_order))
+        dominant[sample_codes[first]] = rows[first]
+        top_pct = np.zeros(len(samples))
+        top_pct[sample_codes[first]] = pct[first]
+        sample_order = np.lexsort((-top_pct, dominant))
+
+    sample_col = np.empty(len(samples), dtype=np.int64)
+    sample_col[sample_order] = np.arange(len(samples))
+    cols = sample_col[sample_codes]
+
+    page_samples = max(1, page_samples)
+    num_pages = max(1, -(-len(samples) // page_samples))
+    base, ext = os.path.splitext(outfile)
+    vmax = pct.max() if len(pct) else 1.
+
+    paths = []
+    for page in range(num_pages):
+        start = page * page_samples
+        end = min(start + page_samples, len(samples))
+        on_page = (cols >= start) & (cols < end)
+
+        grid = np.full((len(taxon_order), end - start), np.nan, np.float32)
+        grid[rows[on_page], cols[on_page] - start] = pct[on_page]
+
+        fig, ax = plt.subplots(figsize=(6 + heat_inches(end - start),
+                                        3 + heat_inches(len(taxon_order))))
+        image = ax.imshow(np.ma.masked_invalid(grid),
+                          aspect='auto',
+                          interpolation='antialiased',
+                          vmin=0,
+                          vmax=vmax)
+        label_axes(ax, samples[sample_order[start:end]], taxa[taxon_order])
+        fig.colorbar(image, ax=ax, label='Proportion of sample reads')
+        fig.subplots_adjust(
+            bottom=.3 if end - start <= MAX_LABELS else .08,
+            left=.3 if len(taxon_order) <= MAX_LABELS else .08)
+        if title:
+            ax.set_title(title if num_pages == 1 else '{} ({}/{})'.format(
+                title, page + 1, num_pages))
+
+        path = outfile if num_pages == 1 else '{}.{}{}'.format(
+            base, page + 1, ext)
+        fig.savefig(path)
+        plt.close(fig)
+        paths.append(path)
+
+    return paths
 
 
 # --------------------------------------------------
-def main():
+def heat_inches(num: int) -> float:
+    """Heatmap side for num cells: room for labels, else a fixed raster"""
+
+    return num / 5 if num <= MAX_LABELS else HEAT_INCHES
+
+
+# --------------------------------------------------
+def label_axes(ax, samples: np.ndarray, taxa: np.ndarray) -> None:
+    """Name the integer ticks, leaving out labels too many to read"""
+
+    if len(samples) <= MAX_LABELS:
+        ax.set_xticks(np.arange(len(samples)))
+        ax.set_xticklabels(samples, rotation=45, ha='right')
+    else:
+        ax.set_xticks([])
+
+    if len(taxa) <= MAX_LABELS:
+        ax.set_yticks(np.arange(len(taxa)))
+        ax.set_yticklabels(taxa)
+    else:
+        ax.set_yticks([])
+
+    ax.set_ylabel('Organism')
+    ax.set_xlabel('Sample')
+
+
+# --------------------------------------------------
+def main(argv: Optional[List[str]] = None) -> None:
     """Make a jazz noise here"""
 
-    args = get_args()
-    data = parse_files(args.file, args.rank, args.exclude, args.min)
+    args = get_args(argv)
+    out_dir = os.path.dirname(os.path.abspath(args.outfile))
+    if not os.path.isdir(out_dir):
+        os.makedirs(out_dir)
+    basename, _ = os.path.splitext(os.path.basename(args.outfile))
+
+    cache_path = '' if args.no_cache else os.path.join(
+        out_dir, basename + '.cohort.parquet')
+    tax_file = taxonomy.cache_for(args.taxonomy,
+                                  out_dir) if args.taxonomy else ''
+    data = parse_files(args.file, args.rank, args.exclude, args.min,
+                       args.procs, cache_path, tax_file)
+    for fh in args.file:
+        fh.close()
 
     num_found = len(data)
     print('Found {} at min {}%'.format(num_found, args.min))
 
     if num_found > 0:
         df = pd.DataFrame(data)
-        out_dir = os.path.dirname(os.path.abspath(args.outfile))
-        if not os.path.isdir(out_dir):
-            os.makedirs(out_dir)
-        basename, _ = os.path.splitext(os.path.basename(args.outfile))
         df.to_csv(os.path.join(out_dir, basename + '.csv'), index=False)
 
         if num_found > args.max_plot:
-            print('Too many to plot (>{})!'.format(args.max_plot))
+            print('Too many for bubbles (>{}), drawing a heatmap'.format(
+                args.max_plot))
+            paths = plot_heatmap(df, args.outfile, args.title,
+                                 args.page_samples, args.top_taxa,
+                                 args.cluster)
+            print('Wrote {} page(s)'.format(len(paths)))
         else:
-            x = df['sample']
-            y = df['tax_name']
-            img_width = args.img_width or 5 + len(x.unique()) / 5
-            img_height = args.img_height or len(y.unique()) / 3
-            plt.figure(figsize=(img_width, img_height))
-            plt.scatter(x, y, s=df['pct'] * 100, alpha=0.5)
-            plt.xticks(rotation=45, ha='right')
-            plt.gcf().subplots_adjust(bottom=.4, left=.4)
-            plt.ylabel('Organism')
-            plt.xlabel('Sample')
-            if args.title:
-                plt.title(args.title)
-
-            plt.savefig(args.outfile)
-            if args.show_image:
-                plt.show()
+            plot_bubbles(df, args.outfile, args.title, args.img_width,
+                         args.img_height, args.show_image)
+
         print('Done, see csv/plot in out_dir "{}"'.format(out_dir))
 
 
@@ -0,0 +1,146 @@
+"""Content-addressed cache of Centrifuge reports"""
+
+import hashlib
+import os
+import shutil
+import tempfile
+import time
+from typing import List
+
+CACHE_FILES = ['tsv', 'sum']
+
+# Temporary entries older than this were left by runs that died storing
+TMP_MAX_AGE = 24 * 60 * 60
+
+
+# --------------------------------------------------
+def file_digest(file: str, block_size: int = 2**20) -> str:
+    """BLAKE2 digest of a file's contents"""
+
+    digest = hashlib.blake2b(digest_size=20)
+    with open(file, 'rb') as fh:
+        for block in iter(lambda: fh.read(block_size), b''):
+            digest.update(block)
+
+    return digest.hexdigest()
+
+
+# --------------------------------------------------
+def cache_key(input_digests: List[str],
+              index: str,
+              index_files: List[str],
+              exclude_tax_ids: List[int],
+              batched: bool = False) -> str:
+    """
+    Key for one sample's results: the reads' digests plus everything
+    about the index and options that changes the classification or the
+    report (batched runs estimate abundance differently)
+    """
+
+    digest = hashlib.blake2b(digest_size=20)
+    for part in input_digests:
+        digest.update(f'input:{part}\n'.encode())
+
+    digest.update(f'index:{index}\n'.encode())
+    for file in index_files:
+        stat = os.stat(file)
+        digest.update('index_file:{}:{}:{}\n'.format(
+            os.path.basename(file), stat.st_size,
+            stat.st_mtime_ns).encode())
+
+    digest.update('exclude:{}\n'.format(','.join(
+        map(str, sorted(exclude_tax_ids)))).encode())
+    digest.update(
+        'mode:{}\n'.format('batch' if batched else 'sample').encode())
+
+    return digest.hexdigest()
+
+
+# --------------------------------------------------
+def entry_dir(cache_dir: str, key: str) -> str:
+    """Directory holding one cache entry"""
+
+    return os.path.join(cache_dir, key[:2], key)
+
+
+# --------------------------------------------------
+def fetch(cache_dir: str, key: str, basename: str) -> bool:
+    """
+    Copy a cached entry to "basename.tsv"/"basename.sum", each appearing
+    atomically. Return whether the entry was found.
+    """
+
+    entry = entry_dir(cache_dir, key)
+    if not all(
+            os.path.isfile(os.path.join(entry, ext)) for ext in CACHE_FILES):
+        return False
+
+    for ext in CACHE_FILES:
+        dest = f'{basename}.{ext}'
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(dest) or '.',
+                                   prefix='.cache-')
+        os.close(fd)
+        shutil.copyfile(os.path.join(entry, ext), tmp)
+        os.chmod(tmp, 0o644)
+        os.replace(tmp, dest)
+
+    # The entry's mtime records its last use for eviction
+    now = time.time()
+    os.utime(entry, (now, now))
+
+    return True
+
+
+# --------------------------------------------------
+def store(cache_dir: str, key: str, basename: str) -> None:
+    """Add "basename.tsv"/"basename.sum" to the cache under key"""
+
+    entry = entry_dir(cache_dir, key)
+    if os.path.isdir(entry):
+        return
+
+    os.makedirs(os.path.dirname(entry), exist_ok=True)
+    tmp_dir = tempfile.mkdtemp(dir=cache_dir, prefix='.tmp-')
+    try:
+        for ext in CACHE_FILES:
+            dest = os.path.join(tmp_dir, ext)
+            shutil.copyfile(f'{basename}.{ext}', dest)
+            os.chmod(dest, 0o644)
+
+        # Shared with other users' runs, but mkdtemp makes it private
+        os.chmod(tmp_dir, 0o755)
+        os.rename(tmp_dir, entry)
+    except OSError:
+        # Another run stored the same key first
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+
+# --------------------------------------------------
+def evict(cache_dir: str, max_bytes: int) -> List[str]:
+    """
+    Remove least-recently used entries until under max_bytes, and any
+    temporary entries left by runs that died storing them
+    """
+
+    entries = []
+    for prefix in os.scandir(cache_dir):
+        if prefix.name.startswith('.tmp-') and prefix.is_dir():
+            if prefix.stat().st_mtime < time.time() - TMP_MAX_AGE:
+                shutil.rmtree(prefix.path, ignore_errors=True)
+            continue
+        if not prefix.is_dir() or prefix.name.startswith('.'):
+            continue
+        for entry in os.scandir(prefix.path):
+            size = sum(f.stat().st_size for f in os.scandir(entry.path))
+            entries.append((entry.stat().st_mtime, size, entry.path))
+
+    total = sum(size for _, size, _ in entries)
+    removed = []
+    for _, size, path in sorted(entries):
+        if total <= max_bytes:
+            break
+        shutil.rmtree(path, ignore_errors=True)
+        total -= size
+        removed.append(path)
+
+    return removed
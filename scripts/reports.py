@@ -0,0 +1,228 @@
+"""Load Centrifuge reports in parallel into sparse sample x taxon matrices"""
+
+from __future__ import annotations
+
+import importlib.util
+import sys
+from dataclasses import dataclass
+from types import ModuleType
+from typing import (Callable, Dict, Iterable, Iterator, List, Sequence,
+                    Tuple, TypeVar)
+
+
+# --------------------------------------------------
+def lazy_import(name: str) -> ModuleType:
+    """
+    A module that is only executed when first used, so that, e.g.,
+    "--help" does not wait for numpy and pandas
+    """
+
+    if name in sys.modules:
+        return sys.modules[name]
+
+    spec = importlib.util.find_spec(name)
+    if spec is None or spec.loader is None:
+        raise ImportError(f'No module named "{name}"', name=name)
+
+    loader = importlib.util.LazyLoader(spec.loader)
+    spec.loader = loader
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[name] = module
+    loader.exec_module(module)
+
+    return module
+
+
+np = lazy_import('numpy')
+pd = lazy_import('pandas')
+
+T = TypeVar('T')
+R = TypeVar('R')
+
+
+# --------------------------------------------------
+def tree_reduce(partials: Iterable[R],
+                merge: Callable[[List[R]], R],
+                empty: R,
+                fan_in: int = 16) -> R:
+    """
+    Merge partials fan_in at a time like a counter in base fan_in: each
+    run of fan_in neighbours at the same level is merged as soon as it is
+    complete, so at most fan_in x log(n) are held at once and the
+    left-to-right order is kept.
+    """
+
+    stack: List[Tuple[int, R]] = []
+    for partial in partials:
+        stack.append((0, partial))
+        while len(stack) >= fan_in and len(
+                set(level for level, _ in stack[-fan_in:])) == 1:
+            level = stack[-1][0]
+            merged = merge([p for _, p in stack[-fan_in:]])
+            del stack[-fan_in:]
+            stack.append((level + 1, merged))
+
+    if not stack:
+        return empty
+
+    return stack[0][1] if len(stack) == 1 else merge([p for _, p in stack])
+
+
+# --------------------------------------------------
+def ordered_map(func: Callable[[T], R],
+                items: Iterable[T],
+                procs: int = 1,
+                max_pending: int = 0) -> Iterator[R]:
+    """
+    Yield func(item) in order, computed in a pool of procs processes
+    with at most max_pending results (default 2 x procs) in flight
+    """
+
+    if procs <= 1:
+        yield from map(func, items)
+        return
+
+    # multiprocessing is slow to import and only needed here
+    from concurrent.futures import ProcessPoolExecutor
+
+    max_pending = max_pending or 2 * procs
+    with ProcessPoolExecutor(max_workers=procs) as pool:
+        pending = []
+        for item in items:
+            pending.append(pool.submit(func, item))
+            if len(pending) >= max_pending:
+                yield pending.pop(0).result()
+
+        for future in pending:
+            yield future.result()
+
+
+# --------------------------------------------------
+def map_reduce(func: Callable[[T], R],
+               items: Iterable[T],
+               merge: Callable[[List[R]], R],
+               empty: R,
+               procs: int = 1,
+               max_pending: int = 0) -> R:
+    """Parse items into partial aggregates in parallel and merge them"""
+
+    return tree_reduce(ordered_map(func, items, procs, max_pending), merge,
+                       empty)
+
+
+# --------------------------------------------------
+@dataclass
+class CohortMatrix:
+    """
+    Sparse sample x taxon matrix in coordinate (COO) form: entry i is at
+    (samples[rows[i]], taxa[cols[i]]) and has values[field][i] for each
+    field, e.g., numReads, numUniqueReads, abundance
+    """
+
+    samples: np.ndarray
+    taxa: np.ndarray
+    rows: np.ndarray
+    cols: np.ndarray
+    values: Dict[str, np.ndarray]
+
+    # --------------------------------------------------
+    @classmethod
+    def from_entries(cls, samples: Sequence, taxa: Sequence,
+                     **values: Sequence) -> 'CohortMatrix':
+        """
+        Build from one (sample, taxon, values) per entry, summing repeated
+        cells strictly in entry order and keeping their first appearance
+        """
+
+        rows, sample_labels = pd.factorize(np.asarray(samples, dtype=object))
+        cols, taxon_labels = pd.factorize(np.asarray(taxa, dtype=object))
+
+        return cls(np.asarray(sample_labels, dtype=object),
+                   np.asarray(taxon_labels, dtype=object),
+                   rows.astype(np.int64), cols.astype(np.int64),
+                   {fld: np.asarray(val)
+                    for fld, val in values.items()}).coalesce()
+
+    # --------------------------------------------------
+    @classmethod
+    def concat(cls, matrices: List['CohortMatrix']) -> 'CohortMatrix':
+        """Stack matrices' entries in order, merging their labels"""
+
+        fields = list(matrices[0].values)
+        return cls.from_entries(
+            np.concatenate([m.samples[m.rows] for m in matrices]),
+            np.concatenate([m.taxa[m.cols] for m in matrices]), **{
+                fld: np.concatenate([m.values[fld] for m in matrices])
+                for fld in fields
+            })
+
+    # --------------------------------------------------
+    def coalesce(self) -> 'CohortMatrix':
+        """Sum entries for the same cell, in order of first appearance"""
+
+        width = max(len(self.taxa), 1)
+        codes, cells = pd.factorize(self.rows * width + self.cols)
+
+        values = {}
+        for fld, val in self.values.items():
+            # ufunc.at adds strictly in entry order, like a running sum
+            total = np.zeros(len(cells), dtype=val.dtype)
+            np.add.at(total, codes, val)
+            values[fld] = total
+
+        return CohortMatrix(self.samples, self.taxa, cells // width,
+                            cells % width, values)
+
+    # --------------------------------------------------
+    def select(self, mask: np.ndarray) -> 'CohortMatrix':
+        """Only the entries where mask is true"""
+
+        return CohortMatrix(self.samples, self.taxa, self.rows[mask],
+                            self.cols[mask],
+                            {fld: val[mask]
+                             for fld, val in self.values.items()})
+
+    # --------------------------------------------------
+    def sort_samples(self) -> 'CohortMatrix':
+        """
+        Order samples by label and entries by sample (CSR order), keeping
+        the order of entries within each sample
+        """
+
+        order = np.argsort(self.samples, kind='stable')
+        rank = np.empty(len(order), dtype=np.int64)
+        rank[order] = np.arange(len(order))
+        rows = rank[self.rows]
+        entries = np.argsort(rows, kind='stable')
+
+        return CohortMatrix(self.samples[order], self.taxa, rows[entries],
+                            self.cols[entries],
+                            {fld: val[entries]
+                             for fld, val in self.values.items()})
+
+    # --------------------------------------------------
+    def indptr(self) -> np.ndarray:
+        """CSR row pointers of a matrix in sample order"""
+
+        return np.concatenate(
+            [[0], np.cumsum(np.bincount(self.rows,
+                                        minlength=len(self.samples)))])
+
+    # --------------------------------------------------
+    def row_totals(self, fld: str) -> np.ndarray:
+        """Sum of a field for each sample"""
+
+        val = self.values[fld]
+        totals = np.zeros(len(self.samples), dtype=val.dtype)
+        np.add.at(totals, self.rows, val)
+        return totals
+
+    # --------------------------------------------------
+    def to_frame(self) -> pd.DataFrame:
+        """One row per entry with sample and taxon labels"""
+
+        return pd.DataFrame({
+            'sample': self.samples[self.rows],
+            'taxon': self.taxa[self.cols],
+            **self.values
+        })
@@ -2,18 +2,36 @@
 """Run Centrifuge/bubble plot"""
 
 import argparse
+import csv
+import glob
+import gzip
+import heapq
 import logging
 import os
 import re
-import shutil
 import subprocess
 import tempfile
+import threading
+import time
 from collections import defaultdict
 from itertools import chain
-from typing import Dict, List, Optional
+from typing import Any, Callable, Dict, List, Optional, Tuple
 from dataclasses import dataclass
-import parallelprocs
-from shutil import which
+from concurrent.futures import ThreadPoolExecutor
+from shutil import copyfile, which
+import index_stage
+import input_manifest
+import job_journal
+import metrics
+import mmap_index
+import report_cache
+
+
+# Outputs are written under this suffix, then renamed when complete
+TMP_SUFFIX = '.tmp'
+
+# Killed by SIGKILL (e.g., the OOM killer), directly or via the shell
+OOM_EXIT_CODES = {-9, 128 + 9}
 
 
 @dataclass
@@ -33,6 +51,30 @@ class Args:
     verbose: bool
     reads_not_paired: bool
     num_halt: int
+    batch_size: int
+    cache_dir: str
+    cache_size: float
+    metrics_file: str
+    manifest_file: str
+    stage_dir: str
+    stage_size: float
+    mmap: bool
+    mlock: bool
+    shard: int
+    num_shards: int
+    merge: bool
+    journal_file: str
+    retries: int
+    backoff: float
+    taxonomy: bool
+
+
+@dataclass
+class Sample:
+    """One sample, either unpaired (one file) or paired (forward/reverse)"""
+
+    name: str
+    files: List[str]
 
 
 # --------------------------------------------------
@@ -96,17 +138,19 @@ def get_args() -> Args:
 
     parser.add_argument('-t',
                         '--threads',
-                        help='Num of threads per instance of centrifuge',
+                        help='Num of threads per instance of centrifuge '
+                        '(0 to fit the host)',
                         metavar='int',
                         type=int,
-                        default=1)
+                        default=0)
 
     parser.add_argument('-P',
                         '--procs',
-                        help='Max number of processes to run',
+                        help='Max number of processes to run '
+                        '(0 to fit the index in memory)',
                         metavar='int',
                         type=int,
-                        default=4)
+                        default=0)
 
     parser.add_argument('-H',
                         '--num_halt',
@@ -115,6 +159,84 @@ def get_args() -> Args:
                         type=int,
                         default=0)
 
+    parser.add_argument('-b',
+                        '--batch_size',
+                        help='Samples per Centrifuge process (0 for one each)',
+                        metavar='int',
+                        type=int,
+                        default=0)
+
+    parser.add_argument('-C',
+                        '--cache_dir',
+                        help='Shared directory for caching reports',
+                        metavar='str',
+                        type=str,
+                        default='')
+
+    parser.add_argument('-M',
+                        '--metrics',
+                        help='JSON-lines timing/memory trace '
+                        '(default "metrics.jsonl" in --out_dir)',
+                        metavar='str',
+                        type=str,
+                        default='')
+
+    parser.add_argument('-F',
+                        '--manifest',
+                        help='Manifest of the input files, reused to only '
+                        'rescan changed directories '
+                        '(default "manifest.json" in --out_dir)',
+                        metavar='str',
+                        type=str,
+                        default='')
+
+    parser.add_argument('-J',
+                        '--journal',
+                        help='Journal of the jobs\' attempts, used to resume '
+                        '(default "journal.jsonl" in --out_dir)',
+                        metavar='str',
+                        type=str,
+                        default='')
+
+    parser.add_argument('-r',
+                        '--retries',
+                        help='Times to retry a failed job',
+                        metavar='int',
+                        type=int,
+                        default=2)
+
+    parser.add_argument('-B',
+                        '--backoff',
+                        help='Seconds before the first retry, doubling '
+                        'after each',
+                        metavar='float',
+                        type=float,
+                        default=30.)
+
+    parser.add_argument('-S',
+                        '--cache_size',
+                        help='Max size of the report cache in GB',
+                        metavar='float',
+                        type=float,
+                        default=100.)
+
+    parser.add_argument('-L',
+                        '--stage_dir',
+                        help='Node-local directory (e.g., local SSD or '
+                        '/dev/shm) to copy the index to, shared by your '
+                        'runs',
+                        metavar='str',
+                        type=str,
+                        default='')
+
+    parser.add_argument('-Z',
+                        '--stage_size',
+                        help='Max size of your staged indexes in GB '
+                        '(0 for the free space)',
+                        metavar='float',
+                        type=float,
+                        default=0.)
+
     parser.add_argument('-m',
                         '--min_proportion',
                         help='Minimum proportion to show',
@@ -127,6 +249,38 @@ def get_args() -> Args:
                         help='Do not try to pair the reads',
                         action='store_true')
 
+    parser.add_argument('-w',
+                        '--mmap',
+                        help='Memory-map the index (Centrifuge --mm) so '
+                        'processes share one pre-warmed copy',
+                        action='store_true')
+
+    parser.add_argument('-l',
+                        '--mlock',
+                        help='With --mmap, lock the index in memory',
+                        action='store_true')
+
+    parser.add_argument('-s',
+                        '--shard',
+                        help='Only classify shard "i/N" of the inputs, '
+                        'balanced by size, in --out_dir/shards/i-of-N; '
+                        'a missing i is $SLURM_ARRAY_TASK_ID',
+                        metavar='str',
+                        type=str,
+                        default='')
+
+    parser.add_argument('-j',
+                        '--merge',
+                        help='Gather the shards\' reports and plot them',
+                        action='store_true')
+
+    parser.add_argument('-R',
+                        '--taxonomy',
+                        help='Roll up the plot\'s ranks by the index\'s '
+                        'taxonomy, cached from centrifuge-inspect (used '
+                        'anyway if already cached)',
+                        action='store_true')
+
     parser.add_argument('-v',
                         '--verbose',
                         help='Verbose logging',
@@ -137,11 +291,36 @@ def get_args() -> Args:
     if not os.path.isdir(args.index_dir):
         parser.error(f'--index_dir "{args.index_dir}" is not a directory')
 
-    valid_index = set(
-        map(lambda s: re.sub(r'\.\d+\.cf$', '', os.path.basename(s)),
-            os.listdir(args.index_dir)))
-
-    if args.index not in valid_index:
+    if args.mlock and not args.mmap:
+        parser.error('--mlock requires --mmap')
+
+    shard, num_shards = 0, 0
+    if args.shard:
+        if args.merge:
+            parser.error('--shard and --merge are exclusive')
+
+        match = re.match(r'^(\d*)/(\d+)$', args.shard)
+        if not match:
+            parser.error(f'--shard "{args.shard}" is not "i/N"')
+        shard = int(match.group(1) or os.environ.get('SLURM_ARRAY_TASK_ID')
+                    or 0)
+        num_shards = int(match.group(2))
+        if not 1 <= shard <= num_shards:
+            parser.error(f'--shard "{args.shard}" must be 1 to N of N')
+
+    if args.retries < 0:
+        parser.error(f'--retries "{args.retries}" must be >= 0')
+
+    if args.batch_size < 0:
+        parser.error(f'--batch_size "{args.batch_size}" must be >= 0')
+
+    # Only list the (possibly large) index dir to explain a bad --index
+    if not os.path.isfile(
+            os.path.join(args.index_dir, args.index + '.1.cf')):
+        valid_index = set(
+            re.sub(r'\.\d+\.cf$', '', file)
+            for file in os.listdir(args.index_dir)
+            if re.search(r'\.\d+\.cf$', file))
         tmpl = '--index "{}" is not valid, please choose from: {}'
         parser.error(tmpl.format(args.index, ', '.join(sorted(valid_index))))
 
@@ -153,11 +332,14 @@ def get_args() -> Args:
                 chain(*map(str.split, re.split(r'\s*,\s*',
                                                args.exclude_tax_ids))))))
 
+    out_dir = shard_dir(args.out_dir, shard,
+                        num_shards) if num_shards else args.out_dir
+
     return Args(query=args.query,
                 format=args.format,
                 index=args.index,
                 index_dir=args.index_dir,
-                out_dir=args.out_dir,
+                out_dir=out_dir,
                 exclude_tax_ids=exclude_ids,
                 figure_title=args.figure_title,
                 num_threads=args.threads,
@@ -165,7 +347,26 @@ def get_args() -> Args:
                 min_proportion=args.min_proportion,
                 verbose=args.verbose,
                 reads_not_paired=args.reads_not_paired,
-                num_halt=args.num_halt)
+                num_halt=args.num_halt,
+                batch_size=args.batch_size,
+                cache_dir=args.cache_dir,
+                cache_size=args.cache_size,
+                metrics_file=args.metrics
+                or os.path.join(out_dir, 'metrics.jsonl'),
+                manifest_file=args.manifest
+                or os.path.join(out_dir, 'manifest.json'),
+                journal_file=args.journal
+                or os.path.join(out_dir, 'journal.jsonl'),
+                retries=args.retries,
+                backoff=args.backoff,
+                stage_dir=args.stage_dir,
+                stage_size=args.stage_size,
+                mmap=args.mmap,
+                mlock=args.mlock,
+                shard=shard,
+                num_shards=num_shards,
+                merge=args.merge,
+                taxonomy=args.taxonomy)
 
 
 # --------------------------------------------------
@@ -179,31 +380,55 @@ def main():
         filemode='w',
         level=logging.DEBUG if args.verbose else logging.CRITICAL)
 
-    files = group_input_files(check_sra(find_input_files(args.query)),
-                              args.reads_not_paired)
+    if not os.path.isdir(args.out_dir):
+        os.makedirs(args.out_dir)
+    trace = metrics.Trace(args.metrics_file)
+
+    with trace.stage('discover') as stage:
+        manifest = input_manifest.scan(
+            args.query, input_manifest.Manifest.load(args.manifest_file))
+        formats = {path: rec.format for path, rec in manifest.files.items()}
+        sra_files, other_files = split_sra(manifest.paths(), formats)
+        files = group_input_files(other_files, args.reads_not_paired)
+        files['sra'] = sra_files
+        manifest.set_mates(files['forward'], files['reverse'])
+        manifest.save(args.manifest_file)
+        stage['files'] = len(manifest.files)
     logging.debug(
-        'Files found: forward = "%s", reverse = "%s", unpaired = "%s"',
-        len(files['forward']), len(files['reverse']), len(files['unpaired']))
-
-    reports_dir = run_centrifuge(files, args)
-    fig_dir = make_bubble(reports_dir, args)
+        'Files found: forward = "%s", reverse = "%s", unpaired = "%s", '
+        'sra = "%s"', len(files['forward']), len(files['reverse']),
+        len(files['unpaired']), len(files['sra']))
 
-    print(f'Done, reports in "{reports_dir}", figures in "{fig_dir}"')
+    if args.merge:
+        with trace.stage('merge'):
+            reports_dir = merge_shards(get_samples(files), args.out_dir)
+    else:
+        if args.num_shards:
+            files = shard_files(files, args.num_shards)[args.shard - 1]
+        journal = job_journal.Journal(args.journal_file)
+        try:
+            reports_dir = run_centrifuge(files, args, trace, formats, journal)
+        finally:
+            journal.close()
+
+    # Shards are only plotted together, by the merge
+    fig_dir = ''
+    if not args.num_shards:
+        with trace.stage('plot'):
+            fig_dir = make_bubble(reports_dir, args)
+
+    trace.close()
+    print(trace.summary())
+    print(f'Done, reports in "{reports_dir}", ' +
+          (f'figures in "{fig_dir}", ' if fig_dir else '') +
+          f'metrics in "{args.metrics_file}"')
 
 
 # --------------------------------------------------
 def find_input_files(query: List[str]) -> List[str]:
     """Find input files from list of files/dirs"""
 
-    files: List[str] = []
-    for qry in query:
-        if os.path.isdir(qry):
-            for root, _, filenames in os.walk(qry):
-                files.extend(map(lambda f: os.path.join(root, f), filenames))
-        elif os.path.isfile(qry):
-            files.append(qry)
-
-    return sorted(files)
+    return input_manifest.scan(query, input_manifest.Manifest()).paths()
 
 
 # --------------------------------------------------
@@ -248,8 +473,57 @@ def group_input_files(files: List[str],
 
 
 # --------------------------------------------------
-def run_centrifuge(files: Dict[str, List[str]], args: Args) -> str:
-    """Run Centrifuge"""
+def get_samples(files: Dict[str, List[str]]) -> List[Sample]:
+    """Turn grouped input files into samples named for their first file"""
+
+    samples = [Sample(os.path.basename(file), [file])
+               for file in files['unpaired']]
+
+    for forward, reverse in zip(files['forward'], files['reverse']):
+        samples.append(Sample(os.path.basename(forward), [forward, reverse]))
+
+    samples.extend(
+        Sample(os.path.basename(file), [file]) for file in files.get('sra', []))
+
+    return samples
+
+
+# --------------------------------------------------
+def input_args(samples: List[Sample]) -> str:
+    """Centrifuge input arguments for samples that are all (un)paired"""
+
+    if all(len(sample.files) == 2 for sample in samples):
+        forward = ','.join(sample.files[0] for sample in samples)
+        reverse = ','.join(sample.files[1] for sample in samples)
+        return f'-1 "{forward}" -2 "{reverse}" '
+
+    return '-U "{}" '.format(','.join(sample.files[0] for sample in samples))
+
+
+# --------------------------------------------------
+def out_args(basename: str, suffix: str = '') -> str:
+    """Centrifuge arguments to write basename.sum/.tsv (plus a suffix)"""
+
+    return (f'-S "{basename}.sum{suffix}" '
+            f'--report-file "{basename}.tsv{suffix}"')
+
+
+# --------------------------------------------------
+def run_centrifuge(files: Dict[str, List[str]],
+                   args: Args,
+                   trace: Optional[metrics.Trace] = None,
+                   formats: Optional[Dict[str, str]] = None,
+                   journal: Optional[job_journal.Journal] = None) -> str:
+    """
+    Run Centrifuge, recording stages and jobs in the trace and each job's
+    attempts in the journal. Formats sniffed from the files' contents take
+    precedence over extensions. Reports are written under temporary names
+    and renamed when complete, so a sample is done if it has a report and
+    the journal does not say it was since attempted again.
+    """
+
+    trace = trace or metrics.Trace()
+    journal = journal or job_journal.Journal()
 
     reports_dir = os.path.join(args.out_dir, 'reports')
     if not os.path.isdir(reports_dir):
@@ -258,46 +532,680 @@ def run_centrifuge(files: Dict[str, List[str]], args: Args) -> str:
     exclude_arg = '--exclude-taxids ' + ','.join(map(
         str, args.exclude_tax_ids)) if args.exclude_tax_ids else ''
 
-    file_format = args.format or get_file_formats(list(chain(*files.values())))
+    reads = list(chain(files['unpaired'], files['forward'], files['reverse']))
+    file_format = args.format or (get_file_formats(reads, formats)
+                                  if reads else 'fasta')
     if not file_format:
         raise Exception(
             'Cannot guess file format from file extentions, please specify.')
 
     format_arg = '-f' if file_format == 'fasta' else ''
 
+    cache_keys: Dict[str, str] = {}
+    with trace.stage('lookup') as stage:
+        if args.cache_dir:
+            # Existing reports may be stale or partial, so trust the cache
+            if not os.path.isdir(args.cache_dir):
+                os.makedirs(args.cache_dir)
+
+            samples = []
+            cache_keys = get_cache_keys(get_samples(files), args)
+            for sample in get_samples(files):
+                basename = os.path.join(reports_dir, sample.name)
+                if report_cache.fetch(args.cache_dir,
+                                      cache_keys[sample.name], basename):
+                    logging.debug('Using cached results for "%s"',
+                                  sample.name)
+                else:
+                    samples.append(sample)
+        else:
+            samples = [
+                sample for sample in get_samples(files)
+                if not (os.path.isfile(
+                    os.path.join(reports_dir, sample.name + '.tsv'))
+                        and journal.state(sample.name) in ('', 'done'))
+            ]
+        stage['samples'] = len(samples)
+
+    num_jobs = -(-len(samples) // args.batch_size) if args.batch_size else len(
+        samples)
+    cpus, mem = host_resources()
+    num_procs, num_threads = plan_resources(
+        index_size(args.index_dir, args.index), num_jobs, cpus, mem,
+        args.num_procs, args.num_threads, args.mmap)
+    logging.debug('Using %s procs with %s threads each', num_procs,
+                  num_threads)
+
+    # A run that dies holding the staged index is dropped by the next one
+    index_dir, staged = args.index_dir, ''
+    if args.stage_dir and samples:
+        with trace.stage('stage_index') as stage:
+            try:
+                staged = index_stage.acquire(
+                    args.index, index_files(args.index_dir, args.index),
+                    args.stage_dir, int(args.stage_size * 2**30))
+            except OSError as err:
+                logging.warning('Cannot stage index in "%s" (%s), using '
+                                '"%s"', args.stage_dir, err, args.index_dir)
+            stage['staged'] = bool(staged)
+        index_dir = staged or index_dir
+
+    pinned: List[Tuple[int, int]] = []
+    if args.mmap and samples:
+        with trace.stage('prewarm') as stage:
+            mapped_files = index_files(index_dir, args.index)
+            stage['input_bytes'] = mmap_index.prewarm(mapped_files, cpus)
+            if args.mlock:
+                try:
+                    pinned = mmap_index.pin(mapped_files)
+                except OSError as err:
+                    logging.warning('Cannot lock index in memory: %s', err)
+            stage['locked'] = bool(pinned)
+            stage['resident_pages'], stage['expected_pages'] = \
+                mmap_index.residency(mapped_files)
+        print('Index pages resident: {resident_pages:,} of '
+              '{expected_pages:,}'.format(**stage))
+
     cmd_tmpl = 'CENTRIFUGE_INDEXES={} centrifuge {} {} -p {} -x {} '
-    cmd_base = cmd_tmpl.format(args.index_dir, exclude_arg, format_arg,
-                               args.num_threads, args.index)
-
-    commands = []
-    for file in files['unpaired']:
-        basename = os.path.basename(file)
-        tsv_file = os.path.join(reports_dir, basename + '.tsv')
-        sum_file = os.path.join(reports_dir, basename + '.sum')
-        if not os.path.isfile(tsv_file):
+    if args.mmap:
+        cmd_tmpl += '--mm '
+    cmd_base = cmd_tmpl.format(index_dir, exclude_arg, format_arg,
+                               num_threads, args.index)
+
+    # SRA runs are decoded as they are classified, never landing on disk
+    sra_files = set(files.get('sra', []))
+    sra_samples = [s for s in samples if s.files[0] in sra_files]
+    samples = [s for s in samples if s.files[0] not in sra_files]
+
+    # Each command's (name, input bytes, output basename and suffix)
+    commands: List[Tuple[int, str]] = []
+    jobs: Dict[str, Tuple[str, int, str, str]] = {}
+    unreadable: List[str] = []
+    if sra_samples:
+        fastq_dump = which('fastq-dump')
+        if not fastq_dump:
+            raise Exception('Cannot find "fastq-dump"')
+
+        sra_base = cmd_tmpl.format(index_dir, exclude_arg, '-f',
+                                   num_threads, args.index)
+        sra_dir = os.path.join(args.out_dir, 'sra')
+
+        def probe(sample: Sample) -> Optional[bool]:
+            """Whether a run is paired, or None (journaled) if unreadable"""
+
+            try:
+                return sra_is_paired(fastq_dump, sample.files[0])
+            except subprocess.CalledProcessError as err:
+                error = err.stderr.decode(errors='replace').strip()
+            except OSError as err:
+                error = str(err)
+            logging.error('Cannot read SRA run "%s": %s', sample.files[0],
+                          error)
+            journal.write(sample.name, 'failed', error=error)
+            return None
+
+        # One corrupt run must not stop the others
+        with trace.stage('sra_probe', samples=len(sra_samples)) as stage, \
+                ThreadPoolExecutor(max_workers=num_procs) as pool:
+            paired = dict(
+                zip([s.name for s in sra_samples],
+                    pool.map(probe, sra_samples)))
+            unreadable = [
+                s.files[0] for s in sra_samples if paired[s.name] is None
+            ]
+            sra_samples = [
+                s for s in sra_samples if paired[s.name] is not None
+            ]
+            stage['failed'] = len(unreadable)
+
+        for sample in sra_samples:
+            basename = os.path.join(reports_dir, sample.name)
             commands.append(
-                cmd_base +
-                f'-U "{file}" -S "{sum_file}" --report-file "{tsv_file}"')
-
-    for forward, reverse in zip(files['forward'], files['reverse']):
-        basename = os.path.basename(forward)
-        tsv_file = os.path.join(reports_dir, basename + '.tsv')
-        sum_file = os.path.join(reports_dir, basename + '.sum')
-        if not os.path.isfile(tsv_file):
-            commands.append(cmd_base + f'-1 "{forward}" -2 "{reverse}" ' +
-                            f'-S "{sum_file}" --report-file "{tsv_file}"')
+                (input_size(sample),
+                 sra_command(fastq_dump, sample.files[0], paired[sample.name],
+                             sra_base, out_args(basename, TMP_SUFFIX),
+                             os.path.join(sra_dir, sample.name))))
+            jobs[commands[-1][1]] = (sample.name, commands[-1][0], basename,
+                                     TMP_SUFFIX)
+
+    # Each batch's samples by its output basename
+    batches: Dict[str, List[Sample]] = {}
+    if args.batch_size:
+        batch_dir = os.path.join(args.out_dir, 'batches')
+        if not os.path.isdir(batch_dir):
+            os.makedirs(batch_dir)
+
+        # Paired and unpaired samples cannot share one invocation
+        for paired in [False, True]:
+            group = [s for s in samples if (len(s.files) == 2) == paired]
+            for i in range(0, len(group), args.batch_size):
+                batch = group[i:i + args.batch_size]
+                name = os.path.join(batch_dir, f'batch-{len(batches) + 1}')
+                batches[name] = batch
+                commands.append(
+                    (sum(map(input_size, batch)), cmd_base + '--reorder ' +
+                     input_args(batch) + out_args(name)))
+                jobs[commands[-1][1]] = (os.path.basename(name),
+                                         commands[-1][0], name, '')
+    else:
+        for sample in samples:
+            basename = os.path.join(reports_dir, sample.name)
+            commands.append(
+                (input_size(sample), cmd_base + input_args([sample]) +
+                 out_args(basename, TMP_SUFFIX)))
+            jobs[commands[-1][1]] = (sample.name, commands[-1][0], basename,
+                                     TMP_SUFFIX)
+
+    job_reads: List[int] = []
+    # Samples whose reports are complete, to cache even if others fail
+    completed: List[str] = []
+
+    def job_done(cmd: str, usage: Dict[str, Any]) -> None:
+        name, size, basename, suffix = jobs[cmd]
+        succeeded = usage['exit_code'] == 0
+        reads = count_classified(f'{basename}.sum{suffix}') if succeeded else 0
+        if succeeded and suffix:
+            # The report last, as it marks the sample done
+            for ext in ['sum', 'tsv']:
+                os.replace(f'{basename}.{ext}{suffix}', f'{basename}.{ext}')
+        job_reads.append(reads)
+        if succeeded and suffix:
+            completed.append(name)
+        trace.write('job', name, input_bytes=size, reads=reads, **usage)
+        journal.write(name,
+                      'done' if succeeded else
+                      'retry' if usage['retry'] else 'failed',
+                      attempt=usage['attempt'],
+                      exit_code=usage['exit_code'],
+                      oom=usage['exit_code'] in OOM_EXIT_CODES,
+                      wall=usage['wall'],
+                      cpu=usage['cpu'],
+                      max_rss=usage['max_rss'])
+
+        # As each batch finishes, so a later failure cannot orphan it
+        if succeeded and basename in batches:
+            logging.debug('Demultiplexing "%s"', basename)
+            start = time.perf_counter()
+            demux_batch(batches[basename], f'{basename}.tsv',
+                        f'{basename}.sum', reports_dir, file_format)
+            for sample in batches[basename]:
+                journal.write(sample.name, 'done', batch=name)
+                completed.append(sample.name)
+            os.remove(f'{basename}.tsv')
+            os.remove(f'{basename}.sum')
+            trace.write('demux',
+                        name,
+                        samples=len(batches[basename]),
+                        wall=time.perf_counter() - start)
 
     logging.debug('Running Centrifuge')
-    logging.debug('\n'.join(commands))
-    parallelprocs.run(commands,
-                      msg='Running Centrifuge',
-                      num_procs=args.num_procs,
-                      verbose=args.verbose,
-                      halt=args.num_halt)
+    try:
+        with trace.stage('classify',
+                         jobs=len(commands),
+                         procs=num_procs,
+                         threads=num_threads) as stage:
+            stage['input_bytes'] = sum(size for size, _ in commands)
+            try:
+                run_jobs(commands,
+                         num_procs=num_procs,
+                         halt=args.num_halt,
+                         on_done=job_done,
+                         retries=args.retries,
+                         backoff=args.backoff)
+            finally:
+                stage['reads'] = sum(job_reads)
+                if args.mmap and samples:
+                    stage['resident_pages'], stage['expected_pages'] = \
+                        mmap_index.residency(mapped_files)
+                mmap_index.unpin(pinned)
+                if staged:
+                    index_stage.release(staged)
+    finally:
+        if args.cache_dir:
+            with trace.stage('cache_store', samples=len(completed)):
+                for name in completed:
+                    report_cache.store(args.cache_dir, cache_keys[name],
+                                       os.path.join(reports_dir, name))
+                report_cache.evict(args.cache_dir,
+                                   int(args.cache_size * 2**30))
+
+    if unreadable:
+        raise Exception('Cannot read {} SRA run(s):\n{}'.format(
+            len(unreadable), '\n'.join(unreadable)))
 
     return reports_dir
 
 
+# --------------------------------------------------
+def shard_dir(out_dir: str, shard: int, num_shards: int) -> str:
+    """Output directory of shard i (from 1) of N"""
+
+    return os.path.join(out_dir, 'shards', f'{shard}-of-{num_shards}')
+
+
+# --------------------------------------------------
+def shard_files(files: Dict[str, List[str]],
+                num_shards: int) -> List[Dict[str, List[str]]]:
+    """
+    Deal grouped input files into shards of about equal bytes, keeping
+    pairs together: the largest first, each to the lightest shard so far.
+    Every process given the same files makes the same shards.
+    """
+
+    units: List[Tuple[str, List[str]]] = [('unpaired', [file])
+                                          for file in files['unpaired']]
+    units.extend(('paired', [fwd, rev])
+                 for fwd, rev in zip(files['forward'], files['reverse']))
+    units.extend(('sra', [file]) for file in files.get('sra', []))
+
+    sizes = [sum(map(os.path.getsize, unit_files)) for _, unit_files in units]
+    loads = [(0, shard) for shard in range(num_shards)]
+    assigned: Dict[int, int] = {}
+    for unit in sorted(range(len(units)),
+                       key=lambda i: (-sizes[i], units[i][1])):
+        load, shard = heapq.heappop(loads)
+        assigned[unit] = shard
+        heapq.heappush(loads, (load + sizes[unit], shard))
+
+    shards: List[Dict[str, List[str]]] = [{
+        'forward': [],
+        'reverse': [],
+        'unpaired': [],
+        'sra': []
+    } for _ in range(num_shards)]
+    for i, (kind, unit_files) in enumerate(units):
+        shard = shards[assigned[i]]
+        if kind == 'paired':
+            shard['forward'].append(unit_files[0])
+            shard['reverse'].append(unit_files[1])
+        else:
+            shard[kind].append(unit_files[0])
+
+    return shards
+
+
+# --------------------------------------------------
+def merge_shards(samples: List[Sample], out_dir: str) -> str:
+    """
+    Copy each sample's reports from the shards into --out_dir/reports,
+    taking the newest if shards of several runs have it
+    """
+
+    reports_dir = os.path.join(out_dir, 'reports')
+    if not os.path.isdir(reports_dir):
+        os.makedirs(reports_dir)
+
+    found: Dict[str, str] = {}
+    shard_reports = glob.glob(
+        os.path.join(glob.escape(out_dir), 'shards', '*', 'reports', '*.tsv'))
+    for tsv_file in sorted(shard_reports, key=os.path.getmtime):
+        basename = tsv_file[:-len('.tsv')]
+        found[os.path.basename(basename)] = basename
+
+    missing = [
+        sample.name for sample in samples if sample.name not in found
+        and not os.path.isfile(os.path.join(reports_dir, sample.name + '.tsv'))
+    ]
+    if missing:
+        raise Exception('No shard has reports for {} sample(s): {}'.format(
+            len(missing), ', '.join(missing[:10])))
+
+    for sample in samples:
+        if sample.name in found:
+            for ext in report_cache.CACHE_FILES:
+                src = f'{found[sample.name]}.{ext}'
+                if os.path.isfile(src):
+                    copyfile(src,
+                             os.path.join(reports_dir, f'{sample.name}.{ext}'))
+
+    return reports_dir
+
+
+# --------------------------------------------------
+def get_cache_keys(samples: List[Sample], args: Args) -> Dict[str, str]:
+    """Cache key for each sample, hashing the inputs in parallel"""
+
+    inputs = sorted(set(chain(*(sample.files for sample in samples))))
+    with ThreadPoolExecutor(max_workers=os.cpu_count()) as pool:
+        digests = dict(zip(inputs, pool.map(report_cache.file_digest,
+                                            inputs)))
+
+    index = index_files(args.index_dir, args.index)
+    return {
+        sample.name:
+        report_cache.cache_key([digests[file] for file in sample.files],
+                               args.index, index, args.exclude_tax_ids,
+                               bool(args.batch_size))
+        for sample in samples
+    }
+
+
+# --------------------------------------------------
+def input_size(sample: Sample) -> int:
+    """Total bytes of a sample's input files"""
+
+    return sum(map(os.path.getsize, sample.files))
+
+
+# --------------------------------------------------
+def index_files(index_dir: str, index: str) -> List[str]:
+    """The ".N.cf" files making up an index"""
+
+    index_re = re.compile(re.escape(index) + r'\.\d+\.cf$')
+    return sorted(
+        os.path.join(index_dir, file) for file in os.listdir(index_dir)
+        if index_re.match(file))
+
+
+# --------------------------------------------------
+def index_size(index_dir: str, index: str) -> int:
+    """Total bytes of the ".N.cf" files making up an index"""
+
+    return sum(map(os.path.getsize, index_files(index_dir, index)))
+
+
+# --------------------------------------------------
+def read_int(file: str) -> Optional[int]:
+    """Read the first number in a (cgroup/proc) file, if there is one"""
+
+    try:
+        with open(file) as fh:
+            match = re.search(r'\d+', fh.read())
+            return int(match.group()) if match else None
+    except OSError:
+        return None
+
+
+# --------------------------------------------------
+def host_resources() -> Tuple[int, int]:
+    """Cores and bytes of memory available to us, honoring cgroup limits"""
+
+    cpus = len(os.sched_getaffinity(0)) if hasattr(
+        os, 'sched_getaffinity') else os.cpu_count() or 1
+
+    quota = None
+    try:
+        with open('/sys/fs/cgroup/cpu.max') as fh:
+            limit, period = fh.read().split()[:2]
+            if limit != 'max':
+                quota = int(limit) / int(period)
+    except (OSError, ValueError):
+        limit_v1 = read_int('/sys/fs/cgroup/cpu/cpu.cfs_quota_us')
+        period_v1 = read_int('/sys/fs/cgroup/cpu/cpu.cfs_period_us')
+        if limit_v1 and period_v1:
+            quota = limit_v1 / period_v1
+
+    if quota:
+        cpus = max(1, min(cpus, int(quota)))
+
+    mem = 0
+    try:
+        with open('/proc/meminfo') as fh:
+            for line in fh:
+                if line.startswith('MemAvailable:'):
+                    mem = int(line.split()[1]) * 1024
+    except OSError:
+        pass
+
+    for limit_file, usage_file in [
+        ('/sys/fs/cgroup/memory.max', '/sys/fs/cgroup/memory.current'),
+        ('/sys/fs/cgroup/memory/memory.limit_in_bytes',
+         '/sys/fs/cgroup/memory/memory.usage_in_bytes')
+    ]:
+        limit = read_int(limit_file)
+        if limit is not None and limit < 2**60:
+            free = limit - (read_int(usage_file) or 0)
+            mem = min(mem, free) if mem else free
+            break
+
+    return cpus, mem
+
+
+# --------------------------------------------------
+def plan_resources(index_bytes: int,
+                   num_jobs: int,
+                   cpus: int,
+                   mem: int,
+                   num_procs: int = 0,
+                   num_threads: int = 0,
+                   shared_index: bool = False) -> Tuple[int, int]:
+    """
+    Choose the number of processes and threads per process.
+
+    Each Centrifuge process holds its own copy of the index, unless they
+    share one memory-mapped copy, so the number of processes is capped by
+    how many copies (plus some working space) fit in memory, then the
+    cores are shared out among them. Explicit values are left alone.
+    """
+
+    if not num_procs:
+        working = int(index_bytes * .2) + 2**28
+        if shared_index:
+            fits = max(mem - index_bytes, 0) // working if mem else cpus
+        else:
+            fits = mem // (index_bytes + working) if mem else cpus
+        num_procs = max(1, min(cpus, fits, num_jobs or 1))
+
+    if not num_threads:
+        num_threads = max(1, cpus // num_procs)
+
+    return num_procs, num_threads
+
+
+# --------------------------------------------------
+def run_jobs(commands: List[Tuple[int, str]],
+             num_procs: int,
+             halt: int = 0,
+             on_done: Optional[Callable[[str, Dict[str, Any]], None]] = None,
+             retries: int = 0,
+             backoff: float = 30.) -> None:
+    """
+    Run (size, command) jobs largest-first, at most num_procs at a time.
+    A failed job is retried up to "retries" times, after backoff seconds
+    doubling each time, and with half the threads if it was killed (as
+    by the OOM killer). Stop starting new jobs once "halt" jobs have
+    failed for good (0 to run all), then raise if any did. Each attempt's
+    usage (see run_job) plus the seconds it was queued, its attempt number
+    and whether it will be retried is passed to on_done with the original
+    command as it finishes.
+    """
+
+    # (when it may start, original command, command to run, attempt)
+    queue = [(0., cmd, cmd, 1)
+             for _, cmd in sorted(commands, key=lambda c: -c[0])]
+    failed: List[Tuple[str, str]] = []
+    lock = threading.Lock()
+    start = time.perf_counter()
+
+    def next_job() -> Tuple[Optional[Tuple[float, str, str, int]], float]:
+        """The first job ready to start, else the seconds until one is"""
+
+        with lock:
+            if not queue or (halt and len(failed) >= halt):
+                return None, 0.
+            now = time.perf_counter()
+            for i, job in enumerate(queue):
+                if job[0] <= now:
+                    return queue.pop(i), 0.
+            return None, min(job[0] for job in queue) - now
+
+    def worker():
+        while True:
+            job, wait = next_job()
+            if not job:
+                if wait <= 0:
+                    return
+                time.sleep(wait)
+                continue
+
+            _, orig, cmd, attempt = job
+            logging.debug('Running %s (attempt %s)', cmd, attempt)
+            queued = time.perf_counter() - start
+            stderr, usage = run_job(cmd)
+            retry = usage['exit_code'] != 0 and attempt <= retries
+            with lock:
+                if retry:
+                    if usage['exit_code'] in OOM_EXIT_CODES:
+                        cmd = fewer_threads(cmd)
+                    queue.append((time.perf_counter() +
+                                  backoff * 2**(attempt - 1), orig, cmd,
+                                  attempt + 1))
+                elif usage['exit_code'] != 0:
+                    failed.append((cmd, stderr))
+            if on_done:
+                on_done(orig,
+                        dict(usage, queued=queued, attempt=attempt,
+                             retry=retry))
+
+    with ThreadPoolExecutor(max_workers=max(1, num_procs)) as pool:
+        for future in [pool.submit(worker) for _ in range(max(1, num_procs))]:
+            future.result()
+
+    if failed:
+        raise Exception('{} job(s) failed:\n{}'.format(
+            len(failed),
+            '\n'.join(f'{cmd}\n{err}' for cmd, err in failed)))
+
+
+# --------------------------------------------------
+def fewer_threads(cmd: str) -> str:
+    """A Centrifuge command with half its threads ("-p N"), at least 1"""
+
+    return re.sub(r'(?<= -p )\d+',
+                  lambda match: str(max(1, int(match.group()) // 2)),
+                  cmd,
+                  count=1)
+
+
+# --------------------------------------------------
+def run_job(cmd: str) -> Tuple[str, Dict[str, Any]]:
+    """
+    Run a shell command, returning its stderr and its exit code, wall
+    and CPU seconds and peak RSS, including the children it waited for
+    (from wait4)
+    """
+
+    with tempfile.TemporaryFile(mode='w+t') as err_fh:
+        start = time.perf_counter()
+        proc = subprocess.Popen(cmd,
+                                shell=True,
+                                executable=which('bash'),
+                                stdout=subprocess.DEVNULL,
+                                stderr=err_fh)
+        _, status, usage = os.wait4(proc.pid, 0)
+        wall = time.perf_counter() - start
+
+        # Reaped here, so tell Popen not to wait for it
+        proc.returncode = os.WEXITSTATUS(status) if os.WIFEXITED(
+            status) else -os.WTERMSIG(status)
+
+        err_fh.seek(0)
+        return err_fh.read(), {
+            'exit_code': proc.returncode,
+            'wall': wall,
+            'cpu': metrics.cpu_seconds(usage),
+            'max_rss': metrics.max_rss(usage)
+        }
+
+
+# --------------------------------------------------
+def count_classified(sum_file: str) -> int:
+    """Reads in a classification file, each on "numMatches" lines"""
+
+    reads = 0.
+    with open(sum_file, 'rb') as fh:
+        next(fh, None)
+        for line in fh:
+            reads += 1 / int(line.rsplit(b'\t', 1)[1])
+
+    return round(reads)
+
+
+# --------------------------------------------------
+def count_reads(file: str, file_format: str) -> int:
+    """Count the records in a (possibly gzipped) FASTA/Q file"""
+
+    opener = gzip.open if file.endswith('.gz') else open
+    with opener(file, 'rb') as fh:
+        if file_format == 'fasta':
+            return sum(1 for line in fh if line.startswith(b'>'))
+
+        return sum(1 for line in fh if line.strip()) // 4
+
+
+# --------------------------------------------------
+def demux_batch(batch: List[Sample], tsv_file: str, sum_file: str,
+                reports_dir: str, file_format: str) -> None:
+    """
+    Split the output of one batched Centrifuge run into per-sample files.
+
+    Batches run with "--reorder" so the classifications come back in input
+    order, each read using "numMatches" lines. Per-sample reports take the
+    name/rank/genome size from the batch report and count reads from the
+    classifications; abundance is the share of reads normalized by genome
+    size rather than Centrifuge's EM estimate.
+    """
+
+    taxa: Dict[str, Dict[str, str]] = {}
+    with open(tsv_file) as fh:
+        for row in csv.DictReader(fh, delimiter='\t'):
+            taxa[row['taxID']] = row
+
+    flds = [
+        'name', 'taxID', 'taxRank', 'genomeSize', 'numReads',
+        'numUniqueReads', 'abundance'
+    ]
+
+    with open(sum_file) as in_fh:
+        hdr = in_fh.readline()
+
+        for sample in batch:
+            num_reads = count_reads(sample.files[0], file_format)
+            reads: Dict[str, int] = defaultdict(int)
+            unique: Dict[str, int] = defaultdict(int)
+
+            basename = os.path.join(reports_dir, sample.name)
+            with open(basename + '.sum' + TMP_SUFFIX, 'wt') as out_fh:
+                out_fh.write(hdr)
+                for _ in range(num_reads):
+                    line = in_fh.readline()
+                    lines = [line]
+                    num_matches = int(line.split('\t')[7])
+                    lines.extend(in_fh.readline()
+                                 for _ in range(num_matches - 1))
+                    out_fh.writelines(lines)
+
+                    for match in lines:
+                        tax_id = match.split('\t')[2]
+                        if tax_id in taxa:
+                            reads[tax_id] += 1
+                            if num_matches == 1:
+                                unique[tax_id] += 1
+
+            norm = {
+                tax_id: count / int(taxa[tax_id]['genomeSize'])
+                for tax_id, count in reads.items()
+                if int(taxa[tax_id]['genomeSize'] or 0) > 0
+            }
+            total = sum(norm.values())
+
+            with open(basename + '.tsv' + TMP_SUFFIX, 'wt') as out_fh:
+                out_fh.write('\t'.join(flds) + '\n')
+                for tax_id in sorted(reads, key=lambda t: -reads[t]):
+                    taxon = taxa[tax_id]
+                    abundance = norm.get(tax_id, 0) / total if total else 0
+                    out_fh.write('\t'.join([
+                        taxon['name'], tax_id, taxon['taxRank'],
+                        taxon['genomeSize'],
+                        str(reads[tax_id]),
+                        str(unique[tax_id]), f'{abundance:.6g}'
+                    ]) + '\n')
+
+            for ext in ['sum', 'tsv']:
+                os.replace(f'{basename}.{ext}{TMP_SUFFIX}',
+                           f'{basename}.{ext}')
+
+
 # --------------------------------------------------
 def make_bubble(reports_dir: str, args: Args) -> str:
     """Make bubble chart"""
@@ -306,19 +1214,41 @@ def make_bubble(reports_dir: str, args: Args) -> str:
     if not os.path.isdir(fig_dir):
         os.makedirs(fig_dir)
 
-    cur_dir = os.path.dirname(os.path.realpath(__file__))
-    bubble = os.path.join(cur_dir, 'plot.py')
-
-    if not os.path.isfile(bubble):
-        raise Exception(f'Cannot find "{bubble}"')
-
-    tmpl = '{} --title "{}" --outfile "{}" --min {} {}/*.tsv'
-    job = tmpl.format(bubble, args.figure_title,
-                      os.path.join(fig_dir, 'bubble.png'), args.min_proportion,
-                      reports_dir)
-    logging.debug('Running %s', job)
-
-    subprocess.run(job, shell=True)
+    report_files = sorted(
+        glob.glob(os.path.join(glob.escape(reports_dir), '*.tsv')))
+    if not report_files:
+        logging.debug('No reports in "%s" to plot', reports_dir)
+        return fig_dir
+
+    # In-process, so pandas/matplotlib load once and only when plotting
+    import plot
+    import taxonomy
+
+    # Built only on request, as it needs centrifuge-inspect and somewhere
+    # to write it; otherwise ranks are rolled up from the taxa's names
+    index = os.path.join(args.index_dir, args.index)
+    cache_dir = args.cache_dir or fig_dir
+    tax_file = taxonomy.find_cache(index, cache_dir)
+    if not tax_file and args.taxonomy:
+        try:
+            tax_file = taxonomy.cache_for(index, cache_dir)
+        except Exception as err:
+            logging.warning(
+                'Cannot get the taxonomy of "%s" (%s), rolling up ranks '
+                'by name', index, err)
+    elif not tax_file:
+        logging.debug(
+            'No taxonomy cached for "%s" (see --taxonomy), rolling up '
+            'ranks by name', index)
+
+    plot_args = [
+        '--title', args.figure_title, '--outfile',
+        os.path.join(fig_dir, 'bubble.png'), '--min',
+        str(args.min_proportion)
+    ] + (['--taxonomy', tax_file] if tax_file else []) + report_files
+    logging.debug('Running plot.py %s', ' '.join(plot_args))
+
+    plot.main(plot_args)
 
     return fig_dir
 
@@ -349,43 +1279,79 @@ def guess_file_format(ext: str) -> str:
 
 
 # --------------------------------------------------
-def get_file_formats(files: List[str]) -> Optional[str]:
-    """Guess one format for all the files"""
-
-    exts = set(map(guess_file_format, map(get_extension, files)))
+def get_file_formats(files: List[str],
+                     sniffed: Optional[Dict[str, str]] = None
+                     ) -> Optional[str]:
+    """Guess one format for all the files, from contents if sniffed"""
+
+    sniffed = sniffed or {}
+    exts = set(
+        sniffed.get(file) or guess_file_format(get_extension(file))
+        for file in files)
     return exts.pop() if len(exts) == 1 else None
 
 
 # --------------------------------------------------
-def check_sra(files: List[str]) -> List[str]:
-    """Unpack FASTA from any SRA files"""
+def is_sra(file: str) -> bool:
+    """Whether a file is an SRA run"""
+
+    return os.path.splitext(file)[1] == '.sra'
 
-    fastq_dump = which('fastq-dump')
-    if not fastq_dump:
+
+# --------------------------------------------------
+def split_sra(files: List[str],
+              sniffed: Optional[Dict[str, str]] = None
+              ) -> Tuple[List[str], List[str]]:
+    """Separate SRA runs (by extension or sniffed format) from the reads"""
+
+    sniffed = sniffed or {}
+    sra_files = [
+        file for file in files if is_sra(file) or sniffed.get(file) == 'sra'
+    ]
+    if sra_files and not which('fastq-dump'):
         raise Exception('Cannot find "fastq-dump"')
 
-    tmpl = fastq_dump + ' --fasta --split-files -O {} {}'
-    new_files = []
+    sra_set = set(sra_files)
+    return sra_files, [file for file in files if file not in sra_set]
 
-    for file in files:
-        _, ext = os.path.splitext(file)
-        if ext == '.sra':
-            logging.debug('Extracting SRA file "%s"', os.path.basename(file))
-            srcdir = os.path.dirname(file)
-            tmpdir = tempfile.TemporaryDirectory()
-            subprocess.run(tmpl.format(tmpdir.name, file), shell=True)
 
-            for fasta in filter(lambda f: re.search('.f(?:ast|n)?a', f),
-                                os.listdir(tmpdir.name)):
-                new = os.path.join(srcdir, fasta)
-                shutil.move(os.path.join(tmpdir.name, fasta), new)
-                new_files.append(new)
+# --------------------------------------------------
+def sra_is_paired(fastq_dump: str, file: str) -> bool:
+    """Check whether an SRA run is paired by decoding only its first spot"""
 
-            tmpdir.cleanup()
-        else:
-            new_files.append(file)
+    proc = subprocess.run(
+        [fastq_dump, '--fasta', '--split-files', '-X', '1', '-Z', file],
+        capture_output=True,
+        check=True)
+
+    return proc.stdout.count(b'\n>') + proc.stdout.startswith(b'>') > 1
 
-    return new_files
+
+# --------------------------------------------------
+def sra_command(fastq_dump: str, file: str, paired: bool, cmd_base: str,
+                out_args: str, work_dir: str) -> str:
+    """
+    Shell command streaming an SRA run from "fastq-dump" into Centrifuge.
+    Unpaired reads are piped to stdin; paired reads go through two named
+    pipes that "fastq-dump --split-files" writes as it decodes.
+    """
+
+    if not paired:
+        return (f'set -o pipefail; "{fastq_dump}" --fasta -Z "{file}" | '
+                f'{cmd_base}-U - {out_args}')
+
+    acc, _ = os.path.splitext(os.path.basename(file))
+    fifos = [os.path.join(work_dir, f'{acc}_{n}.fasta') for n in [1, 2]]
+
+    # If fastq-dump dies before opening the pipes, open them so that
+    # Centrifuge sees EOF instead of waiting forever.
+    return (f'rm -rf "{work_dir}" && mkdir -p "{work_dir}" && '
+            f'mkfifo "{fifos[0]}" "{fifos[1]}" && '
+            f'{{ {{ "{fastq_dump}" --fasta --split-files -O "{work_dir}" '
+            f'"{file}" || {{ : > "{fifos[0]}" & : > "{fifos[1]}" & '
+            f'exit 1; }}; }} & '
+            f'{cmd_base}-1 "{fifos[0]}" -2 "{fifos[1]}" {out_args}; '
+            f'rc=$?; wait $! || rc=1; rm -rf "{work_dir}"; exit $rc; }}')
 
 
 # --------------------------------------------------
@@ -0,0 +1,232 @@
+"""Compact taxonomy from a Centrifuge index for rolling taxa up to a rank"""
+
+from __future__ import annotations
+
+import glob
+import os
+import subprocess
+from dataclasses import dataclass
+from typing import Dict, Iterable, List, Tuple
+from reports import lazy_import
+
+np = lazy_import('numpy')
+
+TAXONOMIES: Dict[str, 'Taxonomy'] = {}
+
+
+# --------------------------------------------------
+@dataclass
+class Taxonomy:
+    """
+    Arrays indexed directly by taxID: parent[tax_id] (0 if unknown) and
+    rank[tax_id], a code into ranks (-1 if unknown). Names are one UTF-8
+    blob sliced by the offsets of the sorted name_ids.
+    """
+
+    parent: np.ndarray
+    rank: np.ndarray
+    ranks: np.ndarray
+    name_ids: np.ndarray
+    name_offsets: np.ndarray
+    name_blob: np.ndarray
+
+    # --------------------------------------------------
+    @classmethod
+    def from_tables(cls, tree: Iterable[Tuple[int, int, str]],
+                    names: Iterable[Tuple[int, str]]) -> 'Taxonomy':
+        """Build from (taxID, parentID, rank) and (taxID, name) rows"""
+
+        tree = list(tree)
+        ranks = sorted(set(rank for _, _, rank in tree))
+        rank_code = {rank: code for code, rank in enumerate(ranks)}
+        size = max([max(tax_id, parent) for tax_id, parent, _ in tree],
+                   default=0) + 1
+
+        parent = np.zeros(size, dtype=np.int32)
+        rank = np.full(size, -1, dtype=np.int16)
+        for tax_id, parent_id, rank_name in tree:
+            parent[tax_id] = parent_id
+            rank[tax_id] = rank_code[rank_name]
+
+        names = sorted(dict(names).items())
+        encoded = [name.encode() for _, name in names]
+        offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+        offsets[1:] = np.cumsum([len(name) for name in encoded])
+
+        return cls(parent, rank, np.array(ranks, dtype=str),
+                   np.array([tax_id for tax_id, _ in names], dtype=np.int64),
+                   offsets,
+                   np.frombuffer(b''.join(encoded), dtype=np.uint8))
+
+    # --------------------------------------------------
+    def ancestor_at(self, tax_ids: np.ndarray, rank: str) -> np.ndarray:
+        """
+        The taxID at the rank on each taxon's lineage (itself included),
+        or 0 if there is none, walking all the lineages up in lockstep
+        """
+
+        tax_ids = np.asarray(tax_ids, dtype=np.int64)
+        found = np.zeros(len(tax_ids), dtype=np.int64)
+        if rank not in self.ranks:
+            return found
+
+        code = self.ranks.tolist().index(rank)
+        cur = np.where((tax_ids > 0) & (tax_ids < len(self.parent)), tax_ids,
+                       0)
+        while cur.any():
+            hit = (cur != 0) & (self.rank[cur] == code)
+            found[hit] = cur[hit]
+            up = self.parent[cur].astype(np.int64)
+            # The root is its own parent
+            cur = np.where(~hit & (up != cur), up, 0)
+
+        return found
+
+    # --------------------------------------------------
+    def name_of(self, tax_ids: np.ndarray) -> np.ndarray:
+        """Scientific names of taxIDs ('' if unknown)"""
+
+        tax_ids = np.asarray(tax_ids, dtype=np.int64)
+        pos = np.searchsorted(self.name_ids, tax_ids)
+        pos = np.minimum(pos, max(len(self.name_ids) - 1, 0))
+        blob = self.name_blob.tobytes()
+
+        return np.array([
+            blob[self.name_offsets[p]:self.name_offsets[p + 1]].decode()
+            if len(self.name_ids) and self.name_ids[p] == tax_id else ''
+            for p, tax_id in zip(pos.tolist(), tax_ids.tolist())
+        ], dtype=object)
+
+    # --------------------------------------------------
+    def save(self, path: str) -> None:
+        """Write atomically as an uncompressed .npz"""
+
+        tmp_path = path + '.tmp'
+        try:
+            with open(tmp_path, 'wb') as fh:
+                np.savez(fh,
+                         parent=self.parent,
+                         rank=self.rank,
+                         ranks=self.ranks,
+                         name_ids=self.name_ids,
+                         name_offsets=self.name_offsets,
+                         name_blob=self.name_blob)
+            os.replace(tmp_path, path)
+        except OSError:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+
+
+# --------------------------------------------------
+def load(path: str) -> Taxonomy:
+    """Read a saved taxonomy, once per process"""
+
+    if path not in TAXONOMIES:
+        with np.load(path) as data:
+            TAXONOMIES[path] = Taxonomy(**{key: data[key] for key in data})
+
+    return TAXONOMIES[path]
+
+
+# --------------------------------------------------
+def inspect(index: str) -> Taxonomy:
+    """Dump an index's taxonomy tree and name table with centrifuge-inspect"""
+
+    def run(option: str) -> List[str]:
+        proc = subprocess.run(['centrifuge-inspect', option, index],
+                              stdout=subprocess.PIPE,
+                              check=True,
+                              universal_newlines=True)
+        return proc.stdout.splitlines()
+
+    return Taxonomy.from_tables(parse_tree(run('--taxonomy-tree')),
+                                parse_names(run('--name-table')))
+
+
+# --------------------------------------------------
+def parse_tree(lines: Iterable[str]) -> List[Tuple[int, int, str]]:
+    """(taxID, parentID, rank) from "taxID\t|\tparentID\t|\trank" lines"""
+
+    rows = []
+    for line in lines:
+        flds = [fld.strip() for fld in line.split('|')]
+        if len(flds) >= 3 and flds[0].isdigit() and flds[1].isdigit():
+            rows.append((int(flds[0]), int(flds[1]), flds[2]))
+
+    return rows
+
+
+# --------------------------------------------------
+def parse_names(lines: Iterable[str]) -> List[Tuple[int, str]]:
+    """(taxID, name) from "taxID\tname" lines"""
+
+    rows = []
+    for line in lines:
+        tax_id, _, name = line.rstrip('\n').partition('\t')
+        if tax_id.isdigit():
+            rows.append((int(tax_id), name))
+
+    return rows
+
+
+# --------------------------------------------------
+def cache_paths(index: str, fallback_dir: str = '') -> List[str]:
+    """Where an index's taxonomy cache may be: next to it, else fallback_dir"""
+
+    paths = [index + '.taxonomy.npz']
+    if fallback_dir:
+        paths.append(
+            os.path.join(fallback_dir,
+                         os.path.basename(index) + '.taxonomy.npz'))
+
+    return paths
+
+
+# --------------------------------------------------
+def find_cache(index: str, fallback_dir: str = '') -> str:
+    """
+    Path of a taxonomy cache of an index no older than the index (or the
+    index itself if it is an .npz), else ''
+    """
+
+    if index.endswith('.npz') and os.path.isfile(index):
+        return index
+
+    index_files = glob.glob(glob.escape(index) + '.*.cf')
+    if not index_files:
+        return ''
+    index_mtime = max(map(os.path.getmtime, index_files))
+
+    for path in cache_paths(index, fallback_dir):
+        if os.path.isfile(path) and os.path.getmtime(path) >= index_mtime:
+            return path
+
+    return ''
+
+
+# --------------------------------------------------
+def cache_for(index: str, fallback_dir: str = '') -> str:
+    """
+    Path of the taxonomy cache of an index (e.g., "dir/p_compressed"),
+    built next to it or in fallback_dir if it is missing or older than
+    the index. Given an existing .npz, use that.
+    """
+
+    path = find_cache(index, fallback_dir)
+    if path:
+        return path
+
+    if not glob.glob(glob.escape(index) + '.*.cf'):
+        raise Exception(f'Cannot find Centrifuge index "{index}"')
+
+    paths = cache_paths(index, fallback_dir)
+    taxonomy = inspect(index)
+    for path in paths:
+        try:
+            taxonomy.save(path)
+            return path
+        except OSError:
+            continue
+
+    raise Exception(f'Cannot write taxonomy cache "{paths[-1]}"')
@@ -1,5 +1,30 @@
+import dataclasses
+import gzip
 import io
-from run_centrifuge import guess_file_format, get_extension, get_file_formats, group_input_files
+import json
+import os
+import numpy as np
+import pandas as pd
+import pytest
+import signal
+import subprocess
+import time
+import bench
+import collapse
+import fasplit
+import index_stage
+import input_manifest
+import job_journal
+import metrics
+import mmap_index
+import plot
+import reports
+import taxonomy
+import report_cache
+import unsplit
+from run_centrifuge import guess_file_format, get_extension, get_file_formats, group_input_files, \
+    Sample, demux_batch, plan_resources, run_jobs, sra_is_paired, sra_command, \
+    Args, make_bubble, shard_files, merge_shards, shard_dir, fewer_threads
 
 
 # --------------------------------------------------
@@ -40,6 +65,10 @@ def test_get_file_formats():
 
     assert get_file_formats(['/x/foo.fa', '/foo/bar.fastq']) is None
 
+    # Sniffed contents win over extensions
+    assert get_file_formats(['/x/foo.txt', '/x/bar.fa'],
+                            {'/x/foo.txt': 'fasta', '/x/bar.fa': ''}) == 'fasta'
+
 
 # --------------------------------------------------
 def test_group_input_files():
@@ -65,3 +94,828 @@ def test_group_input_files():
     assert gr4['unpaired'] == ['baz.fa']
     assert not gr4['forward'] == ['foo_1.fasta', 'bar_R1.fna']
     assert not gr4['reverse'] == ['foo_2.fasta', 'bar_r2.fna']
+
+
+# --------------------------------------------------
+def test_input_manifest(tmp_path):
+    """Test input_manifest scan/sniff/load/save"""
+
+    reads = tmp_path / 'reads'
+    (reads / 'sub').mkdir(parents=True)
+    (reads / 'a_1.txt').write_text('>r1\nACGT\n')
+    (reads / 'a_2.txt').write_text('>r1\nACGT\n')
+    with gzip.open(str(reads / 'sub' / 'b.fa.gz'), 'wt') as fh:
+        fh.write('@r1\nACGT\n+\nIIII\n')
+    (reads / 'sub' / 'run.sra').write_bytes(b'NCBI.sra\x00')
+    (reads / 'notes').write_text('hello')
+
+    old = input_manifest.Manifest()
+    manifest = input_manifest.scan([str(reads)], old, 2)
+    paths = manifest.paths()
+    assert [os.path.relpath(p, str(reads)) for p in paths] == [
+        'a_1.txt', 'a_2.txt', 'notes', 'sub/b.fa.gz', 'sub/run.sra'
+    ]
+    assert [(rec.format, rec.gzip)
+            for rec in map(manifest.files.get, paths)] == [
+                ('fasta', False), ('fasta', False), ('', False),
+                ('fastq', True), ('sra', False)]
+
+    manifest.set_mates([paths[0]], [paths[1]])
+    path = str(tmp_path / 'manifest.json')
+    manifest.save(path)
+    loaded = input_manifest.Manifest.load(path)
+    assert loaded == manifest
+    assert loaded.files[paths[1]].mate == paths[0]
+    assert input_manifest.Manifest.load(str(tmp_path / 'none')) == old
+
+    # Settled directories are not listed again; changed ones are
+    (reads / 'sub' / 'd.fq').write_text('@r2\nACGT\n+\nIIII\n')
+    for name, listing in loaded.dirs.items():
+        listing.mtime_ns = os.stat(name).st_mtime_ns
+    loaded.dirs[str(reads)].files.remove('notes')
+    loaded.dirs[str(reads / 'sub')].mtime_ns = 0
+    rescan = input_manifest.scan([str(reads)], loaded)
+    assert str(reads / 'notes') not in rescan.files
+    assert rescan.files[str(reads / 'sub' / 'd.fq')].format == 'fastq'
+    assert rescan.files[paths[0]] is loaded.files[paths[0]]
+
+    # A file rewritten in place is sniffed again, though its directory is
+    # not listed again
+    for name, listing in rescan.dirs.items():
+        listing.mtime_ns = os.stat(name).st_mtime_ns
+    with gzip.open(paths[0], 'wt') as fh:
+        fh.write('@r1\nACGT\n+\nIIII\n')
+    rescan = input_manifest.scan([str(reads)], rescan)
+    assert (rescan.files[paths[0]].format,
+            rescan.files[paths[0]].gzip) == ('fastq', True)
+
+
+# --------------------------------------------------
+def test_demux_batch(tmp_path):
+    """Test demux_batch"""
+
+    (tmp_path / 'a.fa').write_text('>r1\nACGT\n>r2\nACGT\n')
+    (tmp_path / 'b.fa').write_text('>r1\nACGT\n')
+    (tmp_path / 'batch.tsv').write_text(
+        'name\ttaxID\ttaxRank\tgenomeSize\tnumReads\tnumUniqueReads\tabundance\n'
+        'Foo bar\t1\tspecies\t100\t2\t1\t0.5\n'
+        'Baz qux\t2\tspecies\t300\t2\t1\t0.5\n')
+    (tmp_path / 'batch.sum').write_text(
+        'readID\tseqID\ttaxID\tscore\t2ndBestScore\thitLength\tqueryLength\tnumMatches\n'
+        'r1\ts1\t1\t9\t0\t4\t4\t2\n'
+        'r1\ts2\t2\t9\t0\t4\t4\t2\n'
+        'r2\tunclassified\t0\t0\t0\t0\t4\t1\n'
+        'r1\ts2\t2\t9\t0\t4\t4\t1\n')
+
+    batch = [
+        Sample('a.fa', [str(tmp_path / 'a.fa')]),
+        Sample('b.fa', [str(tmp_path / 'b.fa')])
+    ]
+    demux_batch(batch, str(tmp_path / 'batch.tsv'),
+                str(tmp_path / 'batch.sum'), str(tmp_path), 'fasta')
+
+    assert len((tmp_path / 'a.fa.sum').read_text().splitlines()) == 4
+    assert len((tmp_path / 'b.fa.sum').read_text().splitlines()) == 2
+
+    a_rows = (tmp_path / 'a.fa.tsv').read_text().splitlines()
+    assert len(a_rows) == 3
+    assert a_rows[1].split('\t')[4:6] == ['1', '0']
+
+    b_rows = (tmp_path / 'b.fa.tsv').read_text().splitlines()
+    assert b_rows[1].split('\t') == [
+        'Baz qux', '2', 'species', '300', '1', '1', '1'
+    ]
+
+
+# --------------------------------------------------
+def test_shard_files(tmp_path):
+    """Test shard_files/merge_shards"""
+
+    files = {'forward': [], 'reverse': [], 'unpaired': [], 'sra': []}
+    for name, size in [('a_1.fa', 50), ('a_2.fa', 50), ('b.fa', 90),
+                       ('c.fa', 30), ('d.fa', 30), ('e.sra', 10)]:
+        (tmp_path / name).write_text('x' * size)
+        kind = ('sra' if name.endswith('.sra') else 'forward'
+                if '_1' in name else 'reverse' if '_2' in name else 'unpaired')
+        files[kind].append(str(tmp_path / name))
+
+    shards = shard_files(files, 2)
+    assert shards == shard_files(files, 2)
+    names = [
+        sorted(os.path.basename(f) for kind in shard for f in shard[kind])
+        for shard in shards
+    ]
+    assert names == [['a_1.fa', 'a_2.fa', 'd.fa'], ['b.fa', 'c.fa', 'e.sra']]
+    assert shard_files(files, 3)[2] == {
+        'forward': [], 'reverse': [], 'unpaired': [str(tmp_path / 'c.fa'),
+                                                   str(tmp_path / 'd.fa')],
+        'sra': [str(tmp_path / 'e.sra')]}
+
+    out_dir = str(tmp_path / 'out')
+    samples = [Sample('a_1.fa', []), Sample('b.fa', [])]
+    for shard, sample in enumerate(samples, 1):
+        reports = os.path.join(shard_dir(out_dir, shard, 2), 'reports')
+        os.makedirs(reports)
+        for ext in ['tsv', 'sum']:
+            with open(os.path.join(reports, f'{sample.name}.{ext}'), 'w') as fh:
+                fh.write(f'{sample.name} {ext}')
+
+    reports_dir = merge_shards(samples, out_dir)
+    with open(os.path.join(reports_dir, 'b.fa.sum')) as fh:
+        assert fh.read() == 'b.fa sum'
+
+    with pytest.raises(Exception, match='1 sample.*c.fa'):
+        merge_shards(samples + [Sample('c.fa', [])], out_dir)
+
+
+# --------------------------------------------------
+def test_plan_resources():
+    """Test plan_resources"""
+
+    gb = 2**30
+
+    # Memory for two copies of the index on a 48-core node
+    assert plan_resources(10 * gb, 100, 48, 30 * gb) == (2, 24)
+
+    # Never more processes than jobs
+    assert plan_resources(gb, 3, 48, 200 * gb) == (3, 16)
+
+    # Always at least one process
+    assert plan_resources(100 * gb, 10, 4, 8 * gb) == (1, 4)
+
+    # Explicit settings win
+    assert plan_resources(gb, 100, 48, 200 * gb, 4, 0) == (4, 12)
+    assert plan_resources(gb, 100, 48, 200 * gb, 4, 2) == (4, 2)
+
+    # One memory-mapped copy shared by all
+    assert plan_resources(10 * gb, 100, 48, 30 * gb, 0, 0, True) == (8, 6)
+    assert plan_resources(100 * gb, 10, 4, 8 * gb, 0, 0, True) == (1, 4)
+
+
+# --------------------------------------------------
+def test_run_jobs(tmp_path):
+    """Test run_jobs runs largest-first and halts"""
+
+    out = tmp_path / 'out.txt'
+    run_jobs([(1, f'echo small >> {out}'), (9, f'echo big >> {out}')], 1)
+    assert out.read_text().splitlines() == ['big', 'small']
+
+    with pytest.raises(Exception, match='1 job'):
+        run_jobs([(2, 'false'), (1, f'echo late >> {out}')], 1, halt=1)
+    assert 'late' not in out.read_text()
+
+    done = {}
+    with pytest.raises(Exception, match='1 job'):
+        run_jobs([(1, 'exit 3'), (2, 'sleep 0.1')], 2,
+                 on_done=lambda cmd, usage: done.update({cmd: usage}))
+    assert done['exit 3']['exit_code'] == 3
+    assert done['sleep 0.1']['wall'] >= 0.1
+    assert done['sleep 0.1']['max_rss'] > 0
+
+    # Retried after a failure, with fewer threads after being killed
+    flag = tmp_path / 'flag'
+    attempts = []
+    threads = tmp_path / 'threads.txt'
+    cmd = (f'echo -p 8 >> {threads}; [ -e {flag} ] || {{ touch {flag}; '
+           'kill -9 $$; }')
+    run_jobs([(1, cmd)], 1,
+             on_done=lambda cmd, usage: attempts.append((cmd, usage)),
+             retries=2, backoff=0.01)
+    assert [usage['exit_code'] for _, usage in attempts] == [-9, 0]
+    assert [usage['retry'] for _, usage in attempts] == [True, False]
+    assert attempts[1][0] == cmd
+    assert threads.read_text().splitlines() == ['-p 8', '-p 4']
+
+    with pytest.raises(Exception, match='1 job'):
+        run_jobs([(1, 'exit 3')], 1,
+                 on_done=lambda cmd, usage: attempts.append((cmd, usage)),
+                 retries=1, backoff=0)
+    assert [usage['attempt'] for _, usage in attempts[2:]] == [1, 2]
+
+
+# --------------------------------------------------
+def test_fewer_threads():
+    """Test fewer_threads"""
+
+    assert fewer_threads('centrifuge  -f -p 8 -x idx -p 3') == \
+        'centrifuge  -f -p 4 -x idx -p 3'
+    assert fewer_threads('centrifuge -p 1 -x idx') == 'centrifuge -p 1 -x idx'
+    assert fewer_threads('echo') == 'echo'
+
+
+# --------------------------------------------------
+def test_journal(tmp_path):
+    """Test job_journal replays states, surviving a torn last line"""
+
+    path = str(tmp_path / 'journal.jsonl')
+    journal = job_journal.Journal(path)
+    journal.write('s1', 'retry', attempt=1, exit_code=-9)
+    journal.write('s2', 'done', attempt=1, exit_code=0)
+    journal.write('s1', 'failed', attempt=2, exit_code=1)
+    journal.close()
+
+    with open(path, 'a') as fh:
+        fh.write('{"job": "s2", "sta')
+
+    journal = job_journal.Journal(path)
+    assert journal.state('s1') == 'failed'
+    assert journal.state('s2') == 'done'
+    assert journal.state('s3') == ''
+    journal.write('s1', 'done', attempt=3, exit_code=0)
+    journal.close()
+
+    assert job_journal.Journal(path).state('s1') == 'done'
+    assert job_journal.Journal().state('s1') == ''
+
+
+# --------------------------------------------------
+def test_trace(tmp_path):
+    """Test metrics.Trace records stages and jobs"""
+
+    path = str(tmp_path / 'metrics.jsonl')
+    trace = metrics.Trace(path)
+    with trace.stage('classify') as stage:
+        stage['reads'] = 100
+    trace.write('job', 's1', exit_code=0, wall=2., cpu=1., max_rss=2**20,
+                queued=0., reads=100)
+    trace.close()
+
+    with open(path) as fh:
+        records = list(map(json.loads, fh))
+    assert [rec['name'] for rec in records] == ['classify', 's1']
+    assert records[0]['wall'] > 0 and records[0]['reads'] == 100
+    assert records[1]['reads_per_sec'] == 50
+    assert '1 job(s), 0 failed' in trace.summary()
+
+
+# --------------------------------------------------
+def test_report_cache(tmp_path):
+    """Test report_cache store/fetch/evict"""
+
+    cache_dir = str(tmp_path / 'cache')
+    os.makedirs(cache_dir)
+    (tmp_path / 'index.1.cf').write_text('index')
+    (tmp_path / 'reads.fa').write_text('>r1\nACGT\n')
+    digest = report_cache.file_digest(str(tmp_path / 'reads.fa'))
+
+    key = report_cache.cache_key([digest], 'index',
+                                 [str(tmp_path / 'index.1.cf')], [9606])
+    assert key != report_cache.cache_key([digest], 'index',
+                                         [str(tmp_path / 'index.1.cf')], [])
+    assert key != report_cache.cache_key([digest], 'index',
+                                         [str(tmp_path / 'index.1.cf')],
+                                         [9606], True)
+
+    basename = str(tmp_path / 'reads.fa')
+    assert not report_cache.fetch(cache_dir, key, basename)
+
+    (tmp_path / 'reads.fa.tsv').write_text('tsv')
+    (tmp_path / 'reads.fa.sum').write_text('sum')
+    report_cache.store(cache_dir, key, basename)
+    os.remove(basename + '.tsv')
+    entry = report_cache.entry_dir(cache_dir, key)
+    assert os.stat(entry).st_mode & 0o777 == 0o755
+    assert os.stat(os.path.join(entry, 'tsv')).st_mode & 0o777 == 0o644
+
+    assert report_cache.fetch(cache_dir, key, basename)
+    assert (tmp_path / 'reads.fa.tsv').read_text() == 'tsv'
+
+    # Only stale temporary entries are swept, as others may be in use
+    for name, age in [('.tmp-old', 2 * report_cache.TMP_MAX_AGE),
+                      ('.tmp-new', 0)]:
+        os.makedirs(os.path.join(cache_dir, name))
+        then = time.time() - age
+        os.utime(os.path.join(cache_dir, name), (then, then))
+    assert report_cache.evict(cache_dir, 100) == []
+    assert sorted(name for name in os.listdir(cache_dir)
+                  if name.startswith('.tmp-')) == ['.tmp-new']
+    assert len(report_cache.evict(cache_dir, 0)) == 1
+    assert not report_cache.fetch(cache_dir, key, basename)
+
+
+# --------------------------------------------------
+def test_index_stage(tmp_path):
+    """Test index_stage acquire/release/eviction"""
+
+    stage_dir = str(tmp_path / 'stage')
+    files = []
+    for name, body in [('a.1.cf', 'x' * 30), ('a.2.cf', 'y' * 20),
+                       ('b.1.cf', 'z' * 40)]:
+        (tmp_path / name).write_text(body)
+        files.append(str(tmp_path / name))
+
+    entry = index_stage.acquire('a', files[:2], stage_dir)
+    assert os.path.basename(entry).startswith('a-')
+    # Each user stages their own copies
+    assert os.path.dirname(entry) == os.path.join(stage_dir,
+                                                  str(os.getuid()))
+    with open(os.path.join(entry, 'a.2.cf')) as fh:
+        assert fh.read() == 'y' * 20
+    # Copies keep the mtimes, so report cache keys are unchanged
+    assert report_cache.cache_key([], 'a', files[:2], []) == \
+        report_cache.cache_key(
+            [], 'a', [os.path.join(entry, 'a.1.cf'),
+                      os.path.join(entry, 'a.2.cf')], [])
+
+    assert index_stage.acquire('a', files[:2], stage_dir) == entry
+    assert index_stage.live_refs(entry) == [os.getpid()] * 2
+    index_stage.release(entry)
+    assert index_stage.live_refs(entry) == [os.getpid()]
+
+    # A run that died without releasing does not count
+    proc = subprocess.Popen(['true'])
+    proc.wait()
+    index_stage.write_refs(entry, [proc.pid])
+    assert index_stage.live_refs(entry) == []
+
+    # An entry in use is not evicted to make room
+    index_stage.acquire('a', files[:2], stage_dir)
+    assert index_stage.acquire('b', files[2:], stage_dir, 60) == ''
+    index_stage.release(entry)
+    other = index_stage.acquire('b', files[2:], stage_dir, 60)
+    assert other and not os.path.isdir(entry)
+
+    # A partial copy is replaced
+    os.remove(os.path.join(other, 'b.1.cf'))
+    assert index_stage.acquire('b', files[2:], stage_dir, 60) == other
+    assert os.path.isfile(os.path.join(other, 'b.1.cf'))
+    assert index_stage.acquire('b', files[2:], stage_dir, 10) == other
+
+
+# --------------------------------------------------
+def test_mmap_index(tmp_path):
+    """Test mmap_index prewarm/residency/pin"""
+
+    files = [str(tmp_path / 'a.1.cf'), str(tmp_path / 'a.2.cf')]
+    with open(files[0], 'wb') as fh:
+        fh.write(os.urandom(5 * 2**16 + 1))
+    open(files[1], 'wb').close()
+
+    assert mmap_index.prewarm(files, 2, 2**16) == 5 * 2**16 + 1
+    resident, expected = mmap_index.residency(files)
+    assert expected == mmap_index.num_pages(5 * 2**16 + 1)
+    assert 0 <= resident <= expected
+
+    try:
+        mappings = mmap_index.pin(files)
+    except OSError:
+        # e.g., RLIMIT_MEMLOCK
+        mappings = []
+    assert len(mappings) in (0, 1)
+    mmap_index.unpin(mappings)
+
+
+# --------------------------------------------------
+# Spot by spot, the mates in turn, as fastq-dump writes them, and more
+# than a pipe holds, so named pipes block unless both are read in step
+FAKE_FASTQ_DUMP = """#!/usr/bin/env python3
+import os, sys
+args = sys.argv[1:]
+paired = 'paired' in args[-1]
+spots = 1 if '-X' in args else 2000
+mates = [1, 2] if paired and '--split-files' in args else [1]
+acc = os.path.splitext(os.path.basename(args[-1]))[0]
+outs = ([sys.stdout] * len(mates) if '-Z' in args else [
+    open(os.path.join(args[args.index('-O') + 1], f'{acc}_{m}.fasta'), 'w')
+    for m in mates
+])
+for i in range(spots):
+    for m, out in zip(mates, outs):
+        out.write(f'>s{i}.{m}\\n' + 'ACGT' * 25 + '\\n')
+for out in outs:
+    out.flush()
+"""
+
+
+# --------------------------------------------------
+def test_sra_command(tmp_path):
+    """Test streaming SRA runs with a stand-in fastq-dump"""
+
+    fastq_dump = tmp_path / 'fastq-dump'
+    fastq_dump.write_text(FAKE_FASTQ_DUMP)
+    fastq_dump.chmod(0o755)
+
+    for name in ['single.sra', 'paired.sra']:
+        (tmp_path / name).write_text('')
+
+    assert not sra_is_paired(str(fastq_dump), str(tmp_path / 'single.sra'))
+    assert sra_is_paired(str(fastq_dump), str(tmp_path / 'paired.sra'))
+
+    # "paste" stands in for Centrifuge, reading the streams it is given
+    # in step; a deadlock between the pipes fails the timeout
+    out = tmp_path / 'out.fa'
+    for name, paired in [('single.sra', False), ('paired.sra', True)]:
+        cmd = sra_command(str(fastq_dump), str(tmp_path / name), paired,
+                          'paste -d "\\n" ', f'> "{out}"',
+                          str(tmp_path / 'work'))
+        cmd = cmd.replace('-U - ', '-').replace('-1 ', '').replace('-2 ', '')
+        proc = subprocess.Popen(['bash', '-c', cmd], start_new_session=True)
+        try:
+            assert proc.wait(timeout=30) == 0
+        finally:
+            if proc.poll() is None:
+                os.killpg(proc.pid, signal.SIGKILL)
+        assert out.read_text().count('>') == (4000 if paired else 2000)
+
+    assert not (tmp_path / 'work').exists()
+
+
+# --------------------------------------------------
+def test_split_raw(tmp_path):
+    """Test fasplit.split_raw across block boundaries"""
+
+    fasta = b''.join(b'>r%d\nACGT\nAC\n' % i for i in range(7))
+    fastq = b''.join(b'@r%d\nACGT\n+\nIIII\n' % i for i in range(7))
+
+    for fmt, data in [('fasta', fasta), ('fastq', fastq)]:
+        for block_size in [3, 7, 1000]:
+            out_path = lambda n: str(tmp_path / f'{fmt}.{block_size}.{n}')
+            open_chunk = lambda n: open(out_path(n), 'wb')
+            nseq, nfile = fasplit.split_raw(io.BytesIO(data), fmt, 3,
+                                            open_chunk, block_size)
+            assert (nseq, nfile) == (7, 3)
+
+            chunks = [open(out_path(n), 'rb').read() for n in [1, 2, 3]]
+            assert b''.join(chunks) == data
+            assert chunks[0].count(b'@' if fmt == 'fastq' else b'>') == 3
+
+
+# --------------------------------------------------
+def test_fasplit_index(tmp_path):
+    """Test fasplit offset index and slices, plain and multi-member gzip"""
+
+    recs = [b'@r%d\nACGT\n+\nIIII\n' % i for i in range(7)]
+    (tmp_path / 'a.fq').write_bytes(b''.join(recs))
+
+    # Two members, like BGZF blocks
+    with open(tmp_path / 'a.fq.gz', 'wb') as fh:
+        fh.write(gzip.compress(b''.join(recs[:4])))
+        fh.write(gzip.compress(b''.join(recs[4:])))
+
+    for name in ['a.fq', 'a.fq.gz']:
+        entries = fasplit.build_index(str(tmp_path / name), 'fastq', 3)
+        assert [entry[2] for entry in entries] == [3, 3, 1]
+
+        idx = str(tmp_path / (name + '.idx'))
+        fasplit.write_index(entries, idx)
+        assert fasplit.read_index(idx) == entries
+
+        for num, expected in [(1, recs[:3]), (2, recs[3:6]), (3, recs[6:])]:
+            out = io.BytesIO()
+            fasplit.write_slice(str(tmp_path / name), entries, num, out)
+            assert out.getvalue() == b''.join(expected)
+
+    # The third chunk starts inside the second member
+    assert entries[2][3] > 0
+    assert entries[2][4] == len(recs[4]) * 2
+
+
+# --------------------------------------------------
+def test_split_parallel(tmp_path):
+    """Test fasplit.split_parallel with compressed chunks"""
+
+    data = b''.join(b'>r%d\nACGT\n' % i for i in range(10))
+    out_path = lambda n: str(tmp_path / f'a.{n}.fa.gz')
+
+    nseq, nfile = fasplit.split_parallel(io.BytesIO(data), 'fasta', 4,
+                                         out_path, threads=3, compress=True)
+    assert (nseq, nfile) == (10, 3)
+    assert b''.join(gzip.open(out_path(n)).read() for n in [1, 2, 3]) == data
+
+    # A chunk that cannot be written fails the split instead of hanging it
+    os.makedirs(str(tmp_path / 'b.2.fa'))
+    with pytest.raises(IsADirectoryError):
+        fasplit.split_parallel(io.BytesIO(data * 1000), 'fasta', 4,
+                               lambda n: str(tmp_path / f'b.{n}.fa'),
+                               threads=2)
+
+
+# --------------------------------------------------
+def test_split_sized(tmp_path):
+    """Test fasplit.split_sized by bytes and into equal chunks"""
+
+    lens = [100, 5, 5, 5, 90, 10, 3, 2]
+    fasta = b''.join(b'>r\n' + b'A' * n + b'\n' for n in lens)
+    fastq = b''.join(b'@r\n' + b'A' * n + b'\n+\n' + b'I' * n + b'\n'
+                     for n in lens)
+
+    for fmt, data in [('fasta', fasta), ('fastq', fastq)]:
+        for block_size in [5, 1000]:
+            for num in [1, 2, 3, 4]:
+                out_path = lambda n: str(tmp_path / f'{fmt}.{num}.{n}')
+                open_chunk = lambda n: open(out_path(n), 'wb')
+                chunk_end = lambda n, start: -(-n * len(data) // num)
+                nseq, nfile = fasplit.split_sized(io.BytesIO(data), fmt,
+                                                  chunk_end, open_chunk,
+                                                  block_size)
+                assert nseq == len(lens)
+                assert nfile == num
+
+                chunks = [
+                    open(out_path(n), 'rb').read()
+                    for n in range(1, nfile + 1)
+                ]
+                assert b''.join(chunks) == data
+                marker = b'>' if fmt == 'fasta' else b'@'
+                assert all(chunk.startswith(marker) for chunk in chunks)
+
+    # Balanced by size, the long reads end up on their own
+    assert open(tmp_path / 'fasta.2.1', 'rb').read() == fasta[:131]
+
+    # More chunks than records leaves no chunk empty, just fewer chunks
+    data = b'>a\nAC\n>b\nGT\n'
+    chunk_end = lambda n, start: -(-n * len(data) // 4)
+    open_chunk = lambda n: open(tmp_path / f'few.{n}', 'wb')
+    assert fasplit.split_sized(io.BytesIO(data), 'fasta', chunk_end,
+                               open_chunk) == (2, 2)
+    assert open(tmp_path / 'few.1', 'rb').read() == b'>a\nAC\n'
+    assert open(tmp_path / 'few.2', 'rb').read() == b'>b\nGT\n'
+    assert not os.path.exists(tmp_path / 'few.3')
+
+
+# --------------------------------------------------
+def test_index_splits():
+    """Test collapse.index_splits"""
+
+    index = collapse.index_splits(
+        ['x.y.10.fa.tsv', 'x.y.2.fa.tsv', 'x.y.2.fa.sum', 'z.1.fq.tsv',
+         'notes.txt'], 'r')
+
+    assert sorted(index) == [('x.y', 'fa'), ('z', 'fq')]
+    assert sorted(index[('x.y', 'fa')]['tsv']) == [(2, 'r/x.y.2.fa.tsv'),
+                                                   (10, 'r/x.y.10.fa.tsv')]
+    assert index[('x.y', 'fa')]['sum'] == [(2, 'r/x.y.2.fa.sum')]
+
+
+# --------------------------------------------------
+def test_write_sum(tmp_path):
+    """Test collapse.write_sum, plain and gzipped"""
+
+    files = []
+    for num in [1, 2]:
+        path = tmp_path / f'a.{num}.fa.sum'
+        path.write_text('readID\ttaxID\n' + f'r{num}\t1\n' * 3)
+        files.append(str(path))
+
+    expected = 'readID\ttaxID\n' + 'r1\t1\n' * 3 + 'r2\t1\n' * 3
+    for out in ['a.sum', 'a.sum.gz']:
+        out_path = str(tmp_path / out)
+        collapse.collapse('sum', files, out_path)
+        opener = gzip.open if out.endswith('.gz') else open
+        assert opener(out_path, 'rt').read() == expected
+
+
+# --------------------------------------------------
+def test_unsplit(tmp_path):
+    """Test unsplit.group_splits orders numerically and unsplit joins"""
+
+    for num in [1, 2, 10]:
+        (tmp_path / f'x.{num}.fa').write_text(f'>r{num}\nACGT\n')
+
+    groups = unsplit.group_splits(sorted(os.listdir(tmp_path)),
+                                  str(tmp_path))
+    assert list(groups) == ['x.fa']
+    assert [os.path.basename(f) for f in groups['x.fa']] == [
+        'x.1.fa', 'x.2.fa', 'x.10.fa'
+    ]
+
+    out_path = str(tmp_path / 'x.fa')
+    unsplit.unsplit(out_path, groups['x.fa'])
+    assert open(out_path).read() == '>r1\nACGT\n>r2\nACGT\n>r10\nACGT\n'
+    assert not [f for f in os.listdir(tmp_path) if f.startswith('.')]
+
+
+# --------------------------------------------------
+def test_parse_files(tmp_path):
+    """Test plot.parse_files"""
+
+    hdr = 'name\ttaxID\ttaxRank\tgenomeSize\tnumReads\tnumUniqueReads\tabundance\n'
+    (tmp_path / 's1.tsv').write_text(
+        hdr + 'Escherichia coli K-12\t1\tleaf\t10\t9\t6\t0.25\n'
+        'Escherichia coli\t2\tspecies\t10\t9\t2\t0.5\n'
+        'Enterobacteria phage T4\t3\tleaf\t10\t9\t2\t0.125\n'
+        'Homo sapiens\t9606\tspecies\t10\t9\t5\t0.1\n'
+        'Bacillus\t4\tgenus\t10\t9\t7\t0.1\n'
+        'Bad\t5\tspecies\t10\t9\tx\t0.1\n')
+    (tmp_path / 's2.tsv').write_text(hdr)
+
+    files = [open(tmp_path / 's1.tsv'), open(tmp_path / 's2.tsv')]
+    data = plot.parse_files(files, 'species', ['9606'], 0.1)
+
+    assert data == [{
+        'sample': 's1',
+        'tax_name': 'Escherichia coli',
+        'pct': 0.8,
+        'reads': 8,
+        'abundance': 0.75
+    }, {
+        'sample': 's1',
+        'tax_name': 'Enterobacteria phage T4',
+        'pct': 0.2,
+        'reads': 2,
+        'abundance': 0.125
+    }]
+
+
+# --------------------------------------------------
+def test_taxonomy(tmp_path):
+    """Test rolling taxa up a fixture taxonomy"""
+
+    tree = taxonomy.parse_tree([
+        '1\t|\t1\t|\tno rank', '2\t|\t1\t|\tsuperkingdom',
+        '561\t|\t2\t|\tgenus', '562\t|\t561\t|\tspecies',
+        '83333\t|\t562\t|\tno rank', '10665\t|\t1\t|\tspecies'
+    ])
+    names = taxonomy.parse_names([
+        '1\troot', '2\tBacteria', '561\tEscherichia',
+        '562\tEscherichia coli', '83333\tEscherichia coli K-12',
+        '10665\tEscherichia virus T4'
+    ])
+    tax_file = str(tmp_path / 'idx.taxonomy.npz')
+    taxonomy.Taxonomy.from_tables(tree, names).save(tax_file)
+    tax = taxonomy.load(tax_file)
+
+    assert tax.ancestor_at([83333, 562, 561, 10665, 7, 0],
+                           'species').tolist() == [562, 562, 0, 10665, 0, 0]
+    assert tax.ancestor_at([83333, 10665], 'genus').tolist() == [561, 0]
+    assert tax.ancestor_at([83333], 'order').tolist() == [0]
+    assert tax.name_of([561, 3, 83333]).tolist() == [
+        'Escherichia', '', 'Escherichia coli K-12'
+    ]
+
+    hdr = 'name\ttaxID\ttaxRank\tgenomeSize\tnumReads\tnumUniqueReads\tabundance\n'
+    (tmp_path / 's1.tsv').write_text(
+        hdr + 'E. coli K-12 MG1655\t83333\tleaf\t10\t9\t6\t0.25\n'
+        'E. coli\t562\tspecies\t10\t9\t2\t0.5\n'
+        'Escherichia virus T4\t10665\tspecies\t10\t9\t2\t0.125\n'
+        'Unknown\t99\tleaf\t10\t9\t5\t0.1\n')
+
+    data = plot.parse_files([open(tmp_path / 's1.tsv')], 'species', [], 0,
+                            tax_file=tax_file)
+    assert [(d['tax_name'], d['reads']) for d in data] == [
+        ('Escherichia coli', 8), ('Escherichia virus T4', 2)
+    ]
+    assert taxonomy.cache_for(tax_file) == tax_file
+
+
+# --------------------------------------------------
+def test_plot_heatmap(tmp_path):
+    """Test plot.plot_heatmap pages samples and keeps the top taxa"""
+
+    df = pd.DataFrame({
+        'sample': ['s{}'.format(i // 3) for i in range(30)],
+        'tax_name': ['t{}'.format(i % 7) for i in range(30)],
+        'pct': [0.1] * 30
+    })
+    outfile = str(tmp_path / 'bubble.png')
+
+    assert plot.plot_heatmap(df, outfile, 'Big', 4, 2, True) == [
+        str(tmp_path / 'bubble.{}.png'.format(page)) for page in [1, 2, 3]
+    ]
+    assert all(os.path.isfile(tmp_path / 'bubble.{}.png'.format(page))
+               for page in [1, 2, 3])
+    assert plot.plot_heatmap(df, outfile) == [outfile]
+
+
+# --------------------------------------------------
+def test_make_bubble(tmp_path, monkeypatch):
+    """Test run_centrifuge.make_bubble plots in-process"""
+
+    index_dir = tmp_path / 'idx'
+    index_dir.mkdir()
+    (index_dir / 'p.1.cf').write_text('')
+    taxonomy.Taxonomy.from_tables(
+        [(1, 1, 'no rank'), (9, 1, 'species')],
+        [(9, 'Foo bar')]).save(str(index_dir / 'p.taxonomy.npz'))
+
+    reports_dir = tmp_path / 'reports'
+    reports_dir.mkdir()
+    (reports_dir / 's1.tsv').write_text(
+        'name\ttaxID\ttaxRank\tgenomeSize\tnumReads\tnumUniqueReads\t'
+        'abundance\nFoo\t9\tleaf\t10\t9\t6\t0.25\n')
+
+    args = Args(query=[], format='fasta', index='p', index_dir=str(index_dir),
+                out_dir=str(tmp_path / 'out'), exclude_tax_ids=[],
+                figure_title='Test', num_threads=1, num_procs=1,
+                min_proportion=0.02, verbose=False, reads_not_paired=False,
+                num_halt=0, batch_size=0, cache_dir='', cache_size=100.,
+                metrics_file='', manifest_file='', stage_dir='', stage_size=0.,
+                mmap=False, mlock=False, shard=0, num_shards=0, merge=False,
+                journal_file='', retries=0, backoff=0., taxonomy=False)
+
+    # An existing cache is used
+    fig_dir = make_bubble(str(reports_dir), args)
+    assert os.path.isfile(os.path.join(fig_dir, 'bubble.png'))
+    with open(os.path.join(fig_dir, 'bubble.csv')) as fh:
+        assert fh.read().splitlines()[1].startswith('s1,Foo bar,')
+
+    # Without one, names are split unless --taxonomy asks to build it,
+    # which falls back to names if centrifuge-inspect fails
+    os.remove(index_dir / 'p.taxonomy.npz')
+    monkeypatch.setenv('PATH', str(tmp_path / 'nowhere'))
+    for build in [False, True]:
+        fig_dir = make_bubble(str(reports_dir),
+                              dataclasses.replace(args, taxonomy=build))
+        with open(os.path.join(fig_dir, 'bubble.csv')) as fh:
+            assert fh.read().splitlines()[1].startswith('s1,Foo,')
+    assert not any(name.endswith('.npz') for name in os.listdir(fig_dir))
+
+
+# --------------------------------------------------
+def test_bench(tmp_path):
+    """Test the fake centrifuge and regression checks of bench.py"""
+
+    bench.install_fakes(str(tmp_path / 'bin'))
+    reads = str(tmp_path / 'r.fa.gz')
+    bench.write_reads(reads, 'fasta', 10)
+
+    subprocess.run([
+        str(tmp_path / 'bin' / 'centrifuge'), '-f', '-x', 'idx', '-U', reads,
+        '-S', str(tmp_path / 'r.sum'), '--report-file',
+        str(tmp_path / 'r.tsv')
+    ],
+                   env=bench.fake_env(str(tmp_path), 0, 2),
+                   check=True)
+
+    with open(tmp_path / 'r.sum') as fh:
+        assert len(fh.read().splitlines()) == 1 + 10 * 2
+    with open(tmp_path / 'r.tsv') as fh:
+        assert sum(int(line.split('\t')[4])
+                   for line in fh.read().splitlines()[1:]) == 20
+
+    assert bench.compare({'a': 1.3, 'b': 1.2, 'c': 9.}, {'a': 1., 'b': 1.},
+                         .25) == ['a']
+
+
+# --------------------------------------------------
+def test_tree_reduce():
+    """Test reports.tree_reduce keeps order"""
+
+    merge = lambda parts: ''.join(parts)
+    for num in [0, 1, 2, 5, 16, 17, 100]:
+        items = [chr(65 + i % 26) for i in range(num)]
+        assert reports.tree_reduce(items, merge, '', 4) == ''.join(items)
+        assert reports.map_reduce(str.lower, items, merge, '',
+                                  2) == ''.join(items).lower()
+
+
+# --------------------------------------------------
+def test_cohort_matrix():
+    """Test reports.CohortMatrix sums cells and orders samples"""
+
+    matrix = reports.CohortMatrix.concat([
+        reports.CohortMatrix.from_entries([2, 2, 2], ['b', 'a', 'b'],
+                                          reads=np.array([1, 2, 3])),
+        reports.CohortMatrix.from_entries([0, 2], ['a', 'c'],
+                                          reads=np.array([4, 5]))
+    ]).sort_samples()
+
+    assert matrix.samples.tolist() == [0, 2]
+    assert matrix.taxa[matrix.cols].tolist() == ['a', 'b', 'a', 'c']
+    assert matrix.values['reads'].tolist() == [4, 4, 2, 5]
+    assert matrix.indptr().tolist() == [0, 1, 4]
+    assert matrix.row_totals('reads').tolist() == [4, 11]
+    assert matrix.select(matrix.values['reads'] > 3).to_frame().to_dict(
+        'list') == {'sample': [0, 2, 2], 'taxon': ['a', 'b', 'c'],
+                    'reads': [4, 4, 5]}
+
+
+# --------------------------------------------------
+def test_load_cohort(tmp_path, monkeypatch):
+    """Test plot.load_cohort reuses unchanged reports"""
+
+    hdr = 'name\ttaxID\ttaxRank\tgenomeSize\tnumReads\tnumUniqueReads\tabundance\n'
+    paths = []
+    for num in [1, 2]:
+        path = tmp_path / f's{num}.tsv'
+        path.write_text(hdr + f'Foo bar\t{num}\tspecies\t10\t9\t{num}\t0.5\n')
+        paths.append(str(path))
+
+    cache_path = str(tmp_path / 'bubble.cohort.parquet')
+    first = plot.load_cohort(cache_path, paths)
+    assert first['taxID'].tolist() == ['1', '2']
+    assert os.path.isfile(cache_path)
+
+    read = []
+    read_raw = plot.read_raw
+    monkeypatch.setattr(plot, 'read_raw',
+                        lambda src: read.append(src) or read_raw(src))
+
+    def rewrite(path, text):
+        """Same size, so set a later mtime than coarse clocks might"""
+        mtime_ns = os.stat(path).st_mtime_ns + 10**9
+        path.write_text(text)
+        os.utime(path, ns=(mtime_ns, mtime_ns))
+
+    # Only the changed report is read again
+    rewrite(tmp_path / 's2.tsv', hdr + 'Foo bar\t3\tspecies\t10\t9\t3\t0.5\n')
+    second = plot.load_cohort(cache_path, paths)
+    assert second['taxID'].tolist() == ['1', '3']
+    assert read == [paths[1]]
+
+    # A report given twice (e.g., by overlapping globs) is read once
+    read.clear()
+    rewrite(tmp_path / 's1.tsv', hdr + 'Foo bar\t4\tspecies\t10\t9\t4\t0.5\n')
+    third = plot.load_cohort(cache_path, [paths[0], paths[1], paths[0]])
+    assert third['taxID'].tolist() == ['4', '3']
+    assert read == [paths[0]]
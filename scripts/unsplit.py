@@ -5,7 +5,11 @@
 import argparse
 import os
 import re
+import sys
+import tempfile
 from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from collapse import copy_rest
 
 # --------------------------------------------------
 def get_args():
@@ -15,6 +19,10 @@ def get_args():
                         type=str, metavar='DIR', required=True)
     parser.add_argument('-o', '--out_dir', help='Output directory',
                         type=str, metavar='DIR', required=True)
+    parser.add_argument('-p', '--procs', help='Number of files to write at once',
+                        type=int, metavar='NUM', default=os.cpu_count() or 1)
+    parser.add_argument('-n', '--dry_run', help='Only print "cat" commands',
+                        action='store_true')
     return parser.parse_args()
 
 # --------------------------------------------------
@@ -26,21 +34,65 @@ def main():
 
     if not os.path.isdir(in_dir):
         print("Bad --dir '{}'\n".format(in_dir))
+        sys.exit(1)
 
     if not os.path.isdir(out_dir):
         os.mkdir(out_dir)
 
+    files = group_splits(os.listdir(in_dir), in_dir)
+
+    if args.dry_run:
+        for file in files.keys():
+            print("cat {} > {}/{}".format(" ".join(files[file]), out_dir, file))
+        return
+
+    todo = {}
+    for file, parts in files.items():
+        out_path = os.path.join(out_dir, file)
+        if os.path.isfile(out_path):
+            print('"{}" exists, skipping'.format(out_path))
+        else:
+            todo[out_path] = parts
+
+    with ThreadPoolExecutor(max_workers=max(1, args.procs)) as pool:
+        for out_path in pool.map(unsplit, todo.keys(), todo.values()):
+            print('Wrote "{}"'.format(out_path))
+
+    print('Done, see output dir "{}"'.format(out_dir))
+
+# --------------------------------------------------
+def group_splits(names, in_dir):
+    """group "<base>.<num>.<ext>" files by "<base>.<ext>" in numeric order"""
     files = defaultdict(list)
-    for file in os.listdir(in_dir):
-        name = os.path.basename(file)
-        match = re.search("^(.+)(\.[0-9]+)(\.[a-zA-Z]+)$", name)
+    for name in names:
+        match = re.search(r"^(.+)\.([0-9]+)(\.[a-zA-Z]+)$", name)
         if not match is None:
-            groups = match.groups()
-            new = "".join([groups[0], groups[2]])
-            files[new].append(file)
+            base, num, ext = match.groups()
+            files[base + ext].append((int(num), os.path.join(in_dir, name)))
+
+    return {file: [path for _, path in sorted(parts)]
+            for file, parts in files.items()}
+
+# --------------------------------------------------
+def unsplit(out_path, parts):
+    """
+    concatenate parts into out_path, writing a temp file that is renamed
+    into place so an interrupted run never leaves a partial output
+    """
+    out_dir = os.path.dirname(out_path) or '.'
+    fd, tmp_path = tempfile.mkstemp(dir=out_dir, prefix='.unsplit-')
+    try:
+        with os.fdopen(fd, 'wb') as out_fh:
+            for part in parts:
+                with open(part, 'rb') as in_fh:
+                    copy_rest(in_fh, out_fh)
+        os.chmod(tmp_path, 0o644)
+        os.replace(tmp_path, out_path)
+    except BaseException:
+        os.remove(tmp_path)
+        raise
 
-    for file in files.keys():
-        print("cat {} > {}/{}".format(" ".join(files[file]), out_dir, file))
+    return out_path
 
 # --------------------------------------------------
 if __name__ == '__main__':
@@ -0,0 +1,31 @@
+#!/bin/bash
+
+#
+# Classify IN_DIR in NUM_SHARDS array tasks (one node each), then merge
+# the shards' reports and plot them once
+#
+
+set -u
+
+if [[ $# -lt 3 ]]; then
+    printf "  Usage: %s IN_DIR OUT_DIR NUM_SHARDS [DB QUEUE TIME]\\n" "$(basename "$0")"
+    exit 1
+fi
+
+IN_DIR=$1
+OUT_DIR=$2
+NUM_SHARDS=$3
+DB=${4:-p_compressed+h+v}
+QUEUE=${5:-normal}
+TIME=${6:-24:00:00}
+
+# Each task takes its shard from $SLURM_ARRAY_TASK_ID
+ARRAY_JOB=$(sbatch --parsable -A iPlant-Collabs -N 1 -n 1 -t "$TIME" \
+    -p "$QUEUE" -J cntrfge --array="1-$NUM_SHARDS" \
+    run.sh -q "$IN_DIR" -o "$OUT_DIR" -i "$DB" --shard "/$NUM_SHARDS")
+
+[[ -z "$ARRAY_JOB" ]] && exit 1
+
+sbatch -A iPlant-Collabs -N 1 -n 1 -t 02:00:00 -p "$QUEUE" -J cntrfge-merge \
+    --dependency="afterok:$ARRAY_JOB" \
+    run.sh -q "$IN_DIR" -o "$OUT_DIR" -i "$DB" --merge